@@ -0,0 +1,118 @@
+import os
+import re
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import pandas as pd
+
+from functools import partial
+
+from graph_cache import get_cache_path, save_arrays, load_array
+
+# number of attribute values read from a csv file at a time
+attribute_chunk_size = 10000000
+
+def read_attribute_csv(filepath):
+	'''
+	node ids and sparse attribute matrix of a csv file with a header row
+	and one row per node, indexed by its first column
+
+	rows are read in chunks of about attribute_chunk_size values and converted to csr
+	so that the dense matrix is never held in memory
+	'''
+	K = len(pd.read_csv(filepath, index_col=0, nrows=0).columns)
+	chunks = pd.read_csv(filepath, index_col=0, chunksize=max(1, attribute_chunk_size // K))
+
+	index = []
+	blocks = []
+	for chunk in chunks:
+		index.append(chunk.index.values)
+		blocks.append(sp.sparse.csr_matrix(chunk.values.astype(np.float64)))
+
+	return np.concatenate(index), sp.sparse.vstack(blocks, format="csr")
+
+def snap_feature_files(filepath):
+	'''
+	.feat files of the SNAP ego network layout: filepath itself or all of them in a directory
+	'''
+	if os.path.isdir(filepath):
+		return sorted(os.path.join(filepath, f) for f in os.listdir(filepath) if re.match("[0-9]+.feat$", f))
+	return [filepath]
+
+def read_snap_features(feature_files):
+	'''
+	node ids and sparse attribute matrix of SNAP .feat files (node id followed by binary features)
+	with their .featnames (index and name of every feature)
+
+	features are matched across files by name and a node that appears in several files
+	has every feature it has in any of them
+	'''
+	feature_names = {}
+	rows = []
+	columns = []
+
+	for feature_file in feature_files:
+
+		# map from column of this file to global feature
+		with open(os.path.splitext(feature_file)[0] + ".featnames", "r") as f:
+			feature_map = np.array([feature_names.setdefault(" ".join(line.rstrip().split(" ")[1:]),
+				len(feature_names)) for line in f])
+
+		for chunk in pd.read_csv(feature_file, sep=" ", header=None, index_col=0,
+			chunksize=max(1, attribute_chunk_size // len(feature_map))):
+			chunk_rows, chunk_columns = chunk.values.nonzero()
+			rows.append(chunk.index.values[chunk_rows])
+			columns.append(feature_map[chunk_columns])
+
+	index, rows = np.unique(np.concatenate(rows), return_inverse=True)
+	columns = np.concatenate(columns)
+	X = sp.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(index), len(feature_names)))
+	X.data[:] = 1
+
+	return index, X
+
+def load_attributes(filepath, cache_directory=None):
+	'''
+	node ids and sparse (csr) attribute matrix of a csv file, a SNAP .feat file
+	or a directory of SNAP .feat files
+
+	the attributes are parsed once and cached in cache_directory (default is .attribute_cache
+	next to filepath) under the hash of the source files, later calls memory map the cached arrays
+	'''
+	if os.path.isdir(filepath) or filepath.endswith(".feat"):
+		feature_files = snap_feature_files(filepath)
+		source_files = feature_files + [os.path.splitext(f)[0] + ".featnames" for f in feature_files]
+	else:
+		feature_files = None
+		source_files = [filepath]
+
+	cache_path = get_cache_path(source_files, cache_directory, ".attribute_cache")
+	if not os.path.exists(cache_path):
+		if feature_files is not None:
+			index, X = read_snap_features(feature_files)
+		else:
+			index, X = read_attribute_csv(filepath)
+		X.sort_indices()
+		save_arrays(cache_path, {"index" : index,
+			"X_data" : X.data, "X_indices" : X.indices, "X_indptr" : X.indptr,
+			"X_shape" : np.array(X.shape)})
+
+	load = partial(load_array, cache_path)
+
+	X = sp.sparse.csr_matrix((load("X_data"), load("X_indices"), load("X_indptr")),
+		shape=tuple(load("X_shape")))
+
+	return load("index"), X
+
+def select_rows(nodes, index, name="attributes"):
+	'''
+	rows of the attribute matrix (or another table called name) of nodes
+	integer nodes are positions (as in DataFrame.iloc), other node ids are looked up in index
+	'''
+	nodes = np.asarray(nodes)
+	if nodes.dtype.kind in "iu":
+		return nodes
+	rows = pd.Index(np.asarray(index).astype(str)).get_indexer(nodes.astype(str))
+	assert (rows >= 0).all(), "nodes missing from {}".format(name)
+	return rows
@@ -4,6 +4,8 @@ import networkx as nx
 
 import powerlaw
 
+from graph_cache import degree_order, radial_coordinates
+
 def estimate_T():
 	'''
 	TODO
@@ -22,14 +24,10 @@ def preprocess_G(gml_file):
 	N = nx.number_of_nodes(G)
 
 	degree_dict = nx.degree(G)
-	
-	# node id
-	order_of_appearance = np.array(sorted(degree_dict, key=degree_dict.get, reverse=True))
-	nodes = np.array(G.nodes())
-	# node index
-	order_of_appearance = np.concatenate([np.where(nodes==n)[0] for n in order_of_appearance])
+	degrees = np.array([degree_dict[n] for n in G.nodes()])
 
-	degrees = np.array(degree_dict.values())
+	# node index
+	order_of_appearance = degree_order(degrees)
 
 	# PS model parameters -- to estimate in real world network
 	m = degrees.mean() / 2
@@ -38,8 +36,7 @@ def preprocess_G(gml_file):
 	beta = 1 / (gamma - 1)
 
 	# determine radial coordinates of nodes
-	R = 2 * beta * np.log(range(1, N + 1)) + 2 * (1 - beta) * np.log(N) 
-	R = R[order_of_appearance]
+	R = radial_coordinates(degrees, gamma)
 
 	# observed adjacency matrix
 	A = np.array(nx.adjacency_matrix(G).todense())
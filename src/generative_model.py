@@ -1,4 +1,6 @@
 import os
+import time
+import ctypes
 
 import matplotlib
 matplotlib.use("Agg")
@@ -12,25 +14,100 @@ import pandas as pd
 
 from sys import stdout
 
-from functools import partial
 # from multiprocessing.pool import ThreadPool as Pool
-from multiprocessing import Pool
+from multiprocessing import Pool, sharedctypes
 
 from sklearn.metrics import normalized_mutual_info_score as NMI
 
 import powerlaw
 
-import matplotlib.pyplot as plt
+from plotting import Plotter
+from graph_cache import load_graph, radial_coordinates
+from attribute_cache import load_attributes, select_rows
+from training import EarlyStopping, LearningRateSchedule
+from training import prefixed, unprefixed, save_checkpoint_arrays, load_checkpoint, restore_states
+from labne import labne_angles, equidistant_angles
+
 
 # clip value to avoid taking log of 0 
 clip_value = 1e-8
+# smallest F_u F_v in the fused likelihood kernels, so that P_uv >= clip_value and log P_uv is finite
+min_FF = -np.log1p(-clip_value)
 grad_clip_value = 1
+# tolerance for agreement of closed form and per element gradients
+gradient_check_tolerance = 1e-6
+# steps between choosing the support of a sparse F, which takes a pass over all N x C node community pairs
+default_support_interval = 10
+# groups of parameters that are angles, wrapped onto [0, 2pi) after every update
+angular_parameters = ("thetas", "community_thetas")
+# groups of parameters held in the rows of M
+community_parameters = ("r", "community_thetas", "sd")
 
 def sigmoid(x):
 	'''
 	Compute the elementwise sigmoid activation of matrix x
+	(as exp(-softplus(-x)), which does not overflow)
+	'''
+	return np.exp(-softplus(-x))
+
+def softplus(x):
+	'''
+	log(1 + exp(x)) elementwise, without overflow
+	'''
+	return np.logaddexp(0, x)
+
+class Workspace(object):
 	'''
-	return 1 / (1 + np.exp(-x))
+	named arrays of a single dtype (H, F, blocks of P, Q, dL/dF, ...) that are allocated
+	on first use and then overwritten in place by every forward and backward pass,
+	so the training loop does not allocate them again
+	'''
+
+	def __init__(self, dtype=np.float64):
+		self.dtype = np.dtype(dtype)
+		self.arrays = {}
+
+	def get(self, name, shape):
+		if name not in self.arrays or self.arrays[name].shape != shape:
+			self.arrays[name] = np.empty(shape, dtype=self.dtype)
+		return self.arrays[name]
+
+	def nbytes(self):
+		return sum(array.nbytes for array in self.arrays.values())
+
+def get_buffer(workspace, name, shape, dtype=np.float64):
+	'''
+	array called name of the given shape from workspace
+	(a new array of dtype every time if workspace is None)
+	'''
+	if workspace is None:
+		return np.empty(shape, dtype=dtype)
+	return workspace.get(name, shape)
+
+def log_likelihood_pairs(FF, targets, P=None):
+	'''
+	summed log likelihood of observing targets A_uv for node pairs with F_u F_v = FF and its
+	derivative with respect to every F_u F_v, in one pass and without clipping P:
+
+	log P_uv = log(1 - exp(-F_u F_v)) = log(-expm1(-F_u F_v)), log(1 - P_uv) = -F_u F_v
+	and d log L_uv / d(F_u F_v) = A_uv / P_uv - 1
+
+	F_u F_v is floored at min_FF so that log P_uv is finite
+	FF is overwritten by the derivative, P is a buffer of the shape of FF (allocated if None)
+	'''
+	if P is None:
+		P = np.empty_like(FF)
+	np.maximum(FF, min_FF, out=FF)
+	np.negative(FF, out=P)
+	np.expm1(P, out=P)
+	np.negative(P, out=P)
+
+	log_likelihood = np.vdot(targets, FF) - FF.sum()
+	derivative = np.divide(targets, P, out=FF)
+	derivative -= 1
+	log_likelihood += np.vdot(targets, np.log(P, out=P))
+
+	return log_likelihood, derivative
 
 def compute_L_G(A, P):
 	
@@ -41,6 +118,131 @@ def compute_L_G(A, P):
 	return -(A.multiply(np.log(P)) + 
 		np.log(1 - P) - A.multiply(np.log(1 - P))).mean()
 
+def compute_row_products(X, Y, U, V):
+	'''
+	compute X_u Y_v for pairs of rows (U, V) of X and Y (X may be sparse)
+	'''
+	if sp.sparse.issparse(X):
+		return np.asarray(X[U].multiply(Y[V]).sum(axis=1)).ravel()
+	return np.einsum("ij,ij->i", np.asarray(X[U]), np.asarray(Y[V]))
+
+def transpose_dot(X, Y):
+	'''
+	X.T.dot(Y) as a dense array, for dense or sparse X and Y
+	'''
+	if sp.sparse.issparse(Y) and not sp.sparse.issparse(X):
+		return Y.T.dot(X).T
+	product = X.T.dot(Y)
+	if sp.sparse.issparse(product):
+		return product.toarray()
+	return product
+
+def compute_FF_pairs(F, U, V):
+	'''
+	compute F_u F_v for node pairs (U, V) only
+	'''
+	return compute_row_products(F, F, U, V)
+
+def sample_non_edges(N, A, num_negative_samples):
+	'''
+	sample num_negative_samples nodes uniformly for every node
+	returns sparse (N, N) matrix of weights, so that weighted sums over the samples
+	estimate sums over all non-edges of A
+	'''
+	U = np.repeat(np.arange(N), num_negative_samples)
+	V = np.random.randint(N, size=N * num_negative_samples)
+	is_edge = np.asarray(A[U, V] != 0).ravel()
+	weights = float(N) / num_negative_samples * (1 - is_edge)
+	non_edges = sp.sparse.csr_matrix((weights, (U, V)), shape=(N, N))
+	non_edges.eliminate_zeros()
+	return non_edges
+
+def sample_pairs(N, A, edges, batch_size, sampler="edge"):
+	'''
+	sample batch_size node pairs, returned as sparse (N, N) matrix of weights so that
+	weighted sums over the sample estimate sums over all N ** 2 pairs
+
+	"uniform" samples pairs uniformly,
+	"edge" samples half of the batch from the edges of A (given as the pair of arrays
+	returned by A.nonzero()) and half from the non-edges, so that edges are not drowned out
+	'''
+	if sampler == "uniform":
+		U = np.random.randint(N, size=batch_size)
+		V = np.random.randint(N, size=batch_size)
+		weights = np.ones(batch_size) * N ** 2 / batch_size
+	else:
+		num_edges = batch_size // 2
+		num_pairs = batch_size - num_edges
+		idx = np.random.randint(len(edges[0]), size=num_edges)
+		U = np.random.randint(N, size=num_pairs)
+		V = np.random.randint(N, size=num_pairs)
+		is_edge = np.asarray(A[U, V] != 0).ravel()
+		weights = np.append(np.ones(num_edges) * len(edges[0]) / num_edges,
+			(1 - is_edge) * float(N) ** 2 / num_pairs)
+		U = np.append(edges[0][idx], U)
+		V = np.append(edges[1][idx], V)
+	pairs = sp.sparse.csr_matrix((weights, (U, V)), shape=(N, N))
+	pairs.eliminate_zeros()
+	return pairs
+
+def sample_batch(N, A, edges, batch_size, sampler="edge"):
+	'''
+	sample a minibatch of batch_size node pairs (see sample_pairs)
+	and batch_size attribute rows, sampled uniformly without replacement
+	'''
+	pairs = sample_pairs(N, A, edges, batch_size, sampler)
+	rows = np.sort(np.random.choice(N, size=min(batch_size, N), replace=False))
+	return pairs, rows
+
+def candidate_pairs(F):
+	'''
+	node pairs that share at least one community of a sparse F (without the column of ones),
+	as a sparse (N, N) matrix of unit weights (see sample_pairs)
+	all other pairs have F_u F_v = 0
+	'''
+	pairs = F.dot(F.T).tocsr()
+	pairs.data[:] = 1
+	return pairs
+
+def compute_L_G_candidates(N, A, F):
+	'''
+	compute likelihood of observing adjacacy matrix A (as compute_L_G) from a sparse F
+	(without the column of ones), evaluating P on the candidate pairs only,
+	every other pair has P_uv = clip_value (see log_likelihood_pairs)
+	'''
+	pairs = candidate_pairs(F).tocoo()
+	targets = np.asarray(A[pairs.row, pairs.col]).ravel().astype(F.dtype)
+	L_G, _ = log_likelihood_pairs(compute_FF_pairs(F, pairs.row, pairs.col), targets)
+
+	# all other pairs have F_u F_v = min_FF
+	num_edges = A.sum() - targets.sum()
+	num_non_edges = N ** 2 - len(targets) - num_edges
+	L_G += num_edges * np.log(-np.expm1(-min_FF)) - num_non_edges * min_FF
+
+	return - L_G / N ** 2
+
+def compute_L_G_sparse(N, A, F, num_negative_samples=None):
+	'''
+	compute likelihood of observing adjacacy matrix A from the non zeros of A only
+
+	the edge term is exact (see log_likelihood_pairs), the non-edge term is either computed from
+	sum_uv F_u F_v = ||sum_u F_u|| ** 2 (log(1 - P_uv) = -F_u F_v)
+	or estimated from num_negative_samples sampled non-edges per node
+	'''
+	A = A.tocoo()
+	FF = compute_FF_pairs(F, A.row, A.col)
+	FF_sum = FF.sum()
+
+	L_G, _ = log_likelihood_pairs(FF, A.data)
+
+	if num_negative_samples is None:
+		L_G -= np.square(F.sum(axis=0)).sum() - FF_sum
+	else:
+		non_edges = sample_non_edges(N, A.tocsr(), num_negative_samples).tocoo()
+		L_G -= (non_edges.data * compute_FF_pairs(F, non_edges.row, non_edges.col)).sum()
+
+	return - L_G / N ** 2
+
 def compute_L_X(X, Q, attribute_type):
 
 	'''
@@ -54,55 +256,369 @@ def compute_L_X(X, Q, attribute_type):
 	return -(X.multiply(np.log(Q)) + 
 		np.log(1 - Q) - X.multiply(np.log(1 - Q))).mean()
 
-def compute_likelihood(A, X, N, K, R, thetas, M, W, lamb_F, lamb_W, alpha, attribute_type):
+def compute_L_X_and_residual(X, F, W, attribute_type, workspace=None):
+	'''
+	compute likelihood of observing attribute matrix X (as compute_L_X) and the residual X - Q
+	in one pass over an (N, K) buffer (F has the column of ones appended)
+
+	for binary attributes -log L_X = softplus(Z) - X Z for the logits Z = F W^T
+	and Q = exp(Z - softplus(Z)), so Q is never clipped
+	'''
+	N, K = X.shape
+	X = X.tocoo()
+
+	residual = get_buffer(workspace, "residual", (N, K), F.dtype)
+	if sp.sparse.issparse(F):
+		residual[:] = F.dot(W.T)
+	else:
+		np.dot(np.asarray(F), np.asarray(W).T, out=residual)
+
+	if attribute_type != "binary":
+		np.negative(residual, out=residual)
+		residual[X.row, X.col] += X.data
+		return 0.5 * np.vdot(residual, residual) / (N * K), residual
+
+	softplus_Z = get_buffer(workspace, "softplus_Z", (N, K), F.dtype)
+	np.logaddexp(0, residual, out=softplus_Z)
+	L_X = softplus_Z.sum() - (X.data * residual[X.row, X.col]).sum()
+
+	residual -= softplus_Z
+	np.exp(residual, out=residual)
+	np.negative(residual, out=residual)
+	residual[X.row, X.col] += X.data
+
+	return L_X / (N * K), residual
+
+def compute_Q_entries(F, W, U, V, attribute_type):
+	'''
+	compute probabilities of nodes U possessing attributes V only (not clipped)
+	'''
+	Q = compute_row_products(F, W, U, V)
+	if attribute_type != "binary":
+		return Q
+	return sigmoid(Q)
+
+def sample_attributes(N, K, num_attribute_samples):
+	'''
+	sample num_attribute_samples attributes uniformly for every node,
+	returned with weights so that weighted sums over the sample estimate sums over all N * K entries
+	'''
+	U = np.repeat(np.arange(N), num_attribute_samples)
+	V = np.random.randint(K, size=N * num_attribute_samples)
+	return U, V, float(K) / num_attribute_samples
+
+def attribute_blocks(N, K, C, block_size=None):
+	'''
+	row blocks small enough that a (block_size, K) block is no larger than (N, C)
+	'''
+	if block_size is None:
+		block_size = max(1, N * C // K)
+	return [(start, min(start + block_size, N)) for start in range(0, N, block_size)]
+
+def compute_L_X_sparse(X, F, W, attribute_type, num_attribute_samples=None, block_size=None):
+	'''
+	compute likelihood of observing attribute matrix X without forming the dense (N, K)
+	matrix Q (F has the column of ones appended)
+
+	for real valued attributes sum (X - Q) ** 2 = sum X ** 2 - 2 sum_{X != 0} X Q + ||F W^T|| ** 2,
+	where the last term is computed from F^T F and W^T W
+
+	for binary attributes log L_X = sum_{X != 0} X Z - sum softplus(Z) for the logits Z = F W^T
+	(see compute_L_X_and_residual), the positive entries of X are evaluated exactly and
+	the softplus over all entries either in row blocks of at most (N, C) or,
+	if num_attribute_samples is given, from that many sampled attributes per node
+	'''
+	N, K = X.shape
+	X = X.tocoo()
+	Z = compute_row_products(F, W, X.row, X.col)
+
+	if attribute_type != "binary":
+		QQ = np.multiply(transpose_dot(F, F), W.T.dot(W)).sum()
+		return 0.5 * (np.square(X.data).sum() - 2 * (X.data * Z).sum() + QQ) / (N * K)
+
+	L_X = (X.data * Z).sum()
+	if num_attribute_samples is None:
+		for start, stop in attribute_blocks(N, K, F.shape[1] - 1, block_size):
+			L_X -= softplus(F[start:stop].dot(W.T)).sum()
+	else:
+		U, V, weight = sample_attributes(N, K, num_attribute_samples)
+		L_X -= weight * softplus(compute_row_products(F, W, U, V)).sum()
+	return - L_X / (N * K)
+
+def compute_attribute_residual_products(X, F, W, attribute_type, num_attribute_samples=None, block_size=None,
+	support=None):
+	'''
+	(X - Q).dot(W[:,:-1]) and (X - Q).T.dot(F) without forming the dense (N, K) matrix Q
+	(F has the column of ones appended and may be sparse)
+	if the support of a sparse F is given, (X - Q).dot(W[:,:-1]) is computed on the support only
+
+	for real valued attributes Q.dot(W) = F.dot(W^T W) and Q^T F = W.dot(F^T F),
+	for binary attributes Q is computed in row blocks of at most (N, C) or,
+	if num_attribute_samples is given, estimated from that many sampled attributes per node
+	'''
+	N, K = X.shape
+	if support is None:
+		product = lambda left, right, support: left.dot(right)
+	else:
+		product = compute_support_products
+	residual_W = product(X, W[:,:-1], support)
+	residual_F = transpose_dot(X, F)
+
+	if attribute_type != "binary":
+		residual_W -= product(F, W.T.dot(W[:,:-1]), support)
+		residual_F -= W.dot(transpose_dot(F, F))
+	elif num_attribute_samples is None:
+		for start, stop in attribute_blocks(N, K, F.shape[1] - 1, block_size):
+			Q = sigmoid(F[start:stop].dot(W.T))
+			if support is None:
+				residual_W[start:stop] -= Q.dot(W[:,:-1])
+			else:
+				first, last = np.searchsorted(support[0], [start, stop])
+				residual_W[first:last] -= compute_support_products(Q, W[:,:-1],
+					(support[0][first:last] - start, support[1][first:last]))
+			residual_F -= transpose_dot(Q, F[start:stop])
+	else:
+		U, V, weight = sample_attributes(N, K, num_attribute_samples)
+		Q = sp.sparse.csr_matrix((weight * compute_Q_entries(F, W, U, V, attribute_type), (U, V)), shape=(N, K))
+		residual_W -= product(Q, W[:,:-1], support)
+		residual_F -= transpose_dot(Q, F)
+
+	return residual_W, residual_F
+
+def compute_likelihood(A, X, N, K, R, thetas, M, W, lamb_F, lamb_W, alpha, attribute_type,
+	likelihood="dense", num_negative_samples=None, state=None,
+	attribute_likelihood="dense", num_attribute_samples=None,
+	membership_tolerance=None, num_angular_bands=8, membership_top_k=None):
 	
 	'''
 	compute overall likelood of observing A and X, weighted by alpha
 	also includes l1 penalty on F and W
+	if state is given, F, P and Q are taken from the ForwardState instead
 	'''
 
-	_, h = hyperbolic_distance(R, thetas, M)
-	F = compute_F(h, M)
-	P = compute_P(F)
+	if state is None:
+		state = ForwardState(N, A, X, R, thetas, M, W, attribute_type,
+			likelihood, num_negative_samples, attribute_likelihood=attribute_likelihood,
+			num_attribute_samples=num_attribute_samples, membership_tolerance=membership_tolerance,
+			num_angular_bands=num_angular_bands, membership_top_k=membership_top_k)
 
 	# likelihood of G
-	L_G = compute_L_G(A, P)
+	L_G = state.compute_L_G()
+
+	# F with columns of ones as C+1th column of W is the bias term
+	F = state.get_F()
 
 	# l1 penalty term for matrix F
-	l1_F = lamb_F * np.linalg.norm(F, axis=0, ord=1).sum()
+	if sp.sparse.issparse(F):
+		l1_F = lamb_F * abs(F[:,:-1]).sum()
+	else:
+		l1_F = lamb_F * np.linalg.norm(F[:,:-1], axis=0, ord=1).sum()
 
-	# append columns of ones as C+1th column of W is the bias term
-	F = np.column_stack([F, np.ones(N)])
-	Q = compute_Q(F, W, attribute_type)
-	
 	# likelihood of X
-	L_X = compute_L_X(X, Q, attribute_type)
+	L_X = state.compute_L_X()
 	
 	# l1 penalty on W
-	l1_W = lamb_W * np.linalg.norm(W, axis=0, ord=1).sum()
+	l1_W = lamb_W * np.linalg.norm(state.W, axis=0, ord=1).sum()
 	
 	# overall likelihood
 	likelihood = (1 - alpha) * L_G + alpha * L_X + l1_F + l1_W
 	
 	return L_G, L_X, l1_F, l1_W, likelihood
 
-def hyperbolic_distance(R, thetas, M):
+def hyperbolic_distance(R, thetas, M, out=None):
 	'''
 	computes hyperbolic distance between nodes gievn as (R, thetas)
 	and communities given as (M[0], M[1])
+	out is an optional pair of (N, C) arrays that delta_theta and H are written to
 	'''
-	delta_theta = np.pi - abs(np.pi - abs(thetas - M[1]))
-	# relaxation of hyperbolic law of cosines
-	H = R + M[0] + 2 * np.log(delta_theta / 2)
+	if out is None:
+		delta_theta = np.pi - abs(np.pi - abs(thetas - M[1]))
+		# relaxation of hyperbolic law of cosines
+		H = R + M[0] + 2 * np.log(delta_theta / 2)
+		return delta_theta, H
+
+	delta_theta, H = out
+	np.subtract(thetas, M[1], out=delta_theta)
+	np.abs(delta_theta, out=delta_theta)
+	np.subtract(np.pi, delta_theta, out=delta_theta)
+	np.abs(delta_theta, out=delta_theta)
+	np.subtract(np.pi, delta_theta, out=delta_theta)
+	np.divide(delta_theta, 2, out=H)
+	np.log(H, out=H)
+	H *= 2
+	H += R
+	H += M[0]
 	return delta_theta, H
 
-def compute_F(H, M):
+def compute_F(H, M, out=None):
 	'''
 	compute F matrix from hyperbolic distances h and M
+	(written to out, if given)
+	'''
+	if out is None:
+		F = np.exp(- np.square(H) / (2 * np.square(M[2])))
+		# F = 1 / np.sqrt(2 * np.pi * M[:, 2] ** 2) * F
+		return F
+	np.square(H, out=out)
+	out /= - 2 * np.square(M[2])
+	return np.exp(out, out=out)
+
+class AngularIndex(object):
+	'''
+	nodes split into radial bands of about equal size, each sorted by angle into a circular array,
+	so that the nodes of a band within an angular window are found by binary search
+	'''
+
+	def __init__(self, R, thetas, num_bands=8):
+		R = np.asarray(R).ravel()
+		thetas = np.asarray(thetas).ravel() % (2 * np.pi)
+		self.bands = []
+		for nodes in np.array_split(np.argsort(R, kind="mergesort"), min(num_bands, len(R))):
+			nodes = nodes[np.argsort(thetas[nodes], kind="mergesort")]
+			self.bands.append((nodes, thetas[nodes]))
+		# smallest radial co-ordinate of every band
+		self.band_radii = np.array([R[nodes].min() for nodes, _ in self.bands])
+
+	def query(self, angles, half_widths):
+		'''
+		all pairs (node, i) with the node within half_widths[b, i] of angles[i],
+		where b is the band of the node (half_widths has a row for every band)
+		'''
+		nodes = []
+		queries = []
+		for (band_nodes, band_thetas), widths in zip(self.bands, half_widths):
+			n = len(band_nodes)
+			lower = (angles - widths) % (2 * np.pi)
+			upper = (angles + widths) % (2 * np.pi)
+			starts = np.searchsorted(band_thetas, lower)
+			stops = np.searchsorted(band_thetas, upper, side="right")
+			# windows that wrap around 2pi continue from the start of the array
+			stops = np.where(lower > upper, stops + n, stops)
+			starts = np.where(widths >= np.pi, 0, starts)
+			stops = np.where(widths >= np.pi, n, stops)
+
+			lengths = stops - starts
+			offsets = np.cumsum(lengths) - lengths
+			idx = (np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())) % n
+			nodes.append(band_nodes[idx])
+			queries.append(np.repeat(np.arange(len(angles)), lengths))
+		return np.concatenate(nodes), np.concatenate(queries)
+
+def membership_cutoff(M, tolerance):
+	'''
+	largest |h_uc| with F_uc = exp(-h_uc ** 2 / (2 sd_c ** 2)) >= tolerance for every community
 	'''
-	F = np.exp(- np.square(H) / (2 * np.square(M[2])))
-	# F = 1 / np.sqrt(2 * np.pi * M[:, 2] ** 2) * F
-	return F
+	sd = np.asarray(M[2]).ravel()
+	if tolerance <= 0:
+		return np.full(sd.shape, np.inf)
+	return abs(sd) * np.sqrt(-2 * np.log(tolerance))
+
+def hyperbolic_distance_support(R, thetas, M, tolerance, num_bands=8):
+	'''
+	hyperbolic_distance for the node community pairs with membership F_uc >= tolerance only,
+	so every membership that is left out is below tolerance
+
+	h_uc <= cutoff_c if and only if delta_theta_uc <= 2 exp((cutoff_c - R_u - r_c) / 2),
+	so querying an AngularIndex with the window for the smallest R of every band gives
+	a superset of the support in O((N + C) log N) plus its size, which is then filtered exactly
+
+	returns the support (nodes, communities) in row major order and delta_theta and H on it
+	'''
+	cutoff = membership_cutoff(M, tolerance)
+	r = np.asarray(M[0]).ravel()
+
+	index = AngularIndex(R, thetas, num_bands)
+	with np.errstate(over="ignore"):
+		half_widths = np.minimum(2 * np.exp((cutoff - index.band_radii[:, None] - r) / 2), np.pi)
+	nodes, communities = index.query(np.asarray(M[1]).ravel(), half_widths)
+
+	delta_theta, H = hyperbolic_distance_pairs(R, thetas, M, (nodes, communities))
+
+	keep = np.flatnonzero(abs(H) <= cutoff[communities])
+	keep = keep[np.lexsort((communities[keep], nodes[keep]))]
+	return (nodes[keep], communities[keep]), delta_theta[keep], H[keep]
+
+def hyperbolic_distance_pairs(R, thetas, M, support):
+	'''
+	hyperbolic_distance for the node community pairs (nodes, communities) of support only
+	'''
+	nodes, communities = support
+	delta_theta = np.pi - abs(np.pi - abs(np.asarray(thetas).ravel()[nodes] - np.asarray(M[1]).ravel()[communities]))
+	H = np.asarray(R).ravel()[nodes] + np.asarray(M[0]).ravel()[communities] + 2 * np.log(delta_theta / 2)
+	return delta_theta, H
+
+def membership_support(R, thetas, M, tolerance=None, top_k=None, num_bands=8, block_size=None):
+	'''
+	support (nodes, communities) of a sparse F in row major order: the memberships that are
+	at least tolerance (see hyperbolic_distance_support), the top_k largest memberships of every node
+	or, if both are given, the top_k largest of those that are at least tolerance
+
+	without a tolerance the top_k are chosen block_size (default is N / C) nodes at a time,
+	so nothing larger than N is held in memory
+	'''
+	if tolerance is not None:
+		(nodes, communities), _, H = hyperbolic_distance_support(R, thetas, M, tolerance, num_bands)
+		if top_k is None:
+			return nodes, communities
+		order = np.lexsort((-compute_F_support(H, M, communities), nodes))
+		# position of every membership in decreasing order within its node
+		rank = np.arange(len(order)) - np.searchsorted(nodes[order], nodes[order])
+		keep = np.sort(order[rank < top_k])
+		return nodes[keep], communities[keep]
+
+	N, C = thetas.shape[0], M.shape[1]
+	top_k = min(top_k, C)
+	if block_size is None:
+		block_size = max(1, N // C)
+
+	communities = []
+	for start in range(0, N, block_size):
+		stop = min(start + block_size, N)
+		_, H = hyperbolic_distance(R[start:stop], thetas[start:stop], M)
+		F = np.asarray(compute_F(H, M))
+		communities.append(np.sort(np.argpartition(-F, top_k - 1, axis=1)[:, :top_k], axis=1))
+	return np.repeat(np.arange(N), top_k), np.concatenate(communities).ravel()
+
+def compute_F_support(H, M, communities):
+	'''
+	compute F on its support from the hyperbolic distances H of hyperbolic_distance_support
+	'''
+	sd = np.asarray(M[2]).ravel()[communities]
+	return np.exp(- np.square(H) / (2 * np.square(sd)))
+
+def membership_matrix(N, C, support, F):
+	'''
+	sparse (csr) community membership matrix from its values F on the support,
+	with column of ones appended
+	'''
+	nodes, communities = support
+	return sp.sparse.csr_matrix((np.append(F, np.ones(N, dtype=F.dtype)),
+		(np.append(nodes, np.arange(N)), np.append(communities, np.full(N, C, dtype=communities.dtype)))),
+		shape=(N, C + 1))
+
+def compute_support_products(X, Y, support, chunk_size=None):
+	'''
+	entries of X.dot(Y) on the support (nodes, communities) of F only, as row products of X and Y.T
+	chunk_size (default is 2 ** 20 / K) entries at a time, so that (N, C) is never formed
+	'''
+	nodes, communities = support
+	if chunk_size is None:
+		chunk_size = max(1, (1 << 20) // Y.shape[0])
+	Y = Y.T
+	products = np.zeros(len(nodes))
+	for start in range(0, len(nodes), chunk_size):
+		stop = min(start + chunk_size, len(nodes))
+		products[start:stop] = compute_row_products(X, Y, nodes[start:stop], communities[start:stop])
+	return products
+
+def gather(X, support):
+	'''
+	entries of a dense or sparse (N, C) matrix on the support (nodes, communities) of F
+	'''
+	nodes, communities = support
+	if sp.sparse.issparse(X):
+		X = X.tocsr()
+	return np.asarray(X[nodes, communities]).ravel()
 
 def compute_P(F):
 	'''
@@ -122,107 +638,646 @@ def compute_Q(F, W, attribute_type):
 	Q = sigmoid(Q)
 	return np.clip(Q, a_min=clip_value, a_max=1-clip_value)
 
-def precompute_partial_L_G_partial_P(N, A, P, F):
+def compute_L_G_and_partial_L_G_partial_F(N, A, F, block_size=None, workspace=None):
+	'''
+	likelihood of observing A over all node pairs (as compute_L_G) and its closed form derivative
+	with respect to every element of F in a single pass over P (F has the column of ones appended)
 
-		partial_L_G_partial_P = - 1.0 / N * \
-		(A / P - 1 / (1 - P) + A / (1 - P)).reshape(1, -1)
-		# indicies for quick computation of parital_P_partial_F_c
-		U = np.repeat(np.arange(N), N)
-		V = np.tile(np.arange(N), N)
-		row_idx = np.append(V, U)
-		col_idx = np.tile(np.arange(N**2), 2)
-		_ , idx = np.unique(np.column_stack([row_idx, col_idx]), axis=0, return_index=True)
-		row_idx = row_idx[idx]
-		col_idx = col_idx[idx]
-		F_idx = np.append(U, V)[idx] 
-		exp = np.tile(np.exp(-F.dot(F.T)).reshape(1, -1), 2)[:,idx]
+	the derivative is two (N, C) matrices:
+	the first differentiates L_G only through the uth row of P (as in update_theta_u),
+	the second through both the rows and columns of P (as in update_community_*)
 
-		return partial_L_G_partial_P, row_idx, col_idx, F_idx, exp
+	dL_G/dF_uc = sum_v dL_G/dP_uv * exp(-F_u F_v) * F_vc
 
-def gradient_wrapper(pool, updater, l, N, K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type,
-	precompute_partial_L_G_partial_P_flag=False):
+	rows of P are computed block_size (default is C) at a time in arrays of workspace,
+	which also holds the derivatives, so nothing is allocated after the first call
 	'''
-	computes prelimary matrices for use in parallel computation
+	F = np.asarray(F[:,:-1])
+	if block_size is None:
+		block_size = F.shape[1]
+
+	partial_L_G_partial_F_rows = get_buffer(workspace, "partial_L_G_partial_F_rows", F.shape, F.dtype)
+	partial_L_G_partial_F_columns, log_likelihood = compute_partial_L_G_partial_F_rows(N, A, F, 0, N,
+		block_size, partial_L_G_partial_F_rows, workspace)
+	partial_L_G_partial_F_columns += partial_L_G_partial_F_rows
+
+	return - log_likelihood / N ** 2, (partial_L_G_partial_F_rows, partial_L_G_partial_F_columns)
+
+def compute_partial_L_G_partial_F_rows(N, A, F, start, stop, block_size, partial_L_G_partial_F_rows,
+	workspace=None):
 	'''
+	contribution of rows start to stop of P to L_G and dL_G/dF (F without the column of ones)
+	writes the derivative through the rows of P to partial_L_G_partial_F_rows[start:stop]
+	and returns the (N, C) derivative through the columns of P and the summed log likelihood
+	of rows start to stop of A
 
-	# change in angle and hyperbolic distance between all nodes and community centres
-	delta_theta, H = hyperbolic_distance(R, thetas, M)
-	# community membership matrix
-	F = compute_F(H, M)
-	# node connection probablility matrix
-	P = compute_P(F)
+	every block of rows is evaluated in place by log_likelihood_pairs
+	'''
+	partial_L_G_partial_F_columns = get_buffer(workspace, "partial_L_G_partial_F_columns", F.shape, F.dtype)
+	partial_L_G_partial_F_columns.fill(0)
+	log_likelihood = 0
 
-	# append column of ones to F 
-	F = np.column_stack([F, np.ones(N)])
-	# compute attribute probailty matrix 
-	Q = compute_Q(F, W, attribute_type)
+	FF_buffer = get_buffer(workspace, "FF", (block_size, N), F.dtype)
+	P_buffer = get_buffer(workspace, "P", (block_size, N), F.dtype)
+	targets_buffer = get_buffer(workspace, "targets", (block_size, N), F.dtype)
+
+	for block_start in range(start, stop, block_size):
+		block_stop = min(block_start + block_size, stop)
+		num_rows = block_stop - block_start
+
+		FF = np.dot(F[block_start:block_stop], F.T, out=FF_buffer[:num_rows])
+		A_block = A[block_start:block_stop].tocoo()
+		targets = targets_buffer[:num_rows]
+		targets.fill(0)
+		targets[A_block.row, A_block.col] = A_block.data
+
+		block_log_likelihood, B = log_likelihood_pairs(FF, targets, P_buffer[:num_rows])
+		log_likelihood += block_log_likelihood
 
-	if precompute_partial_L_G_partial_P_flag:
-		partial_L_G_partial_P, row_idx, col_idx, F_idx, exp = precompute_partial_L_G_partial_P(N, A, P, F)
+		# dL_G/dP_uv * dP_uv/d(F_u F_v)
+		B *= - 1.0 / N
+
+		np.dot(B, F, out=partial_L_G_partial_F_rows[block_start:block_stop])
+		partial_L_G_partial_F_columns += B.T.dot(F[block_start:block_stop])
+		# diagonal of P only appears once in dP/dF_c
+		partial_L_G_partial_F_columns[block_start:block_stop] -= np.multiply(
+			B[:, block_start:block_stop].diagonal().reshape(-1, 1), F[block_start:block_stop])
+
+	return partial_L_G_partial_F_columns, log_likelihood
+
+def compute_partial_L_G_partial_F_sparse(N, A, F, num_negative_samples=None):
+	'''
+	derivative of L_G with respect to every element of F from the non zeros of A only
+	(F has the column of ones appended), returned as in compute_L_G_and_partial_L_G_partial_F
+
+	on non-edges dL_G/dP_uv * exp(-F_u F_v) = 1 / N (ignoring the clipping of P),
+	so their contribution is either computed in closed form from sum_v F_v
+	or estimated from num_negative_samples sampled non-edges per node
+	'''
+	F = F[:,:-1]
+
+	B = compute_B_sparse(N, A, F, num_negative_samples)
+
+	if num_negative_samples is None:
+		# 1 / N on all pairs
+		F_sum = F.sum(axis=0) / N
+		partial_L_G_partial_F_rows = B.dot(F) + F_sum
+		# diagonal of P only appears once in dP/dF_c
+		partial_L_G_partial_F_columns = B.T.dot(F) + F_sum - F / N
 	else:
-		partial_L_G_partial_P, row_idx, col_idx, F_idx, exp = None, None, None, None, None
+		partial_L_G_partial_F_rows = B.dot(F)
+		partial_L_G_partial_F_columns = B.T.dot(F)
+
+	partial_L_G_partial_F_columns -= np.multiply(B.diagonal()[:, None], F)
 
+	return partial_L_G_partial_F_rows, partial_L_G_partial_F_rows + partial_L_G_partial_F_columns
+
+def compute_B_sparse(N, A, F, num_negative_samples=None):
+	'''
+	dL_G/dP_uv * dP_uv/d(F_u F_v) on the edges of A (F without the column of ones),
+	plus the sampled non-edges or, if the non-edge term is in closed form,
+	minus the 1 / N that the closed form adds on the edges
+	'''
+	A = A.tocoo()
+	_, derivative = log_likelihood_pairs(compute_FF_pairs(F, A.row, A.col), A.data)
 
-	if pool != None:
-		# parallel
-		return np.concatenate(pool.map(partial(updater, 
-					N=N, A=A, X=X, thetas=thetas, M=M, W=W, delta_theta=delta_theta, H=H, F=F, P=P, Q=Q,
-					alpha=alpha, lamb_F=lamb_F, lamb_W = lamb_W, attribute_type=attribute_type,
-					partial_L_G_partial_P=partial_L_G_partial_P, row_idx=row_idx, col_idx=col_idx, F_idx=F_idx, exp=exp), 
-					l), axis=0)
+	# dL_G/dP_uv * dP_uv/d(F_u F_v) on the edges
+	B = sp.sparse.csr_matrix((- 1.0 / N * derivative, (A.row, A.col)), shape=(N, N))
+
+	if num_negative_samples is None:
+		return B - 1.0 / N * (A != 0)
+
+	A = A.tocsr()
+	non_edges = sample_non_edges(N, A, num_negative_samples)
+	return B + compute_B_pairs(N, A, F, non_edges)
+
+def compute_B_pairs(N, A, F, pairs):
+	'''
+	dL_G/dP_uv * dP_uv/d(F_u F_v) for a weighted sample of node pairs
+	(sparse (N, N) matrix of weights, F without the column of ones)
+	'''
+	pairs = pairs.tocoo()
+	targets = np.asarray(A[pairs.row, pairs.col]).ravel()
+	_, derivative = log_likelihood_pairs(compute_FF_pairs(F, pairs.row, pairs.col), targets)
+	return sp.sparse.csr_matrix((pairs.data * - 1.0 / N * derivative,
+		(pairs.row, pairs.col)), shape=(N, N))
+
+def compute_partial_L_G_partial_F_pairs(N, A, F, pairs):
+	'''
+	estimate of dL_G/dF from a weighted sample of node pairs (see sample_pairs)
+	(F has the column of ones appended), returned as in compute_L_G_and_partial_L_G_partial_F
+	'''
+	F = F[:,:-1]
+	B = compute_B_pairs(N, A, F, pairs)
+	partial_L_G_partial_F_rows = B.dot(F)
+	# diagonal of P only appears once in dP/dF_c
+	partial_L_G_partial_F_columns = B.T.dot(F) - np.multiply(B.diagonal()[:, None], F)
+	return partial_L_G_partial_F_rows, partial_L_G_partial_F_rows + partial_L_G_partial_F_columns
+
+def compute_partial_L_G_partial_F_support(N, A, F, support, F_support, likelihood="dense",
+	num_negative_samples=None, pairs=None):
+	'''
+	dL_G/dF on the support of a sparse F only (F has the column of ones appended, F_support
+	holds its values on the support), returned as in compute_L_G_and_partial_L_G_partial_F
+	but as vectors over the support
+
+	for the dense likelihood P is evaluated on the candidate pairs only, as a pair that shares
+	no community contributes nothing to dL_G/dF_uc for any c in the support of u
+	'''
+	nodes, communities = support
+	F = F[:,:-1]
+
+	if pairs is not None:
+		B = compute_B_pairs(N, A, F, pairs)
+	elif likelihood == "sparse":
+		B = compute_B_sparse(N, A, F, num_negative_samples)
 	else:
-		# non parallel
-		return np.concatenate([updater(x, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
-				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp) for x in l], axis=0)
+		B = compute_B_pairs(N, A, F, candidate_pairs(F))
+
+	partial_L_G_partial_F_rows = gather(B.dot(F), support)
+	# diagonal of P only appears once in dP/dF_c
+	partial_L_G_partial_F_columns = gather(B.T.dot(F), support) - B.diagonal()[nodes] * F_support
+
+	if pairs is None and likelihood == "sparse" and num_negative_samples is None:
+		# 1 / N on all pairs
+		F_sum = np.asarray(F.sum(axis=0)).ravel()[communities] / N
+		partial_L_G_partial_F_rows += F_sum
+		partial_L_G_partial_F_columns += F_sum - F_support / N
+
+	return partial_L_G_partial_F_rows, partial_L_G_partial_F_rows + partial_L_G_partial_F_columns
 
+# ctypes of the numpy dtypes that can be placed in shared memory
+shared_ctypes = {
+	np.dtype(np.float64) : ctypes.c_double,
+	np.dtype(np.float32) : ctypes.c_float,
+	np.dtype(np.int64) : ctypes.c_int64,
+	np.dtype(np.int32) : ctypes.c_int32,
+}
 
+# views of the shared memory of a SharedMemoryPool, set in each worker by initialize_worker
+worker_arrays = {}
 
-def compute_partial_P_partial_F_c(c, N, F, row_idx, col_idx, F_idx, exp):
+def create_shared_array(shape, dtype):
+	'''
+	allocate an array in shared memory, which worker processes forked afterwards can see
+	returns the raw shared memory and a numpy view of it
+	'''
+	dtype = np.dtype(dtype)
+	shared_array = sharedctypes.RawArray(shared_ctypes[dtype], int(np.prod(shape)))
+	return shared_array, np.frombuffer(shared_array, dtype=dtype).reshape(shape)
 
+def initialize_worker(N, block_size, shared_arrays):
+	'''
+	attach a worker process to the shared memory of a SharedMemoryPool
 	'''
-	helper function to compute 3-dimensional tensor representing dP/d_F_c
-	(here represented as 2d sparse matrix of size (N**2, N))
+	worker_arrays["N"] = N
+	worker_arrays["block_size"] = block_size
+	for name, (shared_array, dtype, shape) in shared_arrays.items():
+		worker_arrays[name] = np.frombuffer(shared_array, dtype=dtype).reshape(shape)
+	worker_arrays["A"] = sp.sparse.csr_matrix((worker_arrays["A_data"], worker_arrays["A_indices"],
+		worker_arrays["A_indptr"]), shape=(N, N), copy=False)
+	# blocks of P, reused by every task of the worker
+	worker_arrays["workspace"] = Workspace(worker_arrays["F"].dtype)
+
+def L_G_and_partial_L_G_partial_F_worker((start, stop)):
+	'''
+	dL_G/dF and log likelihood from rows start to stop of P, computed from the shared memory
+	'''
+	return compute_partial_L_G_partial_F_rows(worker_arrays["N"], worker_arrays["A"], 
+		worker_arrays["F"], start, stop, worker_arrays["block_size"], 
+		worker_arrays["partial_L_G_partial_F_rows"], worker_arrays["workspace"])
 
-	
-					 exp(-F_u F_v) * F_uc if u' == v	
-	dp_uv/df_u'c = { exp(-F_u F_v) * F_vc if u' == u
-					 0 otherwise
+class SharedMemoryPool(object):
+	'''
+	persistent pool of worker processes that compute L_G and dL_G/dF over ranges of rows of P
+
+	A, F and the output are placed in shared memory before the workers are forked,
+	so tasks only carry the range of rows
+	'''
+
+	def __init__(self, num_processes, N, A, C, block_size=None, dtype=np.float64):
+		self.N = N
+		if block_size is None:
+			block_size = C
+
+		A = A.tocsr()
+		shared_arrays = {}
+		self.arrays = {}
+		for name, array in (("A_data", A.data.astype(dtype)), ("A_indices", A.indices), 
+			("A_indptr", A.indptr)):
+			shared_array, self.arrays[name] = create_shared_array(array.shape, array.dtype)
+			self.arrays[name][:] = array
+			shared_arrays[name] = (shared_array, array.dtype, array.shape)
+		for name in ("F", "partial_L_G_partial_F_rows"):
+			shared_array, self.arrays[name] = create_shared_array((N, C), dtype)
+			shared_arrays[name] = (shared_array, dtype, (N, C))
+
+		# one contiguous range of rows per process
+		self.ranges = [(l[0], l[-1] + 1) for l in np.array_split(np.arange(N), num_processes) 
+			if len(l) > 0]
+
+		self.pool = Pool(num_processes, initializer=initialize_worker, 
+			initargs=(N, block_size, shared_arrays))
+
+	def compute_L_G_and_partial_L_G_partial_F(self, F):
+		'''
+		L_G and dL_G/dF as returned by compute_L_G_and_partial_L_G_partial_F, computed in parallel
+		(F has the column of ones appended)
+		'''
+		self.arrays["F"][:] = F[:,:-1]
+		results = self.pool.map(L_G_and_partial_L_G_partial_F_worker, self.ranges)
+		partial_L_G_partial_F_columns = sum(columns for columns, _ in results)
+		partial_L_G_partial_F_rows = self.arrays["partial_L_G_partial_F_rows"].copy()
+		return - sum(log_likelihood for _, log_likelihood in results) / self.N ** 2,\
+			(partial_L_G_partial_F_rows, partial_L_G_partial_F_rows + partial_L_G_partial_F_columns)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+def as_parameter(name, value, shape, dtype):
+	'''
+	copy of value as a C contiguous ndarray of dtype, checked against shape
+	(None matches any length), a vector is taken as a column of shape (N, 1)
+	'''
+	value = np.array(value, dtype=dtype, order="C")
+	if value.ndim == 1 and len(shape) == 2 and shape[1] == 1:
+		value = value.reshape(-1, 1)
+	if value.ndim != len(shape) or any(expected is not None and expected != length
+		for expected, length in zip(shape, value.shape)):
+		raise ValueError("{} has shape {}, expected {}".format(name, value.shape, shape))
+	return value
+
+class ModelState(object):
+	'''
+	parameters of the model as C contiguous ndarrays of a single dtype:
+	radial and angular co-ordinates of the nodes R and thetas (N, 1),
+	community radii, angles and standard deviations M (3, C) and attribute weights W (K, C + 1)
+
+	every group of parameters ("thetas", "r", "community_thetas", "sd" or "W") is read with get
+	and written in place with set, so the arrays keep their layout and are never reallocated
+	'''
+
+	def __init__(self, R, thetas, M, W, dtype=np.float64):
+		self.dtype = np.dtype(dtype)
+		self.R = as_parameter("R", R, (None, 1), self.dtype)
+		N = self.R.shape[0]
+		self.thetas = as_parameter("thetas", thetas, (N, 1), self.dtype)
+		self.M = as_parameter("M", M, (3, None), self.dtype)
+		self.W = as_parameter("W", W, (None, self.M.shape[1] + 1), self.dtype)
+
+	def get(self, parameter):
+		if parameter == "thetas":
+			return self.thetas
+		elif parameter == "W":
+			return self.W
+		elif parameter in community_parameters:
+			return self.M[community_parameters.index(parameter)]
+		raise ValueError("unknown parameter {}".format(parameter))
+
+	def set(self, parameter, value):
+		'''
+		overwrite a group of parameters with value, which may differ from it only in dtype
+		and in dimensions of length one
+		'''
+		target = self.get(parameter)
+		value = np.asarray(value)
+		if value.size != target.size:
+			raise ValueError("{} has shape {}, expected {}".format(parameter, value.shape, target.shape))
+		np.copyto(target, value.reshape(target.shape))
+
+class ForwardState(object):
+	'''
+	cache of the forward pass (delta_theta, H, F, P, Q and dL_G/dF) shared by the gradients
+	of every group of parameters and the likelihood
 
+	with a membership_tolerance or membership_top_k, F is a sparse matrix and delta_theta, H,
+	dL_G/dF and (X - Q).dot(W[:,:-1]) are vectors over its support (see membership_support),
+	which is kept until refresh_support is called
+
+	every entry is keyed on the versions of the parameters it depends on,
+	so it is only recomputed after one of those parameters has been updated
+
+	for a dense F, delta_theta, H, F, blocks of P, X - Q and dL_G/dF are computed in place
+	in the arrays of a Workspace of the given dtype, so an entry is only valid until it is
+	next recomputed
+
+	the parameters are held in a ModelState of the same dtype, which train updates in place
 	'''
 
+	# groups of parameters that each entry depends on
+	dependencies = {
+		"H" : ("thetas", "r", "community_thetas", "support"),
+		"F" : ("thetas", "r", "community_thetas", "sd", "support"),
+		"F_support" : ("thetas", "r", "community_thetas", "sd", "support"),
+		"P" : ("thetas", "r", "community_thetas", "sd", "support"),
+		"partial_L_G_partial_F" : ("thetas", "r", "community_thetas", "sd", "batch", "support"),
+		"L_G" : ("thetas", "r", "community_thetas", "sd", "support"),
+		"attribute_residual" : ("thetas", "r", "community_thetas", "sd", "W", "support"),
+		"Q" : ("thetas", "r", "community_thetas", "sd", "W", "support"),
+		"residual_products" : ("thetas", "r", "community_thetas", "sd", "W", "batch", "support"),
+	}
+
+	def __init__(self, N, A, X, R, thetas, M, W, attribute_type,
+		likelihood="dense", num_negative_samples=None, pool=None,
+		attribute_likelihood="dense", num_attribute_samples=None,
+		membership_tolerance=None, num_angular_bands=8, membership_top_k=None, dtype=np.float64):
+		self.N = N
+		self.K = X.shape[1]
+		self.C = M.shape[1]
+		self.A = A
+		self.X = X
+		self.model = ModelState(R, thetas, M, W, dtype)
+		# the arrays of the model are updated in place, so these always hold the current parameters
+		self.R = self.model.R
+		self.thetas = self.model.thetas
+		self.M = self.model.M
+		self.W = self.model.W
+		self.attribute_type = attribute_type
+		self.likelihood = likelihood
+		self.num_negative_samples = num_negative_samples
+		self.attribute_likelihood = attribute_likelihood
+		self.num_attribute_samples = num_attribute_samples
+		# evaluate F on its support only, if either is not None
+		self.membership_tolerance = membership_tolerance
+		self.membership_top_k = membership_top_k
+		self.num_angular_bands = num_angular_bands
+		self.sparse_membership = membership_tolerance is not None or membership_top_k is not None
+		self.support = None
+		# SharedMemoryPool for the dense likelihood
+		self.pool = pool
+		# minibatch of node pairs and attribute rows, all of them if None
+		self.pairs = None
+		self.rows = None
+		self.versions = {parameter : 0 for parameter in ("thetas", "r", "community_thetas", "sd", "W", "batch", "support")}
+		self.cache = {}
+		# arrays of the forward and backward pass, reused by every update
+		self.workspace = Workspace(dtype)
+
+	def update(self, parameter, value=None):
+		'''
+		record an update to a group of parameters ("thetas", "r", "community_thetas", "sd" or "W")
+		if value is given, it is first written to the model
+		'''
+		if value is not None:
+			self.model.set(parameter, value)
+		self.versions[parameter] += 1
+		# release stale entries
+		for name, dependencies in self.dependencies.items():
+			if parameter in dependencies:
+				self.cache.pop(name, None)
+
+	def set_batch(self, pairs=None, rows=None):
+		'''
+		restrict dL_G/dF and the attribute residual to a minibatch (see sample_batch)
+		or, if None, use all node pairs and attribute rows
+		'''
+		self.pairs = pairs
+		self.rows = rows
+		self.update("batch")
+
+	def refresh_support(self):
+		'''
+		choose the support of a sparse F again from the current parameters when it is next needed
+		'''
+		self.support = None
+		self.update("support")
+
+	def set_support(self, support):
+		'''
+		evaluate a sparse F on support (nodes, communities), such as one saved in a checkpoint,
+		until the next refresh_support
+		'''
+		self.support = tuple(np.asarray(x) for x in support)
+		self.update("support")
+
+	def get(self, name, compute):
+		key = tuple(self.versions[parameter] for parameter in self.dependencies[name])
+		if name not in self.cache or self.cache[name][0] != key:
+			self.cache[name] = (key, compute())
+		return self.cache[name][1]
+
+	def set(self, name, value):
+		self.cache[name] = (tuple(self.versions[parameter] for parameter in self.dependencies[name]), value)
+
+	def get_distances(self):
+		def compute():
+			if not self.sparse_membership:
+				return (None, ) + hyperbolic_distance(self.R, self.thetas, self.M,
+					out=(self.workspace.get("delta_theta", (self.N, self.C)), self.workspace.get("H", (self.N, self.C))))
+			if self.support is None:
+				self.support = membership_support(self.R, self.thetas, self.M,
+					self.membership_tolerance, self.membership_top_k, self.num_angular_bands)
+			return (self.support, ) + hyperbolic_distance_pairs(self.R, self.thetas, self.M, self.support)
+		return self.get("H", compute)
+
+	def get_H(self):
+		'''
+		change in angle and hyperbolic distance between all nodes and community centres
+		'''
+		return self.get_distances()[1:]
+
+	def get_support(self):
+		'''
+		(nodes, communities) of the memberships that are evaluated (sparse F only)
+		'''
+		return self.get_distances()[0]
+
+	def get_F_support(self):
+		'''
+		community memberships on the support (sparse F only)
+		'''
+		def compute():
+			_, H = self.get_H()
+			return compute_F_support(H, self.M, self.get_support()[1])
+		return self.get("F_support", compute)
+
+	def get_F(self):
+		'''
+		community membership matrix with column of ones appended
+		'''
+		def compute():
+			if self.sparse_membership:
+				return membership_matrix(self.N, self.C, self.get_support(), self.get_F_support())
+			_, H = self.get_H()
+			F = self.workspace.get("F", (self.N, self.C + 1))
+			F[:,-1] = 1
+			compute_F(H, self.M, out=F[:,:-1])
+			return F
+		return self.get("F", compute)
+
+	def get_P(self):
+		'''
+		node connection probablility matrix (dense likelihood only)
+		'''
+		return self.get("P", lambda: compute_P(self.get_F()[:,:-1]))
+
+	def get_Q(self):
+		'''
+		attribute probailty matrix
+		'''
+		return self.get("Q", lambda: compute_Q(self.get_F(), self.W, self.attribute_type))
+
+	def get_partial_L_G_partial_F(self):
+		'''
+		dL_G/dF as returned by compute_L_G_and_partial_L_G_partial_F
+		'''
+		def compute():
+			if self.sparse_membership:
+				return compute_partial_L_G_partial_F_support(self.N, self.A, self.get_F(),
+					self.get_support(), self.get_F_support(), self.likelihood,
+					self.num_negative_samples, self.pairs)
+			if self.pairs is not None:
+				return compute_partial_L_G_partial_F_pairs(self.N, self.A, self.get_F(), self.pairs)
+			if self.likelihood == "sparse":
+				return compute_partial_L_G_partial_F_sparse(self.N, self.A, self.get_F(),
+					self.num_negative_samples)
+			return self.compute_fused_L_G()[1]
+		return self.get("partial_L_G_partial_F", compute)
+
+	def compute_fused_L_G(self):
+		'''
+		L_G and dL_G/dF of the dense likelihood from a single pass over P,
+		both are cached so that whichever is needed next is not computed again
+		'''
+		if self.pool is not None:
+			L_G, partial_L_G_partial_F = self.pool.compute_L_G_and_partial_L_G_partial_F(self.get_F())
+		else:
+			L_G, partial_L_G_partial_F = compute_L_G_and_partial_L_G_partial_F(self.N, self.A,
+				self.get_F(), workspace=self.workspace)
+		self.set("L_G", L_G)
+		if self.pairs is None:
+			self.set("partial_L_G_partial_F", partial_L_G_partial_F)
+		return L_G, partial_L_G_partial_F
+
+	def get_attribute_residual(self):
+		'''
+		L_X and X - Q of the dense attribute likelihood (see compute_L_X_and_residual)
+		'''
+		return self.get("attribute_residual", lambda: compute_L_X_and_residual(self.X, self.get_F(),
+			self.W, self.attribute_type, self.workspace))
+
+	def get_residual_products(self):
+		'''
+		(X - Q).dot(W[:,:-1]) and (X - Q).T.dot(F), or for a minibatch, the same for the
+		sampled rows only, scaled so that sums over them estimate sums over all rows
+		(for a sparse F, (X - Q).dot(W[:,:-1]) on its support only)
+		'''
+		def compute():
+			support = self.get_support()
+			if self.rows is None:
+				X, F = self.X, self.get_F()
+			else:
+				X, F = self.X[self.rows], self.get_F()[self.rows]
+				if support is not None:
+					# support of the sampled rows, numbered within the batch
+					in_batch = np.in1d(support[0], self.rows)
+					support = (np.searchsorted(self.rows, support[0][in_batch]), support[1][in_batch])
+			if self.attribute_likelihood == "sparse":
+				residual_W, residual_F = compute_attribute_residual_products(X, F, self.W,
+					self.attribute_type, self.num_attribute_samples, support=support)
+			else:
+				if self.rows is None:
+					_, residual = self.get_attribute_residual()
+				else:
+					_, residual = compute_L_X_and_residual(X, F, self.W, self.attribute_type)
+				if support is None:
+					residual_W = residual.dot(self.W[:,:-1])
+				else:
+					residual_W = compute_support_products(residual, self.W[:,:-1], support)
+				residual_F = transpose_dot(residual, F)
+			if self.rows is None:
+				return residual_W, residual_F
+			scale = float(self.N) / len(self.rows)
+			if support is None:
+				residual_rows_W = np.zeros((self.N, self.C), dtype=residual_W.dtype)
+				residual_rows_W[self.rows] = scale * residual_W
+			else:
+				residual_rows_W = np.zeros(len(in_batch), dtype=residual_W.dtype)
+				residual_rows_W[in_batch] = scale * residual_W
+			return residual_rows_W, scale * residual_F
+		return self.get("residual_products", compute)
+
+	def compute_L_X(self):
+		'''
+		likelihood of X (not cached, as it may be sampled)
+		'''
+		if self.attribute_likelihood == "sparse":
+			return compute_L_X_sparse(self.X, self.get_F(), self.W, self.attribute_type,
+				self.num_attribute_samples)
+		L_X, _ = self.get_attribute_residual()
+		return L_X
+
+	def compute_L_G(self):
+		'''
+		likelihood of G (only cached for the dense likelihood, as the others may be sampled)
+		'''
+		if self.likelihood == "sparse":
+			return compute_L_G_sparse(self.N, self.A, self.get_F()[:,:-1], self.num_negative_samples)
+		if self.sparse_membership:
+			return compute_L_G_candidates(self.N, self.A, self.get_F()[:,:-1])
+		return self.get("L_G", lambda: self.compute_fused_L_G()[0])
+
+def reference_partial_L_G_partial_F(N, A, F):
+	'''
+	derivative of L_G with respect to every element of F (without the column of ones)
+	through both the rows and columns of P, from the dense (N, N) matrices of dL_G/dP and dP/dF_c:
 
-	data = np.multiply(F[F_idx, c].T, exp).A1
+	dL_G/dF_uc = sum_v dL_G/dP_uv * dP_uv/dF_uc + sum_v dL_G/dP_vu * dP_vu/dF_uc
+	with dP_uv/dF_uc = exp(-F_u F_v) * F_vc (the diagonal counted once)
 
-	return sp.sparse.csr_matrix((data, (row_idx, col_idx)), shape = (N, N**2))
+	independent of compute_L_G_and_partial_L_G_partial_F, for checking it on small graphs only
+	'''
+	F = np.asarray(F)
+	A = A.toarray() if sp.sparse.issparse(A) else np.asarray(A)
+	P = compute_P(F)
+	partial_L_G_partial_P = - 1.0 / N * (A / P - (1 - A) / (1 - P))
+	B = partial_L_G_partial_P * np.exp(-F.dot(F.T))
+	return B.dot(F) + B.T.dot(F) - B.diagonal()[:, None] * F
+
+def gradient_wrapper(updater, l, state, alpha, lamb_F, lamb_W, partial_L_G_partial_F=None):
+	'''
+	gradient of one group of parameters by the per element updater (update_theta_u, update_community_*
+	or update_W_k) of every element of l, from the forward pass of state, for check_gradients
+	partial_L_G_partial_F (as returned by reference_partial_L_G_partial_F) is needed by update_community_*
+	'''
+
+	# change in angle and hyperbolic distance between all nodes and community centres
+	delta_theta, H = state.get_H()
+	# community membership matrix with column of ones
+	F = state.get_F()
+	# node connection probablility matrix
+	P = state.get_P()
+	# compute attribute probailty matrix 
+	Q = state.get_Q()
+
+	N, A, X, thetas, M, W = state.N, state.A, state.X, state.thetas, state.M, state.W
+	attribute_type = state.attribute_type
+
+	# the per element updates index rows and columns of dense arrays
+	A = A.toarray() if sp.sparse.issparse(A) else np.asarray(A)
+	X = X.toarray() if sp.sparse.issparse(X) else np.asarray(X)
+
+	return np.array([updater(x, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
+		alpha, lamb_F, lamb_W, attribute_type,
+		partial_L_G_partial_F) for x in l])
 
 def update_theta_u(u, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
 				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp):
+				partial_L_G_partial_F):
 
 	'''
 	compute update for angular coo-ordinate of node u
 
 	'''
 
-	# prelimaries to compute uth row of P matrix	
-	# delta_theta, h = hyperbolic_distance(R, thetas, M)
-	# F = compute_F(h, M)
-	# P_u = compute_P_u(u, F)
-
-	
-	# compute derivative of delta theta with respect to theta
-	partial_delta_theta_u_partial_theta_u = np.multiply(-np.sign(np.pi - abs(thetas[u] - M[1])),
-	 -np.sign(thetas[u] - M[1])).T
-
-	# norm = np.linalg.norm(partial_delta_theta_u_partial_theta_u)
-	# if norm > 1:
-	# 	partial_delta_theta_u_partial_theta_u /= norm
+	# compute derivative of delta theta with respect to theta, shape (C, )
+	partial_delta_theta_u_partial_theta_u = -np.sign(np.pi - abs(thetas[u, 0] - M[1])) *\
+		-np.sign(thetas[u, 0] - M[1])
 
 	'''
 	derivative of uth row of F with repect to delta theta
-	multiply dF_uc/dh_uc with dh_uc/delta_theta_uc and ocnvert to 
-	sparse diagonal matrix 
+	dF_uc/dh_uc * dh_uc/delta_theta_uc, the diagonal of the jacobian as a vector of shape (C, )
 
 	'''
 
@@ -231,317 +1286,367 @@ def update_theta_u(u, N, A, X, thetas, M, W, delta_theta, H, F, P, Q,
 	if norm > grad_clip_value:
 		partial_H_u_partial_delta_theta_u /= norm
 
-	partial_F_u_partial_delta_theta_u = np.multiply(np.multiply(-H[u] / np.square(M[2]), 
-		F[u, :-1]), partial_H_u_partial_delta_theta_u)
-	# norm = np.linalg.norm(partial_F_u_partial_delta_theta_u)
-	# if norm > 1:
-	# 	partial_F_u_partial_delta_theta_u /= norm
-	partial_F_u_partial_delta_theta_u = sp.sparse.spdiags(partial_F_u_partial_delta_theta_u, 0,
-		partial_F_u_partial_delta_theta_u.shape[1], partial_F_u_partial_delta_theta_u.shape[1])
+	partial_F_u_partial_delta_theta_u = -H[u] / np.square(M[2]) * F[u, :-1] * partial_H_u_partial_delta_theta_u
 
 	'''
-	derivative of uth row of P with respect to uth row of F
+	derivative of uth row of P with respect to uth row of F, shape (N, C)
 
 	dP_uv/dF_uc = exp(-F_u F_v) * F_vc
 
 	'''
-	partial_P_u_partial_F_u = np.multiply(np.exp(-F[u, :-1].dot(F[:,:-1].T)).T, F[:,:-1])
-	# norm = np.linalg.norm(partial_P_u_partial_F_u)
-	# if norm > 1:
-	# 	partial_P_u_partial_F_u /= norm
-
+	partial_P_u_partial_F_u = np.exp(-F[:, :-1].dot(F[u, :-1]))[:, None] * F[:, :-1]
 
-	# partial L_G 
+	# partial L_G, shape (N, )
 	A_u = A[u]
 	P_u = P[u]
 	partial_L_G_u_partial_P_u = - 1.0 / N * \
 	(A_u / P_u - 1 / (1 - P_u) + A_u / (1 - P_u))
-	# norm = np.linalg.norm(partial_L_G_u_partial_P_u)
-	# if norm > 1:
-	# 	partial_L_G_u_partial_P_u /= norm
 
 	# dot products to combine partial derivatives
 
-	partial_L_G_u_partial_F_u = partial_L_G_u_partial_P_u\
-	.dot(partial_P_u_partial_F_u)
+	partial_L_G_u_partial_F_u = partial_L_G_u_partial_P_u.dot(partial_P_u_partial_F_u)
 
-	partial_F_u_partial_theta_u = partial_F_u_partial_delta_theta_u\
-	.dot(partial_delta_theta_u_partial_theta_u)
+	partial_F_u_partial_theta_u = partial_F_u_partial_delta_theta_u * partial_delta_theta_u_partial_theta_u
 
-	partial_L_G_u_partial_theta_u = partial_L_G_u_partial_F_u\
-	.dot(partial_F_u_partial_theta_u)
+	partial_L_G_u_partial_theta_u = partial_L_G_u_partial_F_u.dot(partial_F_u_partial_theta_u)
 
 	# derivative of abs(F_u) is sign(F_u)
-	partial_l1_F_u_partial_F_u = np.sign(F[u,:-1])
-	# norm = np.linalg.norm(partial_l1_F_u_partial_F_u)
-	# if norm > 1:
-	# 	partial_l1_F_u_partial_F_u /= norm
-
-	# partial L_X
-	# F = np.append(F[u], np.matrix(1), axis=1)
-	# Q_u = compute_Q_u(F, W, attribute_type)
+	partial_l1_F_u_partial_F_u = np.sign(F[u, :-1])
 
 	'''
 	dL_X / d_F_uc = (X_u - Q_u).dot(W__c)
 	'''
 
 	partial_L_X_u_partial_F_u = - 1.0 / N *\
-	(X[u] - Q[u]).dot(W[:,:-1])
-
-	# norm = np.linalg.norm(partial_L_X_u_partial_F_u)
-	# if norm > 1:
-	# 	partial_L_X_u_partial_F_u /= norm
+	(X[u] - Q[u]).dot(W[:, :-1])
 
 	partial_L_X_u_partial_theta_u = partial_L_X_u_partial_F_u.dot(partial_F_u_partial_theta_u)
 
-
 	grad = ((1 - alpha) * partial_L_G_u_partial_theta_u + alpha * partial_L_X_u_partial_theta_u\
 		+ lamb_F * partial_l1_F_u_partial_F_u.dot(partial_F_u_partial_theta_u))
 
-	# norm = np.linalg.norm(grad)
-	# if norm > grad_clip_value:
-	# 	grad /= norm
-
 	return grad
 
 def update_community_r_c(c, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
 				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp):
+				partial_L_G_partial_F):
 
 	'''
 	compute update for radial coordinate of  c
 	'''
-	# compute F
-	# delta_theta, h = hyperbolic_distance(R, thetas, M)
-	# F = compute_F(h, M)
-	# P = compute_P(F)
 
 	'''
 	dh_uc / d_rc = 1
-	'''
-
-	partial_H_c_partial_r_c = np.matrix(np.ones((N, 1)))
-
-	'''
 	dF_uc / dh_u'c = -h_uc / sd_c ** 2 * F_uc if u' == u 
-
+	so dF_uc / d_rc, shape (N, )
 	'''
-	partial_F_c_partial_H_c = np.multiply(-H[:, c] / np.square(M[2, c]), F[:,c]).T
-
-	partial_F_c_partial_H_c = sp.sparse.spdiags(partial_F_c_partial_H_c, 0,
-		partial_F_c_partial_H_c.shape[1], partial_F_c_partial_H_c.shape[1])
+	partial_F_c_partial_r_c = -H[:, c] / np.square(M[2, c]) * F[:, c]
 
 	'''
 	dL_G / d_P_uv = A_uv / P_uv - (1 - A_uv) / (1 - P_uv)
-	reshape into row matrix (1, N**2) for easy dot product with shape (N**2, N)
+	cth column of dL_G/dF, precomputed densely for all communities by reference_partial_L_G_partial_F
 	'''
-	
-	# partial_L_G_partial_P = - 1.0 / N * \
-	# (A / P - 1 / (1 - P) + A / (1 - P)).reshape(1, -1)
-
-	partial_P_partial_F_c = compute_partial_P_partial_F_c(c, N, F, row_idx, col_idx, F_idx, exp)
-	# print partial_P_partial_F_c_new.todense()
-	# print partial_P_partial_F_c.reshape((N, N**2)).todense()
-	# print np.allclose(partial_P_partial_F_c_new.todense(), partial_P_partial_F_c.reshape((N, N**2)).todense())
-	# partial_L_G_c_partial_F_c = partial_P_partial_F_c.reshape((N, N**2)).multiply(partial_L_G_partial_P).sum(axis=1).T
-	partial_L_G_c_partial_F_c = partial_P_partial_F_c.multiply(partial_L_G_partial_P).sum(axis=1).T
-
-	# print partial_L_G_c_partial_F_c
-	
-	partial_F_c_partial_r_c = partial_F_c_partial_H_c.dot(partial_H_c_partial_r_c)
 
-	# print partial_F_c_partial_r_c
+	partial_L_G_c_partial_F_c = partial_L_G_partial_F[:, c]
 
 	partial_L_G_c_partial_r_c = partial_L_G_c_partial_F_c.dot(partial_F_c_partial_r_c)
 
 	# derivative of abs is sign
-	partial_l1_F_c_partial_F_c = np.sign(F[:,c]).T
-	
-	# partial L_x 
-	# F = np.column_stack([F, np.ones(N)])
-	# Q = compute_Q(F, W, attribute_type)
+	partial_l1_F_c_partial_F_c = np.sign(F[:, c])
 
 	partial_L_X_c_partial_F_c = - 1.0 / N * \
-	(X - Q).dot(W[:,c]).T
-	# print partial_L_X_c_partial_F_c
-	# np.array([(X[u] - Q[u]).dot(W[:,c]) for u in range(N)])
+	(X - Q).dot(W[:, c])
 
 	partial_L_X_c_partial_r_c = partial_L_X_c_partial_F_c.dot(partial_F_c_partial_r_c)
 
-	# print partial_L_X_c_partial_r_c 
-
-	# print M[c, 0]
-	# print -0.01 * ((1 - alpha) * partial_L_G_c_partial_r_c + alpha * partial_L_X_c_partial_r_c\
-	#  + lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_r_c)).A1
-
 	grad = ((1 - alpha) * partial_L_G_c_partial_r_c + alpha * partial_L_X_c_partial_r_c\
 	 + lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_r_c))
 
-	# print grad
-	# print
-
-	# norm = np.linalg.norm(grad)
-	# if norm > grad_clip_value:
-	# 	grad /= norm
-
 	return grad
 
 def update_community_theta_c(c, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
 				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp):
-	
-	# compute F
-	# delta_theta, h = hyperbolic_distance(R, thetas, M)
-	# F = compute_F(h, M)
-	# P = compute_P(F)
-	
-	# partial delta theta
-	partial_delta_theta_c_partial_theta_c = - np.multiply(-np.sign(np.pi - abs(thetas - M[1, c])), 
-		-np.sign(thetas - M[1, c]))
+				partial_L_G_partial_F):
+
+	# partial delta theta, shape (N, )
+	partial_delta_theta_c_partial_theta_c = - (-np.sign(np.pi - abs(thetas[:, 0] - M[1, c])) *\
+		-np.sign(thetas[:, 0] - M[1, c]))
 
-	partial_H_c_partial_delta_theta_c = 4 / delta_theta[:,c]
+	partial_H_c_partial_delta_theta_c = 4 / delta_theta[:, c]
 	norm = np.linalg.norm(partial_H_c_partial_delta_theta_c)
 	if norm > grad_clip_value:
 		partial_H_c_partial_delta_theta_c /= norm
-	
-
-	partial_F_c_partial_delta_theta_c = np.multiply(np.multiply(-H[:, c] / np.square(M[2, c]), 
-		F[:,c]), partial_H_c_partial_delta_theta_c).T
-
-	# norm = np.linalg.norm(partial_F_c_partial_delta_theta_c)
-	# if norm > 1:
-	# 	partial_F_c_partial_delta_theta_c /= norm
 
-	partial_F_c_partial_delta_theta_c = sp.sparse.spdiags(partial_F_c_partial_delta_theta_c, 0,
-		partial_F_c_partial_delta_theta_c.shape[1], partial_F_c_partial_delta_theta_c.shape[1])
-	
-	partial_F_c_partial_theta_c = partial_F_c_partial_delta_theta_c.dot(partial_delta_theta_c_partial_theta_c)
+	partial_F_c_partial_delta_theta_c = -H[:, c] / np.square(M[2, c]) * F[:, c] * partial_H_c_partial_delta_theta_c
 
-	# partial_L_G_partial_P = - 1.0 / N * \
-	# (A / P - 1 / (1 - P) + A / (1 - P)).reshape(1, -1)
+	partial_F_c_partial_theta_c = partial_F_c_partial_delta_theta_c * partial_delta_theta_c_partial_theta_c
 
-	partial_P_partial_F_c = compute_partial_P_partial_F_c(c, N, F, row_idx, col_idx, F_idx, exp)
-	partial_L_G_c_partial_F_c = partial_P_partial_F_c.multiply(partial_L_G_partial_P).sum(axis=1).T
-	# partial_L_G_c_partial_F_c = partial_P_partial_F_c.reshape((N, N**2)).multiply(partial_L_G_partial_P).sum(axis=1).T
+	partial_L_G_c_partial_F_c = partial_L_G_partial_F[:, c]
 
 	partial_L_G_c_partial_theta_c = partial_L_G_c_partial_F_c.dot(partial_F_c_partial_theta_c)
 
-	partial_l1_F_c_partial_F_c = np.sign(F[:,c]).T
-	
-	# LX
-	# F = np.column_stack([F, np.ones(N)])
-	# Q = compute_Q(F, W, attribute_type)
+	partial_l1_F_c_partial_F_c = np.sign(F[:, c])
 
-	# partial_L_X_c_partial_F_c = 1.0 / (N * K) *\
 	partial_L_X_c_partial_F_c = - 1.0 / N * \
-	(X - Q).dot(W[:,c]).T
-	# np.array([(X[u] - Q[u]).dot(W[:,c]) for u in range(N)])
+	(X - Q).dot(W[:, c])
 
 	partial_L_X_c_partial_theta_c = partial_L_X_c_partial_F_c.dot(partial_F_c_partial_theta_c)
 
-	# print -0.01 * ((1 - alpha) * partial_L_G_c_partial_theta_c + alpha * partial_L_X_c_partial_theta_c\
-	# 	+ lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_theta_c)).A1
-
-	# if 0.01 * ((1 - alpha) * partial_L_G_c_partial_theta_c + alpha * partial_L_X_c_partial_theta_c\
-	# 	+ lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_theta_c)) > np.pi / 2:
-	# 	stdout.write("TOOBIG COMMUNITY\n")
-	# 	return
-
 	grad = ((1 - alpha) * partial_L_G_c_partial_theta_c + alpha * partial_L_X_c_partial_theta_c\
 		+ lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_theta_c))
-	# norm = np.linalg.norm(grad)
-	# if norm > grad_clip_value:
-	# 	grad /= norm
 
 	return grad
 
 def update_community_sd_c(c, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
 				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp):
-	
-	# compute F
-
-	# delta_theta, h = hyperbolic_distance(R, thetas, M)
-	# F = compute_F(h, M)
-	# P = compute_P(F)
-	# partial F
-	partial_F_c_partial_sd_c = np.multiply(np.square(H[:, c]) / np.power(M[2, c], 3), F[:,c])
-	# partial_F_c_partial_sd_c = F[:,c] * (h[:,c] ** 2 / M[c,2] ** 3 - 1 / M[c,2])
+				partial_L_G_partial_F):
 
+	# partial F, shape (N, )
+	partial_F_c_partial_sd_c = np.square(H[:, c]) / np.power(M[2, c], 3) * F[:, c]
 
-	# partial_L_G_partial_P = - 1.0 / N * \
-	# (A / P - 1 / (1 - P) + A / (1 - P)).reshape(1, -1)
-
-	partial_P_partial_F_c = compute_partial_P_partial_F_c(c, N, F, row_idx, col_idx, F_idx, exp)
-	partial_L_G_c_partial_F_c = partial_P_partial_F_c.multiply(partial_L_G_partial_P).sum(axis=1).T
-	# partial_L_G_c_partial_F_c = partial_P_partial_F_c.reshape((N, N**2)).multiply(partial_L_G_partial_P).sum(axis=1).T
+	partial_L_G_c_partial_F_c = partial_L_G_partial_F[:, c]
 
 	partial_L_G_c_partial_sd_c = partial_L_G_c_partial_F_c.dot(partial_F_c_partial_sd_c)
 
-	partial_l1_F_c_partial_F_c = np.sign(F[:,c]).T
-	
-	# partial L_x 
-	# F = np.column_stack([F, np.ones(N)])
-	# Q = compute_Q(F, W, attribute_type)
+	partial_l1_F_c_partial_F_c = np.sign(F[:, c])
 
-	# partial_L_X_c_partial_F_c = 1.0 / (N * K) *\
 	partial_L_X_c_partial_F_c = - 1.0 / N * \
-	(X - Q).dot(W[:,c]).T
+	(X - Q).dot(W[:, c])
 
 	partial_L_X_c_partial_sd_c = partial_L_X_c_partial_F_c.dot(partial_F_c_partial_sd_c)
 
-	# print -0.01 * ((1 - alpha) * partial_L_G_c_partial_sd_c + alpha * partial_L_X_c_partial_sd_c\
-	# 	+ lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_sd_c)).A1
-
 	grad = ((1 - alpha) * partial_L_G_c_partial_sd_c + alpha * partial_L_X_c_partial_sd_c\
 		+ lamb_F * partial_l1_F_c_partial_F_c.dot(partial_F_c_partial_sd_c))
-	# norm = np.linalg.norm(grad)
-	# if norm > grad_clip_value:
-	# 	grad /= norm
+
 	return grad
 
 
 def update_W_k(k, N, A, X, thetas, M, W, delta_theta, H, F, P, Q, 
 				alpha, lamb_F, lamb_W, attribute_type,
-				partial_L_G_partial_P, row_idx, col_idx, F_idx, exp):
-	
-	# kth row of W
-	# W_k = W[k]
-	
-	# kth column of Q
-	# Q__k = compute_Q__k(F, W_k.T, attribute_type)
-	# Q = compute_Q(F, W, attribute_type)
+				partial_L_G_partial_F):
 
-	# partial_L_X_k_partial_Q_k = 1.0 / N * np.array([X[u, k] / Q[u, k] - (1 - X[u, k]) / (1 - Q[u, k])
-	# 	for u in range(N)])
-	# partial_Q_k_partial_W_k = np.array([[Q[u, k] * (1 - Q[u, k]) * F[u, c] 
-	# 	for c in range(C+1)] for u in range(N)])
-	# partial_L_X_k_partial_W_k = partial_L_X_k_partial_Q_k.dot(partial_Q_k_partial_W_k)
-
-	# partial_L_X_k_partial_W_k = 1.0 / N *\
+	# dL_X / dW_kc = (X__k - Q__k).dot(F__c), shape (C + 1, )
 	partial_L_X_k_partial_W_k = - 1.0 / N * \
-	(X.T[k] - Q.T[k]).dot(F)
-	# print partial_L_X_k_partial_W_k.shape
-	# np.array([(X[:, k] - Q__k).dot(F[:, c]) for c in range(C + 1)])
-
-	# print (X[:,k] - Q__k)
-	# print partial_L_X_k_partial_W_k 
+	(X[:, k] - Q[:, k]).dot(F)
 
 	partial_l1_W_k_partial_W_k = np.sign(W[k])
-	# print X.T[k].T.shape
-	# print Q__k.shape
-	# print (X.T[k] - Q__k).shape
-	# print partial_L_X_k_partial_W_k.shape
-	# print partial_l1_W_k_partial_W_k.shape
-	# print (alpha * partial_L_X_k_partial_W_k - lamb_W * partial_l1_W_k_partial_W_k).shape
 
 	grad = alpha * partial_L_X_k_partial_W_k + lamb_W * partial_l1_W_k_partial_W_k
-	# norm = np.linalg.norm(grad)
-	# if norm > grad_clip_value:
-	# 	grad /= norm
 
 	return grad
 
+def clip_gradient_norm(x, axis):
+	'''
+	rescale rows (axis=1) or columns (axis=0) of x with norm greater than grad_clip_value
+	to have unit norm
+	'''
+	norm = np.sqrt(np.square(x).sum(axis=axis, keepdims=True))
+	return np.divide(x, np.where(norm > grad_clip_value, norm, 1))
+
+def compute_partial_L_partial_F(N, F, residual_W, alpha, lamb_F, partial_L_G_partial_F, workspace=None):
+	'''
+	closed form derivative of the loss with respect to every element of F
+	(F without the column of ones, residual_W is (X - Q).dot(W[:,:-1]))
+	or, with a membership tolerance, to every element of the support of F
+
+	returns two (N, C) matrices:
+	the first differentiates L_G only through the uth row of P (as in update_theta_u),
+	the second through both the rows and columns of P (as in update_community_*)
+
+	the result is written to arrays of workspace, if given
+	'''
+
+	if workspace is None:
+
+		partial_L_G_partial_F_nodes, partial_L_G_partial_F_communities = partial_L_G_partial_F
+
+		# dL_X/dF_uc = -1/N (X_u - Q_u).dot(W__c)
+		partial_L_X_partial_F = - 1.0 / N * residual_W
+
+		partial_l1_F_partial_F = np.sign(F)
+
+		partial_L_partial_F = alpha * partial_L_X_partial_F + lamb_F * partial_l1_F_partial_F
+
+		return (1 - alpha) * partial_L_G_partial_F_nodes + partial_L_partial_F,\
+			(1 - alpha) * partial_L_G_partial_F_communities + partial_L_partial_F
+
+	# the same operations in place
+	partial_L_partial_F = workspace.get("partial_L_partial_F", F.shape)
+	partial_L_partial_F_nodes = workspace.get("partial_L_partial_F_nodes", F.shape)
+	partial_L_partial_F_communities = workspace.get("partial_L_partial_F_communities", F.shape)
+
+	np.multiply(residual_W, - 1.0 / N, out=partial_L_partial_F)
+	partial_L_partial_F *= alpha
+	np.sign(F, out=partial_L_partial_F_nodes)
+	partial_L_partial_F_nodes *= lamb_F
+	partial_L_partial_F += partial_L_partial_F_nodes
+
+	for partial_L_G, out in zip(partial_L_G_partial_F, (partial_L_partial_F_nodes, partial_L_partial_F_communities)):
+		np.multiply(partial_L_G, 1 - alpha, out=out)
+		out += partial_L_partial_F
+
+	return partial_L_partial_F_nodes, partial_L_partial_F_communities
+
+def compute_partial_F_partial_H(H, F, M):
+	'''
+	dF_uc / dh_uc = -h_uc / sd_c ** 2 * F_uc
+	'''
+	return np.multiply(-H / np.square(M[2]), F[:,:-1])
+
+def compute_partial_delta_theta_partial_theta(thetas, M):
+	'''
+	d delta_theta_uc / d theta_u (the derivative with respect to M[1, c] is its negative)
+	'''
+	return np.multiply(np.sign(np.pi - abs(thetas - M[1])), np.sign(thetas - M[1]))
+
+def gradient_thetas(thetas, M, delta_theta, H, F, partial_L_partial_F):
+	'''
+	gradient of loss with respect to the angular co-ordinates of all nodes (N, 1)
+	'''
+	# clipped per node, as in update_theta_u
+	partial_H_partial_delta_theta = clip_gradient_norm(4 / delta_theta, axis=1)
+	partial_F_partial_theta = np.multiply(np.multiply(compute_partial_F_partial_H(H, F, M),
+		partial_H_partial_delta_theta), compute_partial_delta_theta_partial_theta(thetas, M))
+	return np.multiply(partial_L_partial_F, partial_F_partial_theta).sum(axis=1, keepdims=True)
+
+def gradient_community_r(M, H, F, partial_L_partial_F):
+	'''
+	gradient of loss with respect to the radial co-ordinates of all communities
+	dh_uc / d_rc = 1
+	'''
+	return np.multiply(partial_L_partial_F, compute_partial_F_partial_H(H, F, M)).sum(axis=0)
+
+def gradient_community_thetas(thetas, M, delta_theta, H, F, partial_L_partial_F):
+	'''
+	gradient of loss with respect to the angular co-ordinates of all communities
+	'''
+	# clipped per community, as in update_community_theta_c
+	partial_H_partial_delta_theta = clip_gradient_norm(4 / delta_theta, axis=0)
+	partial_F_partial_theta = - np.multiply(np.multiply(compute_partial_F_partial_H(H, F, M),
+		partial_H_partial_delta_theta), compute_partial_delta_theta_partial_theta(thetas, M))
+	return np.multiply(partial_L_partial_F, partial_F_partial_theta).sum(axis=0)
+
+def gradient_community_sd(M, H, F, partial_L_partial_F):
+	'''
+	gradient of loss with respect to the standard deviations of all communities
+	dF_uc / d_sd_c = h_uc ** 2 / sd_c ** 3 * F_uc
+	'''
+	partial_F_partial_sd = np.multiply(np.square(H) / np.power(M[2], 3), F[:,:-1])
+	return np.multiply(partial_L_partial_F, partial_F_partial_sd).sum(axis=0)
+
+def compute_clip_norms(delta_theta, indices, length):
+	'''
+	divisors that clip_gradient_norm(4 / delta_theta, axis) applies to the rows (indices are the nodes
+	of the support) or columns (indices are the communities of the support) of 4 / delta_theta,
+	with the norms taken over the support only (delta_theta is a vector over the support)
+	'''
+	norm = np.sqrt(np.bincount(indices, np.square(4 / delta_theta), minlength=length))
+	return np.where(norm > grad_clip_value, norm, 1)
+
+def gradient_support(parameter, N, thetas, M, support, delta_theta, H, F,
+	partial_L_partial_F_nodes, partial_L_partial_F_communities):
+	'''
+	gradient of one group of parameters ("thetas", "r", "community_thetas" or "sd") from
+	the support of F only (delta_theta, H, F and dL/dF are vectors over the support),
+	as gradient_thetas, gradient_community_r, gradient_community_thetas and gradient_community_sd
+
+	4 / delta_theta is clipped by its norm over the support (see compute_clip_norms),
+	which is the norm over all node community pairs when the support is every pair
+	'''
+	nodes, communities = support
+	C = M.shape[1]
+	sd = np.asarray(M[2]).ravel()[communities]
+	partial_F_partial_H = -H / np.square(sd) * F
+
+	if parameter == "r":
+		return np.bincount(communities, partial_L_partial_F_communities * partial_F_partial_H,
+			minlength=C).astype(F.dtype)
+	elif parameter == "sd":
+		partial_F_partial_sd = np.square(H) / np.power(sd, 3) * F
+		return np.bincount(communities, partial_L_partial_F_communities * partial_F_partial_sd,
+			minlength=C).astype(F.dtype)
+
+	difference = np.asarray(thetas).ravel()[nodes] - np.asarray(M[1]).ravel()[communities]
+	partial_delta_theta_partial_theta = np.sign(np.pi - abs(difference)) * np.sign(difference)
+
+	if parameter == "thetas":
+		partial_H_partial_delta_theta = 4 / delta_theta / compute_clip_norms(delta_theta, nodes, N)[nodes]
+		partial_F_partial_theta = partial_F_partial_H * partial_H_partial_delta_theta * partial_delta_theta_partial_theta
+		return np.bincount(nodes, partial_L_partial_F_nodes * partial_F_partial_theta,
+			minlength=N).astype(F.dtype)[:, None]
+	elif parameter == "community_thetas":
+		partial_H_partial_delta_theta = 4 / delta_theta / compute_clip_norms(delta_theta, communities, C)[communities]
+		partial_F_partial_theta = - partial_F_partial_H * partial_H_partial_delta_theta * partial_delta_theta_partial_theta
+		return np.bincount(communities, partial_L_partial_F_communities * partial_F_partial_theta,
+			minlength=C).astype(F.dtype)
+	raise ValueError("unknown parameter {}".format(parameter))
+
+def gradient_W(N, W, residual_F, alpha, lamb_W):
+	'''
+	gradient of loss with respect to all attribute weights
+	(residual_F is (X - Q).T.dot(F), F with the column of ones appended)
+	'''
+	return - alpha / N * residual_F + lamb_W * np.sign(W)
+
+def closed_form_gradient_wrapper(parameter, state, alpha, lamb_F, lamb_W):
+	'''
+	computes the gradient of one group of parameters ("thetas", "r", "community_thetas", "sd" or "W")
+	for all nodes, communities or attributes at once, in the shape of the group (see ModelState)
+	'''
+
+	delta_theta, H = state.get_H()
+	F = state.get_F()
+	residual_W, residual_F = state.get_residual_products()
+	N, thetas, M, W = state.N, state.thetas, state.M, state.W
+
+	if parameter == "W":
+		return gradient_W(N, W, residual_F, alpha, lamb_W)
+
+	if state.sparse_membership:
+		F_support = state.get_F_support()
+		partial_L_partial_F_nodes, partial_L_partial_F_communities = compute_partial_L_partial_F(N,
+			F_support, residual_W, alpha, lamb_F, state.get_partial_L_G_partial_F())
+		return gradient_support(parameter, N, thetas, M, state.get_support(), delta_theta, H, F_support,
+			partial_L_partial_F_nodes, partial_L_partial_F_communities)
+
+	partial_L_partial_F_nodes, partial_L_partial_F_communities = compute_partial_L_partial_F(N,
+		F[:,:-1], residual_W, alpha, lamb_F, state.get_partial_L_G_partial_F(), state.workspace)
+
+	if parameter == "thetas":
+		return gradient_thetas(thetas, M, delta_theta, H, F, partial_L_partial_F_nodes)
+	elif parameter == "r":
+		return gradient_community_r(M, H, F, partial_L_partial_F_communities)
+	elif parameter == "community_thetas":
+		return gradient_community_thetas(thetas, M, delta_theta, H, F, partial_L_partial_F_communities)
+	elif parameter == "sd":
+		return gradient_community_sd(M, H, F, partial_L_partial_F_communities)
+	raise ValueError("unknown parameter {}".format(parameter))
+
+def check_gradients(N, K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type,
+	tolerance=gradient_check_tolerance):
+	'''
+	compare closed form gradients against the per element update functions, which differentiate
+	L_G through the dense matrices of dL_G/dP and dP/dF (see reference_partial_L_G_partial_F)
+	rather than the block kernel of the closed form, so the graph should be small
+	'''
+	state = ForwardState(N, A, X, R, thetas, M, W, attribute_type)
+	partial_L_G_partial_F = reference_partial_L_G_partial_F(N, A, state.get_F()[:,:-1])
+
+	checks = [("thetas", update_theta_u, range(N)),
+		("r", update_community_r_c, range(C)),
+		("community_thetas", update_community_theta_c, range(C)),
+		("sd", update_community_sd_c, range(C)),
+		("W", update_W_k, range(K))]
+
+	for parameter, updater, l in checks:
+		grad = closed_form_gradient_wrapper(parameter, state, alpha, lamb_F, lamb_W)
+		expected = gradient_wrapper(updater, l, state, alpha, lamb_F, lamb_W, partial_L_G_partial_F)
+		grad, expected = np.ravel(grad), np.ravel(expected)
+		error = np.abs(grad - expected).max()
+		stdout.write("gradient check {}: max absolute error={}\n".format(parameter, error))
+		assert np.allclose(grad, expected, rtol=tolerance, atol=tolerance),\
+		"closed form gradient of {} does not match".format(parameter)
+
 def estimate_T():
 	'''
 	TODO
@@ -555,23 +1660,11 @@ def estimate_gamma(degrees):
 	result = powerlaw.Fit(degrees)
 	return result.power_law.alpha
 
-def preprocess_G(gml_file, gamma, T):
-
-	G = nx.read_gml(gml_file)
-	G = max(nx.connected_component_subgraphs(G), key=len)
+def preprocess_G(gml_file, gamma, T, cache_directory=None):
 
-	N = nx.number_of_nodes(G)
+	nodes, A, degrees, L = load_graph(gml_file, cache_directory)
 
-	degree_dict = nx.degree(G)
-	
-	# node id
-	order_of_appearance = np.array(sorted(degree_dict, key=degree_dict.get, reverse=True))
-	nodes = np.array(G.nodes())
-	# node index
-	order_of_appearance = np.concatenate([np.where(order_of_appearance==n)[0]
-		for n in nodes])
-
-	degrees = np.array(degree_dict.values())
+	N = len(nodes)
 
 	# PS model parameters -- to estimate in real world network
 	m = degrees.mean() / 2
@@ -586,50 +1679,49 @@ def preprocess_G(gml_file, gamma, T):
 	stdout.write("m={}, T={}, gamma={}, beta={}\n".format(m, T, gamma, beta))
 
 	# determine radial coordinates of nodes
-	R = 2 * beta * np.log(range(1, N + 1)) + 2 * (1 - beta) * np.log(N) 
-	R = np.matrix(R[order_of_appearance]).T
-
-	# observed adjacency matrix
-	A = nx.adjacency_matrix(G)
-
-	L = nx.laplacian_matrix(G).asfptype()
+	R = radial_coordinates(degrees, gamma).reshape(-1, 1)
 
 	return nodes, N, R, A, L
 
-def preprocess_X(nodes, attribute_file):
-	attr_df = pd.read_csv(attribute_file, index_col=0,)
-	return sp.sparse.csr_matrix(attr_df.iloc[nodes, :].values)
+def preprocess_X(nodes, attribute_file, cache_directory=None):
+	index, X = load_attributes(attribute_file, cache_directory)
+	return X[select_rows(nodes, index)]
 
 def preprocess_true_communities(nodes, true_community_file):
 	if true_community_file == None:
 		return None
 	community_df = pd.read_csv(true_community_file, header=None, index_col=0, sep=" ")
-	return community_df.iloc[nodes, 0].values
+	return community_df.iloc[select_rows(nodes, community_df.index, "true communities"), 0].values
 
-def initialize_matrices(L, N, C, K, R):
+def initialize_matrices(L, N, C, K, R, likelihood="dense", init="auto", init_thetas=None):
+	'''
+	random community centres, standard deviations and attribute weights and angular co-ordinates
+	of nodes ordered as in LaBNE (see labne_angles for init and the warm start init_thetas)
+	'''
 
 	sigma = 10
 	community_radii = R.mean()
 	noise = 1e-2
 	# community matrix M
-	M = np.matrix(np.zeros((3, C)))
+	M = np.zeros((3, C))
 	# centre radii
-	# M[0] = np.random.normal(size=(1, C), loc=community_radii, scale=noise)
-	M[0] = np.random.rand(1, C) * R.max()
+	# M[0] = np.random.normal(size=C, loc=community_radii, scale=noise)
+	M[0] = np.random.rand(C) * R.max()
 	# center angular coordinate
-	M[1] = np.random.rand(1, C) * 2 * np.pi
+	M[1] = np.random.rand(C) * 2 * np.pi
 	# community standard deviations
-	# M[2] = np.random.normal(size=(1, C), loc=sigma, scale=noise)
-	M[2] = np.random.rand(1, C) * R.mean()
+	# M[2] = np.random.normal(size=C, loc=sigma, scale=noise)
+	M[2] = np.random.rand(C) * R.mean()
 
 
 	# initialise logistic weights
-	W = np.matrix(np.random.normal(size=(K, C + 1), scale=noise))
+	W = np.random.normal(size=(K, C + 1), scale=noise)
 
 	# order statrting angles according to labne
-	u, V = sp.sparse.linalg.eigsh(L, k=3, which="LM", sigma=0)
-	thetas = np.arctan2(V[:,2], V[:,1])
-	thetas = np.matrix(thetas.argsort() * 2 * np.pi / N).T
+	start_time = time.time()
+	thetas = labne_angles(L, init, init_thetas)
+	thetas = equidistant_angles(thetas).reshape(-1, 1)
+	stdout.write("Computed LaBNE angles in {:.1f} seconds\n".format(time.time() - start_time))
 
 	stdout.write("Initialized thetas to:\n")
 	stdout.write("{}\n".format(thetas[:10]))
@@ -640,221 +1732,322 @@ def initialize_matrices(L, N, C, K, R):
 
 	_, H = hyperbolic_distance(R, thetas, M)
 	F = compute_F(H, M)
-	P = compute_P(F)
-
-	print "F="
-	print F 
-
-	stdout.write("P_mean={}\n".format(P.mean()))
-
-	return thetas, M, W
-
-def train(A, X, N, K, C, R, thetas, M, W, 
-	eta=1e-2, alpha=0.5, lamb_F=1e-2, lamb_W=1e-2, 
-	num_processes=None, num_epochs=0, true_communities=None, 
-	attribute_type="binary", plot_directory=None):
-
-	L_G, L_X, l1_F, l1_W, loss = compute_likelihood(A, X, N, K, R, thetas, M, W, 
-		lamb_F=lamb_F, lamb_W=lamb_W, alpha=alpha, attribute_type=attribute_type)
-	# alpha = L_X / (L_G + L_X)
-	stdout.write("alpha={}, L_G={}, L_X={}, l1_F={}, l1_W={}, total_loss={}\n".format(alpha, L_G, L_X, l1_F, l1_W, loss))
 
-	if num_processes is not None:
-		pool = Pool(num_processes)
+	stdout.write("Initialized F to:\n")
+	stdout.write("{}\n".format(F))
 
+	if likelihood == "sparse":
+		# mean of F_u F_v over all pairs without computing P
+		stdout.write("FF_mean={}\n".format(np.square(F.sum(axis=0)).sum() / N ** 2))
 	else:
-		pool = None
-		
-	for e in range(num_epochs):
-
-		delta_thetas = gradient_wrapper(pool, update_theta_u, range(N), N, 
-			K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type)
-
-		# print delta_thetas
-
-		thetas -= eta * delta_thetas
-		thetas = thetas % (2* np.pi)
+		P = compute_P(F)
+		stdout.write("P_mean={}\n".format(P.mean()))
 
-		delta_M = gradient_wrapper(pool, update_community_r_c, range(C), N, 
-			K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type, precompute_partial_L_G_partial_P_flag=True)
-
-		print "r"
-		print delta_M
-
-		M[0] -= eta * delta_M.T
-
-		delta_M = gradient_wrapper(pool, update_community_theta_c, range(C), N, 
-			K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type, precompute_partial_L_G_partial_P_flag=True)
-
-		print "thetas"
-		print delta_M
-
-		M[1] -= eta * delta_M.T
-		M[1] = M[1] % (2 * np.pi)
+	return thetas, M, W
 
-		delta_M = gradient_wrapper(pool, update_community_sd_c, range(C), N, 
-			K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type, precompute_partial_L_G_partial_P_flag=True)
+class SGD(object):
+	'''
+	gradient descent with optional momentum
 
-		print "sd"
-		print delta_M
+	every group of parameters ("thetas", "r", "community_thetas", "sd" and "W") has its own
+	learning rate (eta unless given in learning_rates) and its own optimizer state,
+	which can be saved and restored with get_state and set_state
+	'''
 
-		M[2] -= eta * delta_M.T
+	def __init__(self, eta, learning_rates=None, momentum=0.):
+		self.eta = eta
+		self.learning_rates = learning_rates if learning_rates is not None else {}
+		self.momentum = momentum
+		# multiplier of all learning rates, set by the learning rate schedule
+		self.scale = 1.
+		# number of updates to each group of parameters
+		self.iterations = {}
+		# accumulators (velocity, moments) keyed on (group of parameters, name)
+		self.slots = {}
+
+	def learning_rate(self, parameter):
+		return self.scale * self.learning_rates.get(parameter, self.eta)
+
+	def get_slot(self, parameter, name, grad):
+		if (parameter, name) not in self.slots:
+			self.slots[(parameter, name)] = np.zeros(grad.shape, dtype=grad.dtype)
+		return self.slots[(parameter, name)]
+
+	def compute_step(self, parameter, grad):
+		if self.momentum == 0:
+			return self.learning_rate(parameter) * grad
+		velocity = self.momentum * self.get_slot(parameter, "velocity", grad) + grad
+		self.slots[(parameter, "velocity")] = velocity
+		return self.learning_rate(parameter) * velocity
+
+	def apply(self, parameter, value, grad):
+		'''
+		return value after one step against grad
+
+		angles are wrapped back onto [0, 2pi) after the step, the loss is periodic in them
+		so the accumulated state is unaffected by the wrap
+		'''
+		self.iterations[parameter] = self.iterations.get(parameter, 0) + 1
+		# the step is taken in the precision of value
+		value = value - self.compute_step(parameter, grad).astype(value.dtype, copy=False)
+		if parameter in angular_parameters:
+			value = value % (2 * np.pi)
+		return value
+
+	def get_state(self):
+		'''
+		flat dictionary of arrays, suitable for np.savez
+		'''
+		state = {"{}__{}".format(parameter, name) : np.asarray(slot)
+			for (parameter, name), slot in self.slots.items()}
+		state.update({"{}__iterations".format(parameter) : np.array(iterations)
+			for parameter, iterations in self.iterations.items()})
+		return state
+
+	def set_state(self, state):
+		for key in state.keys():
+			parameter, name = key.split("__")
+			if name == "iterations":
+				self.iterations[parameter] = int(state[key])
+			else:
+				self.slots[(parameter, name)] = np.asarray(state[key])
+
+class AdaGrad(SGD):
+	'''
+	gradient descent with learning rates scaled by the accumulated squared gradients
+	'''
 
-		delta_W = gradient_wrapper(pool, update_W_k, range(K), N, 
-			K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type)
+	def __init__(self, eta, learning_rates=None, epsilon=1e-8):
+		super(AdaGrad, self).__init__(eta, learning_rates)
+		self.epsilon = epsilon
 
-		W -= eta * delta_W
+	def compute_step(self, parameter, grad):
+		accumulator = self.get_slot(parameter, "accumulator", grad) + np.square(grad)
+		self.slots[(parameter, "accumulator")] = accumulator
+		return self.learning_rate(parameter) * np.divide(grad, np.sqrt(accumulator) + self.epsilon)
 
-		# if num_processes is None:
-			
-		# 	# print "thetas"
-		# 	for u in np.random.permutation(N):
-		# 		thetas[u] -= eta * update_theta_u(u, N, K, C, A, X, R,
-		# 			thetas, M, W, alpha, lamb_F, attribute_type)
-		# 		thetas[u] = thetas[u] % (2 * np.pi)
+class Adam(SGD):
+	'''
+	gradient descent with bias corrected estimates of the first and second moments of the gradient
+	'''
 
-		# 	stdout.write("thetas\n")
-		# 	stdout.flush()
+	def __init__(self, eta, learning_rates=None, beta_1=0.9, beta_2=0.999, epsilon=1e-8):
+		super(Adam, self).__init__(eta, learning_rates)
+		self.beta_1 = beta_1
+		self.beta_2 = beta_2
+		self.epsilon = epsilon
 
-		# 	# print "r"
-		# 	for c in np.random.permutation(C):
-		# 		M[0, c] -= eta * update_community_r_c(c, N, K, A, X, R,
-		# 			thetas, M, W, alpha, lamb_F, attribute_type)
+	def compute_step(self, parameter, grad):
+		t = self.iterations[parameter]
+		m = self.beta_1 * self.get_slot(parameter, "m", grad) + (1 - self.beta_1) * grad
+		v = self.beta_2 * self.get_slot(parameter, "v", grad) + (1 - self.beta_2) * np.square(grad)
+		self.slots[(parameter, "m")] = m
+		self.slots[(parameter, "v")] = v
+		eta = self.learning_rate(parameter) * np.sqrt(1 - self.beta_2 ** t) / (1 - self.beta_1 ** t)
+		return eta * np.divide(m, np.sqrt(v) + self.epsilon)
 
-		# 	stdout.write("community radial\n")
-		# 	stdout.flush()
+optimizers = {"sgd" : SGD, "adagrad" : AdaGrad, "adam" : Adam}
 
-		# 	# # # # print "community thetas"
-		# 	for c in np.random.permutation(C):
-		# 		M[1, c] -= eta * update_community_theta_c(c, N, K, A, X, R,
-		# 			thetas, M, W, alpha, lamb_F, attribute_type)
-		# 		M[1, c] = M[1, c] % (2 * np.pi)
+def save_checkpoint(filepath, epoch, loss, thetas, M, W, optimizer, early_stopping, schedule, support=None):
+	'''
+	atomically write everything needed to resume training from epoch to a compressed npz file:
+	parameters, loss, state of the optimizer, early stopping and learning rate schedule,
+	the state of the random number generator and the support of a sparse F (if given)
+	'''
+	_, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+	checkpoint = {"epoch" : epoch, "loss" : loss, "thetas" : thetas, "M" : M, "W" : W,
+		"rng_keys" : rng_keys, "rng_pos" : rng_pos, "rng_has_gauss" : rng_has_gauss,
+		"rng_cached_gaussian" : rng_cached_gaussian}
+	if support is not None:
+		checkpoint.update(prefixed("support", {"nodes" : support[0], "communities" : support[1]}))
+	save_checkpoint_arrays(filepath, checkpoint,
+		(("optimizer", optimizer), ("early_stopping", early_stopping), ("schedule", schedule)))
+
+def restore_checkpoint(checkpoint, optimizer, early_stopping, schedule):
+	'''
+	restore optimizer, early stopping and learning rate schedule from checkpoint
+	returns epoch, loss, thetas, M, W and the support of a sparse F (None if it was not saved)
+	'''
+	restore_states(checkpoint, (("optimizer", optimizer), ("early_stopping", early_stopping), ("schedule", schedule)))
+	support = unprefixed(checkpoint, "support")
+	support = (support["nodes"], support["communities"]) if support else None
+	return (int(checkpoint["epoch"]), float(checkpoint["loss"]), checkpoint["thetas"],
+		checkpoint["M"], checkpoint["W"], support)
 
-		# 	stdout.write("community thetas\n")
-		# 	stdout.flush()
+def restore_random_state(checkpoint):
+	np.random.set_state(("MT19937", checkpoint["rng_keys"], int(checkpoint["rng_pos"]),
+		int(checkpoint["rng_has_gauss"]), float(checkpoint["rng_cached_gaussian"])))
 
-		# 	# # # # print "sd"
-		# 	for c in np.random.permutation(C):
-		# 		M[2, c] -= eta * update_community_sd_c(c, N, K, A, X, R,
-		# 			thetas, M, W, alpha, lamb_F, attribute_type)
+def train(A, X, N, K, C, R, thetas, M, W, 
+	eta=1e-2, alpha=0.5, lamb_F=1e-2, lamb_W=1e-2, 
+	num_processes=None, num_epochs=0, true_communities=None, 
+	attribute_type="binary", plot_directory=None, likelihood="dense", num_negative_samples=None,
+	batch_size=None, sampler="edge", steps_per_epoch=None, optimizer=None,
+	early_stopping=None, schedule=None, checkpoint_filepath=None, checkpoint_interval=1, checkpoint=None,
+	plot_interval=1, plot_format="png", attribute_likelihood="dense", num_attribute_samples=None,
+	membership_tolerance=None, num_angular_bands=8, membership_top_k=None, support_interval=default_support_interval,
+	dtype=np.float64):
+
+	if optimizer is None:
+		optimizer = SGD(eta)
+	if early_stopping is None:
+		early_stopping = EarlyStopping()
+	if schedule is None:
+		schedule = LearningRateSchedule()
+	stop_reason = "reached {} epochs".format(num_epochs)
+
+	initial_epoch = 0
+	if checkpoint is not None:
+		initial_epoch, checkpoint_loss, thetas, M, W, checkpoint_support = restore_checkpoint(checkpoint,
+			optimizer, early_stopping, schedule)
+		stdout.write("Resuming from epoch {}\n".format(initial_epoch))
+
+	# every array of the forward and backward pass is computed in the precision of the parameters
+	X = X.astype(dtype)
+
+	if num_processes is not None and likelihood == "dense" and membership_tolerance is None and membership_top_k is None:
+		pool = SharedMemoryPool(num_processes, N, A, C, dtype=dtype)
 
-		# 	stdout.write("community sd\n")
-		# 	stdout.flush()
+	else:
+		if num_processes is not None:
+			stdout.write("parallel gradients are only available for the dense likelihood of dense F\n")
+		pool = None
 
-		# else:
-		# 	delta_thetas = np.concatenate(pool.map(partial(update_theta_u, 
-		# 		N=N, K=K, C=C, A=A, X=X, R=R, thetas=thetas, M=M, W=W, 
-		# 		alpha=alpha, lamb_F=lamb_F, attribute_type=attribute_type),
-		# 		range(N)))
+	# forward pass shared by all gradients and likelihoods
+	state = ForwardState(N, A, X, R, thetas, M, W, attribute_type,
+		likelihood, num_negative_samples, pool, attribute_likelihood, num_attribute_samples,
+		membership_tolerance, num_angular_bands, membership_top_k, dtype)
+	# parameters, updated in place
+	model = state.model
+	R, thetas, M, W = model.R, model.thetas, model.M, model.W
 
-		# 	thetas -= eta * delta_thetas
-		# 	thetas = thetas % (2 * np.pi)
+	if plot_directory is not None:
+		plotter = Plotter(plot_directory, N, C, R, plot_interval, plot_format)
+	else:
+		plotter = None
+
+	if batch_size is not None:
+		# sample minibatches of node pairs and attribute rows,
+		# by default taking enough steps per epoch to visit every edge once
+		edges = A.nonzero()
+		if steps_per_epoch is None:
+			steps_per_epoch = int(np.ceil(float(len(edges[0])) / batch_size))
+	else:
+		steps_per_epoch = 1
 
-		# 	stdout.write("thetas\n")
-		# 	stdout.flush()
+	L_G, L_X, l1_F, l1_W, loss = compute_likelihood(A, X, N, K, R, thetas, M, W, 
+		lamb_F=lamb_F, lamb_W=lamb_W, alpha=alpha, attribute_type=attribute_type,
+		likelihood=likelihood, num_negative_samples=num_negative_samples, state=state)
+	# alpha = L_X / (L_G + L_X)
+	stdout.write("alpha={}, L_G={}, L_X={}, l1_F={}, l1_W={}, total_loss={}\n".format(alpha, L_G, L_X, l1_F, l1_W, loss))
 
-		# 	delta_M = np.concatenate(pool.map(partial(update_community_r_c, 
-		# 		N=N, K=K, A=A, X=X, R=R, thetas=thetas, M=M, W=W, 
-		# 		alpha=alpha, lamb_F=lamb_F, attribute_type=attribute_type), range(C)), axis=0)
+	if checkpoint is not None:
+		# continue exactly as the interrupted run would have
+		# (computing the loss above may have drawn negative samples)
+		loss = checkpoint_loss
+		restore_random_state(checkpoint)
+		# the support chosen at the last refresh, rather than one chosen early from the current parameters
+		if state.sparse_membership and checkpoint_support is not None:
+			state.set_support(checkpoint_support)
 
-		# 	M[0] -= eta * delta_M.T
+	e = initial_epoch - 1
+	for e in range(initial_epoch, num_epochs):
 
-		# 	stdout.write("community radial\n")
-		# 	stdout.flush()
+		optimizer.scale = schedule.scale(e, loss)
 
-		# 	delta_M = np.concatenate(pool.map(partial(update_community_theta_c, 
-		# 		N=N, K=K, A=A, X=X, R=R, thetas=thetas, M=M, W=W, 
-		# 		alpha=alpha, lamb_F=lamb_F, attribute_type=attribute_type), range(C)), axis=0)
+		for step in range(steps_per_epoch):
 
-		# 	M[1] -= eta * delta_M.T
-		# 	M[1] = M[1] % (2 * np.pi)
+			# in between, memberships that enter the support are missed and those that leave it are
+			# still evaluated (they are only near zero), so a longer interval trades accuracy for speed
+			if state.sparse_membership and (e * steps_per_epoch + step) % support_interval == 0:
+				state.refresh_support()
 
-		# 	stdout.write("community thetas\n")
-		# 	stdout.flush()
+			if batch_size is not None:
+				state.set_batch(*sample_batch(N, A, edges, batch_size, sampler))
 
-		# 	delta_M = np.concatenate(pool.map(partial(update_community_sd_c, 
-		# 		N=N, K=K, A=A, X=X, R=R, thetas=thetas, M=M, W=W, 
-		# 		alpha=alpha, lamb_F=lamb_F, attribute_type=attribute_type), range(C)), axis=0)
+			delta_thetas = closed_form_gradient_wrapper("thetas", state, alpha, lamb_F, lamb_W)
 
-		# 	M[2] -= eta * delta_M.T
+			model.set("thetas", optimizer.apply("thetas", thetas, delta_thetas))
+			state.update("thetas")
 
-		# 	stdout.write("community sd\n")
-		# 	stdout.flush()
-		
-		# _, h = hyperbolic_distance(R, thetas, M)
-		# F = compute_F(h, M)
-		# community_predictions = F.argmax(axis=1).A1
-		# F = np.column_stack([F, np.ones(N)])
+			delta_M = closed_form_gradient_wrapper("r", state, alpha, lamb_F, lamb_W)
 
+			model.set("r", optimizer.apply("r", M[0], delta_M))
+			state.update("r")
 
-		# if  num_processes is None:
+			delta_M = closed_form_gradient_wrapper("community_thetas", state, alpha, lamb_F, lamb_W)
 
-		# 	for k in np.random.permutation(K):
-		# 		W[k] -= eta * update_W_k(k, N, K, C, X, W, F, lamb_W, alpha, attribute_type)
+			model.set("community_thetas", optimizer.apply("community_thetas", M[1], delta_M))
+			state.update("community_thetas")
 
-		# else:
+			delta_M = closed_form_gradient_wrapper("sd", state, alpha, lamb_F, lamb_W)
 
-		# 	delta_W = np.concatenate(pool.map(partial(update_W_k, 
-		# 		N=N, K=K, C=C, X=X, F=F, W=W, 
-		# 		alpha=alpha, lamb_W=lamb_W, attribute_type=attribute_type), range(K)), axis=0)
+			model.set("sd", optimizer.apply("sd", M[2], delta_M))
+			state.update("sd")
 
-		# 	W -= eta * delta_W
+			delta_W = closed_form_gradient_wrapper("W", state, alpha, lamb_F, lamb_W)
 
-		# stdout.write("W\n")
-		# stdout.flush()
+			model.set("W", optimizer.apply("W", W, delta_W))
+			state.update("W")
 
+		# loss and NMI over the whole graph
+		state.set_batch()
 		L_G, L_X, l1_F, l1_W, loss = compute_likelihood(A, X, N, K, R, thetas, M, W, 
-			lamb_F=lamb_F, lamb_W=lamb_W, alpha=alpha, attribute_type=attribute_type)
+			lamb_F=lamb_F, lamb_W=lamb_W, alpha=alpha, attribute_type=attribute_type,
+			likelihood=likelihood, num_negative_samples=num_negative_samples, state=state)
 		# alpha = L_X / (L_G + L_X)
 		stdout.write("epoch={}, alpha={}, L_G={}, L_X={}, l1_F={}, l1_W={}, total_loss={}\n".format(e, alpha, L_G, L_X, l1_F, l1_W, loss) )
 
+		F = state.get_F()[:,:-1]
+
+		nmi = None
 		if true_communities is not None:
 			# NMI
-			stdout.write("NMI: {}\n".format(NMI(true_communities, community_predictions)))
+			community_predictions = np.asarray(F.argmax(axis=1)).ravel()
+			nmi = NMI(true_communities, community_predictions)
+			stdout.write("NMI: {}\n".format(nmi))
 
-		draw_network(N, C, R, thetas, M, e, L_G, L_X, plot_directory)
+		if plotter is not None:
+			plotter.plot(e, thetas, M, F, L_G=L_G, L_X=L_X)
 
 		stdout.flush()
 
-	if num_processes is not None:
+		reason = early_stopping.check(loss, nmi)
+
+		if checkpoint_filepath is not None and (reason is not None 
+			or (e + 1) % checkpoint_interval == 0 or e + 1 == num_epochs):
+			save_checkpoint(checkpoint_filepath, e + 1, loss, thetas, M, W, optimizer, early_stopping, schedule,
+				state.support if state.sparse_membership else None)
+			stdout.write("Saved checkpoint to {}\n".format(checkpoint_filepath))
+
+		if reason is not None:
+			stop_reason = reason
+			break
+
+	stdout.write("Training stopped after {} epochs ({:.1f} seconds): {}\n".format(e + 1,
+		time.time() - early_stopping.start_time, stop_reason))
+
+	if pool is not None:
 		pool.close()
-		pool.join()
+	if plotter is not None:
+		plotter.close()
+		stdout.write("Waited {:.1f} seconds for plots to render\n".format(plotter.wait_time))
 
 	return thetas, M, W
 
-def draw_network(N, C, R, thetas, M, e, L_G, L_X, plot_directory):
-
-	_, h = hyperbolic_distance(R, thetas, M)
-	F = compute_F(h, M)
-	assignments = F.argmax(axis=1).A1
-	assignment_strength = F[np.arange(N), assignments].A1
-
-	node_cartesian = np.column_stack([np.multiply(R, np.cos(thetas)),
-	np.multiply(R, np.sin(thetas))])
-	community_cartesian = np.column_stack([np.multiply(M[0], np.cos(M[1])).T, 
-		np.multiply(M[0], np.sin(M[1])).T])
-
-	plt.figure(figsize=(15, 15))
-	plt.title("Epoch={}, L_G={}, L_X={}".format(e, L_G, L_X))
-	plt.scatter(node_cartesian[:,0].A1, node_cartesian[:,1].A1, 
-		c=assignments, s=100*assignment_strength)
-	plt.scatter(community_cartesian[:,0].A1, community_cartesian[:,1].A1, 
-		c=np.arange(C), s=100)
-	plt.scatter(community_cartesian[:,0].A1, community_cartesian[:,1].A1, 
-		c="k", s=25)
-	# plt.show()
-	plt.savefig(os.path.join(plot_directory, "epoch_{}.png".format(e)))
-	plt.close()
-
 def parse_args():
 
 	parser = argparse.ArgumentParser(description="Embed complex network to hyperbolic space.")
 	parser.add_argument("gml_file", metavar="gml_file_path",
-						help="path of gml file of network")
+						help="path of gml file or edge list (optionally gzipped) of network")
 	parser.add_argument("attribute_file", metavar="attribute_file", 
-						help="path of attribute file")
+						help="path of attribute csv file, SNAP .feat file or directory of SNAP .feat files")
 	parser.add_argument("num_communities", metavar="C", type=int,
 					help="number of communities")
+	parser.add_argument("--graph_cache", dest="graph_cache_directory",
+					help="directory of parsed graphs (default is .graph_cache next to the network file)", default=None)
+	parser.add_argument("--attribute_cache", dest="attribute_cache_directory",
+					help="directory of parsed attributes (default is .attribute_cache next to the attribute file)", default=None)
 	parser.add_argument("--T", dest="T", type=np.float,
 					help="network temperature (if this is not given, it is estimated)", default=None)
 	parser.add_argument("--gamma", dest="gamma", type=np.float,
@@ -883,7 +2076,78 @@ def parse_args():
 	parser.add_argument("--W", dest="W_filepath",
 			help="filepath of trained W matrix (default is \"W.csv\")", default="W.csv")
 	parser.add_argument("--plot", dest="plot_directory",
-				help="path of directory to save plots")
+				help="path of directory to save plots (default is no plots)", default=None)
+	parser.add_argument("--plot_interval", dest="plot_interval", type=int,
+				help="number of epochs between plots (default is 1)", default=1)
+	parser.add_argument("--plot_format", dest="plot_format", choices=["png", "coordinates"],
+				help="save plots as images (png) or as compressed co-ordinates to render later (default is png)", default="png")
+	parser.add_argument("--likelihood", dest="likelihood", choices=["dense", "sparse"],
+				help="compute likelihood of G over all node pairs (dense) or from the edges of G only (sparse) (default is dense)",
+				default="dense")
+	parser.add_argument("--num_negative_samples", dest="num_negative_samples", type=int,
+				help="number of sampled non-edges per node for sparse likelihood (default is to compute the non-edge term in closed form)",
+				default=None)
+	parser.add_argument("--attribute_likelihood", dest="attribute_likelihood", choices=["dense", "sparse"],
+				help="compute likelihood of X from dense Q (dense) or from the non-zero entries of X (sparse) (default is dense)",
+				default="dense")
+	parser.add_argument("--num_attribute_samples", dest="num_attribute_samples", type=int,
+				help="number of sampled attributes per node for sparse binary attribute likelihood (default is to compute Q in blocks)",
+				default=None)
+	parser.add_argument("--membership_tolerance", dest="membership_tolerance", type=np.float,
+				help="evaluate only the memberships F_uc that are at least this, found with an angular index (default is to evaluate all of F)",
+				default=None)
+	parser.add_argument("--membership_top_k", dest="membership_top_k", type=int,
+				help="evaluate only the k largest memberships of every node (of those above the membership tolerance, if given) (default is to evaluate all of F)",
+				default=None)
+	parser.add_argument("--support_interval", dest="support_interval", type=int,
+				help="number of steps between choosing the memberships to evaluate, every choice takes a pass over all node community pairs and memberships that grow in between are missed until the next one (default is {})".format(default_support_interval), default=default_support_interval)
+	parser.add_argument("--angular_bands", dest="num_angular_bands", type=int,
+				help="number of radial bands of the angular index (default is 8)", default=8)
+	parser.add_argument("--init", dest="init", choices=["auto", "eigsh", "lobpcg", "multilevel"],
+				help="eigensolver of the LaBNE initialisation of thetas (default is eigsh for graphs of up to 10000 nodes, multilevel LOBPCG otherwise)",
+				default="auto")
+	parser.add_argument("--init_thetas", dest="init_thetas_filepath",
+				help="csv file of thetas (as written by --thetas) to warm start the initialisation from (default is none)", default=None)
+	parser.add_argument("--dtype", dest="dtype", choices=["float32", "float64"],
+				help="precision of the parameters and of every array computed from them (default is float64)", default="float64")
+	parser.add_argument("-b", dest="batch_size", type=int,
+				help="number of node pairs and attribute rows per minibatch (default is full batch training)", default=None)
+	parser.add_argument("--sampler", dest="sampler", choices=["uniform", "edge"],
+				help="sample minibatch node pairs uniformly or half from edges and half from non-edges (default is edge)",
+				default="edge")
+	parser.add_argument("--steps_per_epoch", dest="steps_per_epoch", type=int,
+				help="number of minibatches per epoch (default is number of edges / minibatch size)", default=None)
+	parser.add_argument("--optimizer", dest="optimizer", choices=sorted(optimizers.keys()),
+				help="update rule (default is sgd)", default="sgd")
+	parser.add_argument("--momentum", dest="momentum", type=np.float,
+				help="momentum of sgd optimizer (default is 0)", default=0.)
+	for parameter in ("thetas", "r", "community_thetas", "sd", "W"):
+		parser.add_argument("--eta_{}".format(parameter), dest="eta_{}".format(parameter), type=np.float,
+				help="learning rate of {} (default is eta)".format(parameter), default=None)
+	parser.add_argument("--tolerance", dest="tolerance", type=np.float,
+				help="stop when relative change in loss is below tolerance for patience epochs (default is to never stop)", default=None)
+	parser.add_argument("--patience", dest="patience", type=int,
+				help="number of epochs for the loss tolerance (default is 10)", default=10)
+	parser.add_argument("--nmi_patience", dest="nmi_patience", type=int,
+				help="stop when NMI has not improved for nmi_patience epochs (requires -c)", default=None)
+	parser.add_argument("--max_hours", dest="max_hours", type=np.float,
+				help="stop after this many hours of training (default is no limit)", default=None)
+	parser.add_argument("--lr_schedule", dest="lr_schedule", choices=["constant", "step", "cosine", "plateau"],
+				help="learning rate schedule (default is constant)", default="constant")
+	parser.add_argument("--lr_step_size", dest="lr_step_size", type=int,
+				help="number of epochs between learning rate decays for step schedule (default is 100)", default=100)
+	parser.add_argument("--lr_factor", dest="lr_factor", type=np.float,
+				help="learning rate decay factor for step and plateau schedules (default is 0.5)", default=0.5)
+	parser.add_argument("--lr_patience", dest="lr_patience", type=int,
+				help="number of epochs without improvement before decay for plateau schedule (default is 10)", default=10)
+	parser.add_argument("--checkpoint", dest="checkpoint_filepath",
+				help="filepath of checkpoint to save during training (default is no checkpoints)", default=None)
+	parser.add_argument("--checkpoint_interval", dest="checkpoint_interval", type=int,
+				help="number of epochs between checkpoints (default is 1)", default=1)
+	parser.add_argument("--resume", action="store_true",
+				help="resume training from checkpoint if it exists")
+	parser.add_argument("--check_gradients", dest="check_gradients", action="store_true",
+				help="check closed form gradients against per element gradients before training")
 
 
 	args = parser.parse_args()
@@ -898,13 +2162,13 @@ def main():
 	gamma = args.gamma
 	T = args.T
 	stdout.write("Reading G from {} with scaling exponent={} and T={}\n".format(gml_file, gamma, T))
-	nodes, N, R, A, L = preprocess_G(gml_file, gamma, T)
+	nodes, N, R, A, L = preprocess_G(gml_file, gamma, T, args.graph_cache_directory)
 	stdout.write("Preprocessed G\n")
 
 	# X, true_communities = generate_X(N, K, attribute_file, order_of_appearance)
 	attribute_file = args.attribute_file
 	stdout.write("Reading attributes from {}\n".format(attribute_file))
-	X = preprocess_X(nodes, attribute_file)
+	X = preprocess_X(nodes, attribute_file, args.attribute_cache_directory)
 	stdout.write("Preprocessed X\n")
 
 	K = X.shape[1]
@@ -913,7 +2177,13 @@ def main():
 	C = args.num_communities
 	stdout.write("C={}\n".format(C))
 
-	thetas, M, W = initialize_matrices(L, N, C, K, R)
+	likelihood = args.likelihood
+	num_negative_samples = args.num_negative_samples
+
+	init_thetas = None
+	if args.init_thetas_filepath is not None:
+		init_thetas = pd.read_csv(args.init_thetas_filepath, header=None).values.ravel()
+	thetas, M, W = initialize_matrices(L, N, C, K, R, likelihood, args.init, init_thetas)
 	stdout.write("Initialized matrices\n")
 
 	eta = args.eta
@@ -925,16 +2195,56 @@ def main():
 	attribute_type = args.attribute_type
 	num_processes = args.num_processes
 	plot_directory = args.plot_directory
+	batch_size = args.batch_size
+	sampler = args.sampler
+	steps_per_epoch = args.steps_per_epoch
+
+	learning_rates = {parameter : getattr(args, "eta_{}".format(parameter))
+		for parameter in ("thetas", "r", "community_thetas", "sd", "W")
+		if getattr(args, "eta_{}".format(parameter)) is not None}
+	if args.optimizer == "sgd":
+		optimizer = SGD(eta, learning_rates, momentum=args.momentum)
+	else:
+		optimizer = optimizers[args.optimizer](eta, learning_rates)
 
-	stdout.write("Training with eta={}, num_epochs={}, lamb_F={}, lamb_W={}, alpha={}, attribute_type={}, num_processes={}\n".format(eta,	
-		num_epochs, lamb_F, lamb_W, alpha, attribute_type, num_processes))
+	schedule = LearningRateSchedule(args.lr_schedule, num_epochs, args.lr_step_size,
+		args.lr_factor, args.lr_patience)
+
+	stdout.write("Training with eta={}, num_epochs={}, lamb_F={}, lamb_W={}, alpha={}, attribute_type={}, num_processes={}, likelihood={}, num_negative_samples={}, batch_size={}, sampler={}, optimizer={}, learning_rates={}, lr_schedule={}, attribute_likelihood={}, membership_tolerance={}, membership_top_k={}, dtype={}\n".format(eta,	
+		num_epochs, lamb_F, lamb_W, alpha, attribute_type, num_processes, likelihood, num_negative_samples, batch_size, sampler,
+		args.optimizer, learning_rates, args.lr_schedule, args.attribute_likelihood, args.membership_tolerance, args.membership_top_k, args.dtype))
 	stdout.write("saving plots to {}\n".format(plot_directory))
 	stdout.flush()
+
+	if args.check_gradients:
+		check_gradients(N, K, C, A, X, R, thetas, M, W, alpha, lamb_F, lamb_W, attribute_type)
+		stdout.write("Checked gradients\n")
+
+	max_time = args.max_hours * 3600 if args.max_hours is not None else None
+	early_stopping = EarlyStopping(args.tolerance, args.patience, args.nmi_patience, max_time)
+
+	checkpoint_filepath = args.checkpoint_filepath
+	checkpoint = None
+	if args.resume:
+		if checkpoint_filepath is not None and os.path.exists(checkpoint_filepath):
+			stdout.write("Loading checkpoint from {}\n".format(checkpoint_filepath))
+			checkpoint = load_checkpoint(checkpoint_filepath)
+		else:
+			stdout.write("No checkpoint found at {}, training from scratch\n".format(checkpoint_filepath))
+
 	thetas, M, W = train(A, X, N, K, C, R, thetas, M, W, 
 		eta=eta, lamb_F=lamb_F, lamb_W=lamb_W, alpha=alpha, 
 		num_epochs=num_epochs, true_communities=true_communities, 
 		attribute_type=attribute_type, num_processes=num_processes,
-		plot_directory=plot_directory)
+		plot_directory=plot_directory, likelihood=likelihood, num_negative_samples=num_negative_samples,
+		batch_size=batch_size, sampler=sampler, steps_per_epoch=steps_per_epoch, optimizer=optimizer,
+		early_stopping=early_stopping, schedule=schedule, checkpoint_filepath=checkpoint_filepath,
+		checkpoint_interval=args.checkpoint_interval, checkpoint=checkpoint,
+		plot_interval=args.plot_interval, plot_format=args.plot_format,
+		attribute_likelihood=args.attribute_likelihood, num_attribute_samples=args.num_attribute_samples,
+		membership_tolerance=args.membership_tolerance, num_angular_bands=args.num_angular_bands,
+		membership_top_k=args.membership_top_k, support_interval=args.support_interval,
+		dtype=np.dtype(args.dtype))
 
 	stdout.write("Trained matrices\n") 
 
@@ -1,4 +1,5 @@
 import os
+import time
 
 import matplotlib
 matplotlib.use("Agg")
@@ -18,47 +19,98 @@ from sklearn.metrics import normalized_mutual_info_score as NMI
 
 import powerlaw
 
-import matplotlib.pyplot as plt
+from plotting import Plotter
+from graph_cache import load_graph, radial_coordinates
+from attribute_cache import load_attributes, select_rows
+from training import EarlyStopping, LearningRateSchedule
+from training import prefixed, unprefixed_list, save_checkpoint_arrays, load_checkpoint, restore_states
+from pair_sampler import PairSampler, PrefetchingSampler
 
 from keras import backend as K
 from keras.engine.topology import Layer
 from keras.initializers import uniform
+from keras import initializers
 from keras.models import Model
-from keras.layers import Input, Dense
+from keras.layers import Input, Dense, Activation
 from keras import regularizers
 from keras import constraints
 from keras.regularizers import l1
 from keras.constraints import NonNeg
 from keras.optimizers import Adam
-from keras.callbacks import History
+from keras.callbacks import Callback
 # def theta_initilizer(shape, dtype, **kwargs):
 # 	return
 
+# names of the outputs of the trainable model: edge probability of (u, v) and attributes of u and v
+output_names = ("P", "Q_u", "Q_v")
+# number of pairs of an epoch unless the number of steps is given (1000 minibatches of the default size)
+pairs_per_epoch = 100000
+# minibatch size that the learning rate of the optimizer is tuned for
+reference_batch_size = 100
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+	'''
+	replace the session of the tensorflow backend by one that runs every operation on intra_op_threads
+	threads and inter_op_threads operations at a time (None is the tensorflow default of all cores),
+	before any model is built
+	'''
+	if intra_op_threads is None and inter_op_threads is None:
+		return
+	assert K.backend() == "tensorflow", "thread counts need the tensorflow backend"
+	import tensorflow as tf
+	K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+		inter_op_parallelism_threads=inter_op_threads or 0)))
+
+def learning_rate_scale(batch_size, lr_scaling="none"):
+	'''
+	factor of the learning rate for minibatches of batch_size pairs relative to reference_batch_size:
+	batch_size / reference_batch_size (linear), its square root (sqrt) or 1 (none)
+	'''
+	ratio = float(batch_size) / reference_batch_size
+	if lr_scaling == "linear":
+		return ratio
+	if lr_scaling == "sqrt":
+		return np.sqrt(ratio)
+	return 1.0
+
 def M_initializer(shape, dtype=None):
 	r = K.random_normal((1, shape[1]), mean=10, stddev=1e-2, dtype=dtype)
 	thetas = K.random_uniform((1, shape[1]), maxval=2*np.pi, dtype=dtype)
 	sd = K.random_normal((1, shape[1]), mean=3, stddev=1e-2, dtype=dtype)
 	return K.concatenate([r, thetas, sd], axis=0)
 
-class ThetaLookupLayer(Layer):
+class NodeLookupLayer(Layer):
+	'''
+	one value per node, gathered by the integer node indices of the input (shape (batch, 1)),
+	so that a batch costs O(batch) rather than a product with one hot rows of the identity
+	'''
 
-	def __init__(self, **kwargs):
-		self.output_dim=1
-		super(ThetaLookupLayer, self).__init__(**kwargs)
+	def __init__(self, N, initializer="zeros", **kwargs):
+		self.N = N
+		self.output_dim = 1
+		self.initializer = initializers.get(initializer)
+		super(NodeLookupLayer, self).__init__(**kwargs)
 
 	def build(self, input_shape):
-		# Create a trainable weight variable for this layer.
-		self.kernel = self.add_weight(name='theta_lookup_matrix', 
-									  shape=(input_shape[1], self.output_dim),
-									  initializer=uniform(maxval=2*np.pi),
-									  trainable=True)
-		super(ThetaLookupLayer, self).build(input_shape)  # Be sure to call this somewhere!
+		self.kernel = self.add_weight(name='lookup_vector', 
+									  shape=(self.N, self.output_dim),
+									  initializer=self.initializer,
+									  trainable=self.trainable)
+		super(NodeLookupLayer, self).build(input_shape)  # Be sure to call this somewhere!
 
 	def call(self, x):
-		return K.dot(x, self.kernel)
+		return K.gather(self.kernel, K.flatten(K.cast(x, "int32")))
 
 	def compute_output_shape(self, input_shape):
 		return (input_shape[0], self.output_dim)
+
+	def get_config(self):
+		config = {
+			'N': self.N,
+			'initializer': initializers.serialize(self.initializer),
+		}
+		base_config = super(NodeLookupLayer, self).get_config()
+		return dict(list(base_config.items()) + list(config.items()))
 	
 class FLayer(Layer):
 
@@ -112,28 +164,36 @@ class PLayer(Layer):
 	def compute_output_shape(self, input_shape):
 		return (None, self.output_dim)
 
-def build_model(N, K, C, lamb_F=1e-2, lamb_W=1e-2, alpha=0.5, attribute_type="binary"):
+def build_model(N, K, C, R, lamb_F=1e-2, lamb_W=1e-2, alpha=0.5, attribute_type="binary"):
+	'''
+	trainable model of the edge and attributes of pairs of nodes u and v
+	and community assignment model of the memberships of nodes u
 
+	both take integer node indices: thetas are trainable and R is a fixed (non trainable)
+	weight of the model, looked up per node
+	'''
 	
-	u = Input(shape=(N,))
-	v = Input(shape=(N,))
-	
-	r_u = Input(shape=(1,))
-	r_v = Input(shape=(1,))
+	u = Input(shape=(1,), dtype="int32")
+	v = Input(shape=(1,), dtype="int32")
 
-	theta_lookup = ThetaLookupLayer()
+	theta_lookup = NodeLookupLayer(N, uniform(maxval=2*np.pi), name="theta_lookup")
+	r_lookup = NodeLookupLayer(N, trainable=False, name="r_lookup")
 	
 	theta_u = theta_lookup(u)
 	theta_v = theta_lookup(v)
 	
-	F = FLayer(C, 
+	r_u = r_lookup(u)
+	r_v = r_lookup(v)
+	r_lookup.set_weights([np.asarray(R).reshape(N, 1)])
+	
+	F = FLayer(C, name="F",
 		# activity_regularizer=l1(lamb_F), kernel_constraint=NonNeg()
 		)
 	
 	F_u = F([theta_u, r_u])
 	F_v = F([theta_v, r_v])
 	
-	P_uv = PLayer()([F_u, F_v])
+	P_uv = PLayer(name=output_names[0])([F_u, F_v])
 	
 	if attribute_type == "binary":
 		activation = "sigmoid"
@@ -144,8 +204,9 @@ def build_model(N, K, C, lamb_F=1e-2, lamb_W=1e-2, alpha=0.5, attribute_type="bi
 		# kernel_regularizer=l1(lamb_W), bias_regularizer=l1(lamb_W)
 		)
 	
-	Q_u = Q(F_u)
-	Q_v = Q(F_v)
+	# Q is shared, so its outputs are named by identity layers
+	Q_u = Activation("linear", name=output_names[1])(Q(F_u))
+	Q_v = Activation("linear", name=output_names[2])(Q(F_v))
 
 	loss = ["binary_crossentropy"]
 	if attribute_type == "binary":
@@ -153,14 +214,14 @@ def build_model(N, K, C, lamb_F=1e-2, lamb_W=1e-2, alpha=0.5, attribute_type="bi
 	else:
 		loss += ["mse"] * 2
 
-	trainable_model = Model([u, v, r_u, r_v], [P_uv, Q_u, Q_v], name="trainable_model")
+	trainable_model = Model([u, v], [P_uv, Q_u, Q_v], name="trainable_model")
 
 
 	adam = Adam(clipnorm=1.0)
 	trainable_model.compile(optimizer=adam, loss=loss, 
 		loss_weights=[1-alpha, alpha, alpha], )
 
-	community_assignment_model = Model([u, r_u], F_u, name="community_assignment_model")
+	community_assignment_model = Model(u, F_u, name="community_assignment_model")
 	
 	return trainable_model, community_assignment_model
 
@@ -174,38 +235,300 @@ def save_trained_models(models):
 
 		model.save_weights("models/{}_weights.h5".format(model.name))
 
-def input_pattern_generator(N, R, A, X, batch_size=100):
-	
-	I = np.identity(N)
-	
-	while True:
-		
-		U = np.random.choice(N, replace=True, size=(batch_size,))
-		V = np.random.choice(N, replace=True, size=(batch_size,))
-		
-		yield [I[U], I[V], R[U], R[V]], [A[U, V].T, X[U].todense(), X[V].todense()]
+def top_memberships(F, top_k):
+	'''
+	communities of the top_k largest memberships of every row of F,
+	in decreasing order of membership, and those memberships
+	'''
+	top_k = min(top_k, F.shape[1])
+	rows = np.arange(F.shape[0])[:, None]
+	communities = np.argpartition(-F, top_k - 1, axis=1)[:, :top_k]
+	communities = communities[rows, np.argsort(-F[rows, communities], axis=1)]
+	return communities, F[rows, communities]
 
-def train_model(N, C, R, A, X, trainable_model, community_assignment_model, 
-	num_epochs=10000, batch_size=100, true_communities=None, plot_directory=None):
-	
-	callback = History()
-	generator = input_pattern_generator(N, R, A, X, batch_size)
-
-	for epoch in range(num_epochs):
-		trainable_model.fit_generator(generator, steps_per_epoch=1000, epochs=1, verbose=0, callbacks=[callback])
-		P_loss = callback.history["p_layer_1_loss"]
-		Q_loss = callback.history["Q_loss_1"]
-		assert not np.isnan(P_loss).any(), "P loss is nan"
-		assert not np.isnan(Q_loss).any(), "Q loss is nan"
-		if true_communities is not None:
-			community_predictions = community_assignment_model.predict([np.identity(N), R])
-			community_membership_predictions = np.argmax(community_predictions, axis=1)
-			stdout.write("NMI: {}\n".format(NMI(true_communities, community_membership_predictions)))
-		if epoch % 10 == 0:
-			draw_network(epoch, trainable_model, community_assignment_model, P_loss, Q_loss, N, C, R, plot_directory)
-		stdout.write("Epoch {} complete, P_loss: {} Q_loss: {}\n".format(epoch, P_loss, Q_loss))
+def predict_communities(community_assignment_model, N, batch_size=10000, top_k=None, filepath=None):
+	'''
+	memberships F of all N nodes, predicted batch_size nodes at a time so that no more than
+	(batch_size, C) memberships are held at once besides the result
+
+	returns F, or with top_k the communities of the top_k largest memberships of every node
+	and those memberships (see top_memberships, top_k=1 is the argmax)
+
+	if filepath is given, the rows of every batch (communities followed by memberships with top_k)
+	are appended to that csv file as soon as they are predicted and nothing is returned
+	'''
+	if filepath is not None:
+		open(filepath, "w").close()
+	results = []
+	for start in range(0, N, batch_size):
+		stop = min(start + batch_size, N)
+		F = community_assignment_model.predict_on_batch(np.arange(start, stop).reshape(-1, 1))
+		result = (F, ) if top_k is None else top_memberships(F, top_k)
+		if filepath is not None:
+			with open(filepath, "a") as f:
+				pd.concat([pd.DataFrame(array) for array in result], axis=1).to_csv(f, sep=",", 
+					index=False, header=False)
+		else:
+			results.append(result)
+
+	if filepath is not None:
+		return None
+	results = [np.concatenate(arrays) for arrays in zip(*results)]
+	return results[0] if top_k is None else tuple(results)
+
+def save_checkpoint(filepath, epoch, loss, seed, trainable_model, early_stopping, schedule):
+	'''
+	atomically write everything needed to resume training from epoch to a compressed npz file:
+	weights of the model and its optimizer, loss, seed of the input patterns
+	and state of early stopping and learning rate schedule
+	'''
+	checkpoint = {"epoch" : epoch, "loss" : loss, "seed" : seed}
+	checkpoint.update(prefixed("weights", trainable_model.get_weights()))
+	checkpoint.update(prefixed("optimizer", trainable_model.optimizer.get_weights()))
+	save_checkpoint_arrays(filepath, checkpoint, (("early_stopping", early_stopping), ("schedule", schedule)))
+
+def restore_checkpoint(checkpoint, trainable_model, early_stopping, schedule):
+	'''
+	restore weights of the model and its optimizer, early stopping and learning rate schedule 
+	from checkpoint, returns epoch, loss and seed
+	'''
+	trainable_model.set_weights(unprefixed_list(checkpoint, "weights"))
+	# optimizer weights are only created with the training function
+	trainable_model._make_train_function()
+	trainable_model.optimizer.set_weights(unprefixed_list(checkpoint, "optimizer"))
+	restore_states(checkpoint, (("early_stopping", early_stopping), ("schedule", schedule)))
+	return int(checkpoint["epoch"]), float(checkpoint["loss"]), int(checkpoint["seed"])
+
+class LearningRateCallback(Callback):
+	'''
+	set the learning rate at the start of every epoch to lr scaled by schedule,
+	given the loss of the last epoch, and ramp it up linearly over the first warmup_steps steps
+	'''
+
+	def __init__(self, schedule, lr, loss=None, warmup_steps=0, steps_per_epoch=1000):
+		super(LearningRateCallback, self).__init__()
+		self.schedule = schedule
+		self.lr = lr
+		self.loss = loss
+		self.warmup_steps = warmup_steps
+		self.steps_per_epoch = steps_per_epoch
+
+	def on_epoch_begin(self, epoch, logs=None):
+		self.epoch = epoch
+		self.epoch_lr = self.lr * self.schedule.scale(epoch, self.loss)
+		K.set_value(self.model.optimizer.lr, self.epoch_lr)
+
+	def on_batch_begin(self, batch, logs=None):
+		step = self.epoch * self.steps_per_epoch + batch
+		if step < self.warmup_steps:
+			K.set_value(self.model.optimizer.lr, self.epoch_lr * min(1.0, (step + 1.0) / self.warmup_steps))
+
+	def on_epoch_end(self, epoch, logs=None):
+		self.loss = logs["loss"]
+
+class ThroughputCallback(Callback):
+	'''
+	time the training steps of every epoch and add steps and samples (pairs) per second
+	and the time spent between steps (waiting for minibatches) to the logs of the epoch,
+	samples per second of the whole run are logged at the end of training
+	'''
+
+	def __init__(self, batch_size):
+		super(ThroughputCallback, self).__init__()
+		self.batch_size = batch_size
+		self.total_step_time = 0
+		self.total_steps = 0
+
+	def on_epoch_begin(self, epoch, logs=None):
+		self.epoch_start_time = time.time()
+		self.step_time = 0
+		self.num_steps = 0
+
+	def on_batch_begin(self, batch, logs=None):
+		self.step_start_time = time.time()
+
+	def on_batch_end(self, batch, logs=None):
+		self.step_time += time.time() - self.step_start_time
+		self.num_steps += 1
+
+	def on_epoch_end(self, epoch, logs=None):
+		step_time = max(self.step_time, 1e-12)
+		logs["steps_per_second"] = self.num_steps / step_time
+		logs["samples_per_second"] = self.num_steps * self.batch_size / step_time
+		logs["wait_time"] = time.time() - self.epoch_start_time - self.step_time
+		self.total_step_time += self.step_time
+		self.total_steps += self.num_steps
+
+	def on_train_end(self, logs=None):
+		if self.total_steps > 0:
+			stdout.write("Trained on {} samples in minibatches of {} at {:.0f} samples/s ({:.1f} seconds of steps)\n".format(
+				self.total_steps * self.batch_size, self.batch_size,
+				self.total_steps * self.batch_size / max(self.total_step_time, 1e-12), self.total_step_time))
+
+class LossCallback(Callback):
+	'''
+	fail on a nan loss and log the losses and throughput of every epoch
+	'''
+
+	def on_epoch_end(self, epoch, logs=None):
+		for name in output_names:
+			assert not np.isnan(logs[name + "_loss"]), "{} loss is nan".format(name)
+		stdout.write("Epoch {} complete, {}".format(epoch, " ".join("{}_loss: {}".format(name,
+			logs[name + "_loss"]) for name in output_names)))
+		if "steps_per_second" in logs:
+			stdout.write(", {:.1f} steps/s ({:.0f} samples/s), {:.1f} seconds waiting for minibatches".format(
+				logs["steps_per_second"], logs["samples_per_second"], logs["wait_time"]))
+		stdout.write("\n")
 		stdout.flush()
 
+class NMICallback(Callback):
+	'''
+	add NMI of the argmax of the memberships predicted by community_assignment_model
+	(eval_batch_size nodes at a time) to the logs of every eval_interval epochs
+	'''
+
+	def __init__(self, community_assignment_model, N, true_communities, eval_interval=1, eval_batch_size=10000):
+		super(NMICallback, self).__init__()
+		self.community_assignment_model = community_assignment_model
+		self.N = N
+		self.true_communities = true_communities
+		self.eval_interval = eval_interval
+		self.eval_batch_size = eval_batch_size
+
+	def on_epoch_end(self, epoch, logs=None):
+		if epoch % self.eval_interval != 0:
+			return
+		community_membership_predictions, _ = predict_communities(self.community_assignment_model, self.N,
+			self.eval_batch_size, top_k=1)
+		logs["nmi"] = NMI(self.true_communities, community_membership_predictions.ravel())
+		stdout.write("NMI: {}\n".format(logs["nmi"]))
+
+class PlotCallback(Callback):
+	'''
+	pass the embedding and memberships to plotter every plotter.interval epochs
+	'''
+
+	def __init__(self, plotter, community_assignment_model, N, eval_batch_size=10000):
+		super(PlotCallback, self).__init__()
+		self.plotter = plotter
+		self.community_assignment_model = community_assignment_model
+		self.N = N
+		self.eval_batch_size = eval_batch_size
+
+	def on_epoch_end(self, epoch, logs=None):
+		if epoch % self.plotter.interval != 0:
+			return
+		community_predictions = predict_communities(self.community_assignment_model, self.N, self.eval_batch_size)
+		thetas = self.model.get_layer("theta_lookup").get_weights()[0]
+		M = self.model.get_layer("F").get_weights()[0]
+		self.plotter.plot(epoch, thetas, M, community_predictions,
+			**{name + "_loss" : logs[name + "_loss"] for name in output_names})
+
+	def on_train_end(self, logs=None):
+		self.plotter.close()
+		stdout.write("Waited {:.1f} seconds for plots to render\n".format(self.plotter.wait_time))
+
+class EarlyStoppingCallback(Callback):
+	'''
+	stop training when early_stopping decides to, given the loss and NMI (if evaluated) of the epoch
+	'''
+
+	def __init__(self, early_stopping, initial_epoch, num_epochs):
+		super(EarlyStoppingCallback, self).__init__()
+		self.early_stopping = early_stopping
+		self.num_trained_epochs = initial_epoch
+		self.stop_reason = "reached {} epochs".format(num_epochs)
+
+	def on_epoch_end(self, epoch, logs=None):
+		self.num_trained_epochs = epoch + 1
+		reason = self.early_stopping.check(logs["loss"], logs.get("nmi"))
+		if reason is not None:
+			self.stop_reason = reason
+			self.model.stop_training = True
+
+class CheckpointCallback(Callback):
+	'''
+	save a checkpoint (see save_checkpoint) to filepath every interval epochs,
+	after the last epoch and when training is stopped early
+	'''
+
+	def __init__(self, filepath, interval, num_epochs, seed, early_stopping, schedule):
+		super(CheckpointCallback, self).__init__()
+		self.filepath = filepath
+		self.interval = interval
+		self.num_epochs = num_epochs
+		self.seed = seed
+		self.early_stopping = early_stopping
+		self.schedule = schedule
+
+	def on_epoch_end(self, epoch, logs=None):
+		if (self.model.stop_training or (epoch + 1) % self.interval == 0 
+			or epoch + 1 == self.num_epochs):
+			save_checkpoint(self.filepath, epoch + 1, logs["loss"], self.seed, self.model,
+				self.early_stopping, self.schedule)
+			stdout.write("Saved checkpoint to {}\n".format(self.filepath))
+
+def train_model(N, C, R, A, X, trainable_model, community_assignment_model, 
+	num_epochs=10000, batch_size=100, true_communities=None, plot_directory=None,
+	early_stopping=None, schedule=None, checkpoint_filepath=None, checkpoint_interval=1, checkpoint=None,
+	plot_interval=10, plot_format="png", eval_interval=1, eval_batch_size=10000,
+	sampler="uniform", num_sampler_workers=1, sampler_queue_depth=10, sampler_processes=False,
+	steps_per_epoch=None, warmup_steps=0):
+	'''
+	train for num_epochs of steps_per_epoch minibatches (default is pairs_per_epoch pairs)
+	in a single call of fit_generator, with the learning rate warmed up over warmup_steps, NMI (given true_communities)
+	evaluated every eval_interval epochs from the argmax of the memberships predicted eval_batch_size
+	nodes at a time, and everything else done between epochs by callbacks
+
+	minibatches are sampled by sampler (see PairSampler) ahead of training by num_sampler_workers
+	threads or processes, sampler_queue_depth at a time (see PrefetchingSampler)
+	'''
+
+	if early_stopping is None:
+		early_stopping = EarlyStopping()
+	if schedule is None:
+		schedule = LearningRateSchedule()
+	lr = K.get_value(trainable_model.optimizer.lr)
+	loss = None
+
+	initial_epoch = 0
+	# input patterns of every epoch are drawn from their own random state
+	# so that they do not depend on how far the generator was read ahead
+	seed = np.random.randint(2 ** 31)
+	if checkpoint is not None:
+		initial_epoch, loss, seed = restore_checkpoint(checkpoint, trainable_model, early_stopping, schedule)
+		stdout.write("Resuming from epoch {}\n".format(initial_epoch))
+
+	pair_sampler = PrefetchingSampler(PairSampler(A, X, batch_size, sampler), num_sampler_workers,
+		sampler_queue_depth, sampler_processes)
+
+	if steps_per_epoch is None:
+		steps_per_epoch = max(1, pairs_per_epoch // batch_size)
+	stdout.write("Training on {} minibatches of {} pairs per epoch\n".format(steps_per_epoch, batch_size))
+
+	early_stopping_callback = EarlyStoppingCallback(early_stopping, initial_epoch, num_epochs)
+	callbacks = [LearningRateCallback(schedule, lr, loss, warmup_steps, steps_per_epoch),
+		ThroughputCallback(batch_size), LossCallback()]
+	if true_communities is not None:
+		callbacks.append(NMICallback(community_assignment_model, N, true_communities, eval_interval,
+			eval_batch_size))
+	if plot_directory is not None:
+		plotter = Plotter(plot_directory, N, C, R, plot_interval, plot_format)
+		callbacks.append(PlotCallback(plotter, community_assignment_model, N, eval_batch_size))
+	callbacks.append(early_stopping_callback)
+	if checkpoint_filepath is not None:
+		callbacks.append(CheckpointCallback(checkpoint_filepath, checkpoint_interval, num_epochs, seed,
+			early_stopping, schedule))
+
+	trainable_model.fit_generator(pair_sampler.batches(seed, initial_epoch, steps_per_epoch),
+		steps_per_epoch=steps_per_epoch, epochs=num_epochs, initial_epoch=initial_epoch, verbose=0,
+		callbacks=callbacks)
+	pair_sampler.close()
+
+	stdout.write("Training stopped after {} epochs ({:.1f} seconds): {}\n".format(
+		early_stopping_callback.num_trained_epochs, time.time() - early_stopping.start_time,
+		early_stopping_callback.stop_reason))
+
 def estimate_T():
 	'''
 	TODO
@@ -219,23 +542,11 @@ def estimate_gamma(degrees):
 	result = powerlaw.Fit(degrees)
 	return result.power_law.alpha
 
-def preprocess_G(gml_file, gamma, T):
+def preprocess_G(gml_file, gamma, T, cache_directory=None):
 
-	G = nx.read_gml(gml_file)
-	G = max(nx.connected_component_subgraphs(G), key=len)
+	nodes, A, degrees, L = load_graph(gml_file, cache_directory)
 
-	N = nx.number_of_nodes(G)
-
-	degree_dict = nx.degree(G)
-	
-	# node id
-	order_of_appearance = np.array(sorted(degree_dict, key=degree_dict.get, reverse=True))
-	nodes = np.array(G.nodes())
-	# node index
-	order_of_appearance = np.concatenate([np.where(order_of_appearance==n)[0]
-		for n in nodes])
-
-	degrees = np.array(degree_dict.values())
+	N = len(nodes)
 
 	# PS model parameters -- to estimate in real world network
 	m = degrees.mean() / 2
@@ -250,74 +561,33 @@ def preprocess_G(gml_file, gamma, T):
 	stdout.write("m={}, T={}, gamma={}, beta={}\n".format(m, T, gamma, beta))
 
 	# determine radial coordinates of nodes
-	R = 2 * beta * np.log(range(1, N + 1)) + 2 * (1 - beta) * np.log(N) 
-	R = np.matrix(R[order_of_appearance]).T
-
-	# observed adjacency matrix
-	A = nx.adjacency_matrix(G)
-
-	L = nx.laplacian_matrix(G).asfptype()
+	R = np.matrix(radial_coordinates(degrees, gamma)).T
 
 	return nodes, N, R, A, L
 
-def preprocess_X(nodes, attribute_file):
-	attr_df = pd.read_csv(attribute_file, index_col=0,)
-	return sp.sparse.csr_matrix(attr_df.iloc[nodes, :].values)
+def preprocess_X(nodes, attribute_file, cache_directory=None):
+	index, X = load_attributes(attribute_file, cache_directory)
+	return X[select_rows(nodes, index)]
 
 def preprocess_true_communities(nodes, true_community_file):
 	if true_community_file == None:
 		return None
 	community_df = pd.read_csv(true_community_file, header=None, index_col=0, sep=" ")
-	return community_df.iloc[nodes, 0].values
-
-def draw_network(epoch, trainable_model, community_assignment_model, P_loss, Q_loss, N, C, R, plot_directory):
-	'''
-	TODO
-	'''
-	thetas = trainable_model.layers[2].get_weights()[0]
-	M = trainable_model.layers[5].get_weights()[0]
-	W = np.vstack(trainable_model.layers[7].get_weights())
-	F = community_assignment_model.predict([np.identity(N), R])
-	
-	assignments = F.argmax(axis=1)
-	assignment_strength = F[np.arange(N), assignments]
-
-	node_cartesian = np.column_stack([np.multiply(R, np.cos(thetas)),
-	np.multiply(R, np.sin(thetas))])
-	community_cartesian = np.column_stack([np.multiply(M[0], np.cos(M[1])), 
-		np.multiply(M[0], np.sin(M[1]))])
-
-	# print type(node_cartesian)
-	# print node_cartesian.shape
-	# print node_cartesian[:,0].shape
-	# print assignments.shape
-	# print assignment_strength.shape
-
-	colours = np.random.rand(C, 3)
-	# c = colours[assignments]
-	# print c.shape
-
-	plt.figure(figsize=(15, 15))
-	plt.title("Epoch={} P_loss={} Q_loss={}".format(epoch, P_loss, Q_loss))
-	plt.scatter(node_cartesian[:,0].A1, node_cartesian[:,1].A1, 
-		c=colours[assignments], s=100*assignment_strength)
-	plt.scatter(community_cartesian[:,0], community_cartesian[:,1], 
-		c=colours, s=100)
-	plt.scatter(community_cartesian[:,0], community_cartesian[:,1], 
-		c="k", s=25)
-	# plt.show()
-	plt.savefig(os.path.join(plot_directory, "epoch_{}.png".format(epoch)))
-	plt.close()
+	return community_df.iloc[select_rows(nodes, community_df.index, "true communities"), 0].values
 
 def parse_args():
 
 	parser = argparse.ArgumentParser(description="Embed complex network to hyperbolic space.")
 	parser.add_argument("gml_file", metavar="gml_file_path",
-						help="path of gml file of network")
+						help="path of gml file or edge list (optionally gzipped) of network")
 	parser.add_argument("attribute_file", metavar="attribute_file", 
-						help="path of attribute file")
+						help="path of attribute csv file, SNAP .feat file or directory of SNAP .feat files")
 	parser.add_argument("num_communities", metavar="C", type=int,
 					help="number of communities")
+	parser.add_argument("--graph_cache", dest="graph_cache_directory",
+					help="directory of parsed graphs (default is .graph_cache next to the network file)", default=None)
+	parser.add_argument("--attribute_cache", dest="attribute_cache_directory",
+					help="directory of parsed attributes (default is .attribute_cache next to the attribute file)", default=None)
 	parser.add_argument("--T", dest="T", type=np.float,
 					help="network temperature (if this is not given, it is estimated)", default=None)
 	parser.add_argument("--gamma", dest="gamma", type=np.float,
@@ -329,6 +599,24 @@ def parse_args():
 					help="number of epochs to train for (default is 10000)", default=10000)
 	parser.add_argument("-b", dest="batch_size", type=int,
 					help="minibatch_size (default is 100)", default=100)
+	parser.add_argument("--steps_per_epoch", dest="steps_per_epoch", type=int,
+					help="number of minibatches per epoch (default is 100000 pairs per epoch, 1000 minibatches of 100)", default=None)
+	parser.add_argument("--lr_scaling", dest="lr_scaling", choices=["none", "linear", "sqrt"],
+					help="scale the learning rate by the minibatch size over 100 (linear) or its square root (sqrt) (default is none)", default="none")
+	parser.add_argument("--lr_warmup_steps", dest="lr_warmup_steps", type=int,
+					help="number of steps to increase the learning rate linearly over at the start of training (default is 0)", default=0)
+	parser.add_argument("--intra_op_threads", dest="intra_op_threads", type=int,
+					help="number of threads of every tensorflow operation (default is all cores)", default=None)
+	parser.add_argument("--inter_op_threads", dest="inter_op_threads", type=int,
+					help="number of tensorflow operations run in parallel (default is all cores)", default=None)
+	parser.add_argument("--sampler", dest="sampler", choices=["uniform", "edge", "degree"],
+					help="sample pairs uniformly, half from the edges and half uniformly (edge) or half from the edges and half in proportion to degree (degree) (default is uniform), pairs and nodes are importance weighted so the losses estimate those over all pairs and nodes", default="uniform")
+	parser.add_argument("--sampler_workers", dest="num_sampler_workers", type=int,
+					help="number of threads (or processes) sampling minibatches ahead of training, 0 samples in the training loop (default is 1)", default=1)
+	parser.add_argument("--sampler_queue_depth", dest="sampler_queue_depth", type=int,
+					help="number of minibatches sampled ahead of training (default is 10)", default=10)
+	parser.add_argument("--sampler_processes", action="store_true",
+					help="sample minibatches in processes rather than threads")
 	parser.add_argument("--lamb_F", dest="lamb_F", type=np.float,
 					help="l1 penalty on F (default is 0.01) (default is 1e-2)", default=1e-2)
 	parser.add_argument("--lamb_W", dest="lamb_W", type=np.float,
@@ -348,7 +636,39 @@ def parse_args():
 	parser.add_argument("--F", dest="F_filepath",
 			help="filepath of trained F matrix (default is \"F.csv\")", default="F.csv")
 	parser.add_argument("--plot", dest="plot_directory",
-				help="path of directory to save plots")
+				help="path of directory to save plots (default is no plots)", default=None)
+	parser.add_argument("--plot_interval", dest="plot_interval", type=int,
+				help="number of epochs between plots (default is 10)", default=10)
+	parser.add_argument("--plot_format", dest="plot_format", choices=["png", "coordinates"],
+				help="save plots as images (png) or as compressed co-ordinates to render later (default is png)", default="png")
+	parser.add_argument("--tolerance", dest="tolerance", type=np.float,
+				help="stop when relative change in loss is below tolerance for patience epochs (default is to never stop)", default=None)
+	parser.add_argument("--patience", dest="patience", type=int,
+				help="number of epochs for the loss tolerance (default is 10)", default=10)
+	parser.add_argument("--nmi_patience", dest="nmi_patience", type=int,
+				help="stop when NMI has not improved for nmi_patience evaluations (requires -c)", default=None)
+	parser.add_argument("--eval_interval", dest="eval_interval", type=int,
+				help="number of epochs between evaluations of NMI (default is 1)", default=1)
+	parser.add_argument("--eval_batch_size", dest="eval_batch_size", type=int,
+				help="number of nodes to predict memberships of at a time (default is 10000)", default=10000)
+	parser.add_argument("--F_top_k", dest="F_top_k", type=int,
+				help="write only the top k communities of every node followed by their memberships to the F file (default is all memberships)", default=None)
+	parser.add_argument("--max_hours", dest="max_hours", type=np.float,
+				help="stop after this many hours of training (default is no limit)", default=None)
+	parser.add_argument("--lr_schedule", dest="lr_schedule", choices=["constant", "step", "cosine", "plateau"],
+				help="learning rate schedule (default is constant)", default="constant")
+	parser.add_argument("--lr_step_size", dest="lr_step_size", type=int,
+				help="number of epochs between learning rate decays for step schedule (default is 100)", default=100)
+	parser.add_argument("--lr_factor", dest="lr_factor", type=np.float,
+				help="learning rate decay factor for step and plateau schedules (default is 0.5)", default=0.5)
+	parser.add_argument("--lr_patience", dest="lr_patience", type=int,
+				help="number of epochs without improvement before decay for plateau schedule (default is 10)", default=10)
+	parser.add_argument("--checkpoint", dest="checkpoint_filepath",
+				help="filepath of checkpoint to save during training (default is no checkpoints)", default=None)
+	parser.add_argument("--checkpoint_interval", dest="checkpoint_interval", type=int,
+				help="number of epochs between checkpoints (default is 1)", default=1)
+	parser.add_argument("--resume", action="store_true",
+				help="resume training from checkpoint if it exists")
 
 
 	args = parser.parse_args()
@@ -364,17 +684,17 @@ def main():
 	gamma = args.gamma
 	T = args.T
 	stdout.write("Reading G from {} with scaling exponent={} and T={}\n".format(gml_file, gamma, T))
-	nodes, N, R, A, L = preprocess_G(gml_file, gamma, T)
+	nodes, N, R, A, L = preprocess_G(gml_file, gamma, T, args.graph_cache_directory)
 	stdout.write("Preprocessed G\n")
 
 	# X, true_communities = generate_X(N, K, attribute_file, order_of_appearance)
 	attribute_file = args.attribute_file
 	stdout.write("Reading attributes from {}\n".format(attribute_file))
-	X = preprocess_X(nodes, attribute_file)
+	X = preprocess_X(nodes, attribute_file, args.attribute_cache_directory)
 	stdout.write("Preprocessed X\n")
 
-	K = X.shape[1]
-	stdout.write("K={}\n".format(K))
+	num_attributes = X.shape[1]
+	stdout.write("K={}\n".format(num_attributes))
 
 	C = args.num_communities
 	stdout.write("C={}\n".format(C))
@@ -384,36 +704,57 @@ def main():
 	lamb_W = args.lamb_W
 	attribute_type = args.attribute_type
 
-	trainable_model, community_assignment_model = build_model(N, K, C, lamb_F, lamb_W, alpha, attribute_type)
+	configure_threads(args.intra_op_threads, args.inter_op_threads)
+
+	trainable_model, community_assignment_model = build_model(N, num_attributes, C, R, lamb_F, lamb_W, alpha, attribute_type)
 	stdout.write("Built model\n")
 	
 	num_epochs = args.num_epochs
 	batch_size = args.batch_size
 
+	lr = K.get_value(trainable_model.optimizer.lr) * learning_rate_scale(batch_size, args.lr_scaling)
+	K.set_value(trainable_model.optimizer.lr, lr)
+	stdout.write("Learning rate={} for batch_size={}\n".format(lr, batch_size))
+
 	
 	true_communities = preprocess_true_communities(nodes, args.true_communities)
 
 	plot_directory = args.plot_directory
 
-	stdout.write("num_epochs={}, lamb_F={}, lamb_W={}, alpha={}, attribute_type={}".format(num_epochs, 
+	schedule = LearningRateSchedule(args.lr_schedule, num_epochs, args.lr_step_size,
+		args.lr_factor, args.lr_patience)
+	max_time = args.max_hours * 3600 if args.max_hours is not None else None
+	early_stopping = EarlyStopping(args.tolerance, args.patience, args.nmi_patience, max_time)
+
+	checkpoint_filepath = args.checkpoint_filepath
+	checkpoint = None
+	if args.resume:
+		if checkpoint_filepath is not None and os.path.exists(checkpoint_filepath):
+			stdout.write("Loading checkpoint from {}\n".format(checkpoint_filepath))
+			checkpoint = load_checkpoint(checkpoint_filepath)
+		else:
+			stdout.write("No checkpoint found at {}, training from scratch\n".format(checkpoint_filepath))
+
+	stdout.write("num_epochs={}, lamb_F={}, lamb_W={}, alpha={}, attribute_type={}\n".format(num_epochs, 
 		lamb_F, lamb_W, alpha, attribute_type))
 	# stdout.write("saving plots to {}\n".format(plot_directory))
 	stdout.flush()
 
 	train_model(N, C, R, A, X, trainable_model, community_assignment_model, 
-		num_epochs, batch_size, true_communities, plot_directory)
+		num_epochs, batch_size, true_communities, plot_directory, early_stopping, schedule,
+		checkpoint_filepath, args.checkpoint_interval, checkpoint, args.plot_interval, args.plot_format,
+		args.eval_interval, args.eval_batch_size, args.sampler, args.num_sampler_workers,
+		args.sampler_queue_depth, args.sampler_processes, args.steps_per_epoch, args.lr_warmup_steps)
 
 	stdout.write("Trained matrices\n")
 
-	thetas = trainable_model.layers[2].get_weights()[0]
-	M = trainable_model.layers[5].get_weights()[0]
-	W = np.vstack(trainable_model.layers[7].get_weights())
-	F = community_assignment_model.predict([np.identity(N), R])
+	thetas = trainable_model.get_layer("theta_lookup").get_weights()[0]
+	M = trainable_model.get_layer("F").get_weights()[0]
+	W = np.vstack(trainable_model.get_layer("Q").get_weights())
 
 	thetas = pd.DataFrame(thetas)
 	M = pd.DataFrame(M)
 	W = pd.DataFrame(W)
-	F = pd.DataFrame(F)
 
 	thetas_filepath = args.thetas_filepath
 	M_filepath = args.M_filepath
@@ -423,7 +764,8 @@ def main():
 	thetas.to_csv(thetas_filepath, sep=",", index=False, header=False)
 	M.to_csv(M_filepath, sep=",", index=False, header=False)
 	W.to_csv(W_filepath, sep=",", index=False, header=False)
-	F.to_csv(F_filepath, sep=",", index=False, header=False)
+	# memberships are written as they are predicted rather than held in memory
+	predict_communities(community_assignment_model, N, args.eval_batch_size, args.F_top_k, F_filepath)
 
 	stdout.write("Written trained matrices to file\n")
 
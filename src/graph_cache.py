@@ -0,0 +1,161 @@
+import os
+import shutil
+import hashlib
+
+from functools import partial
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import scipy.sparse.csgraph
+import networkx as nx
+import pandas as pd
+
+# bump when the layout of the cache changes
+cache_version = 1
+# number of edges read from an edge list at a time
+edge_list_chunksize = 1000000
+
+def degree_order(degrees):
+	'''
+	nodes sorted by decreasing degree, ties broken by node index
+	'''
+	return np.argsort(-np.asarray(degrees), kind="mergesort")
+
+def degree_rank(degrees):
+	'''
+	rank of every node by decreasing degree (from 0), ties broken by node index
+	'''
+	order = degree_order(degrees)
+	rank = np.empty(len(order), dtype=np.int64)
+	rank[order] = np.arange(len(order))
+	return rank
+
+def radial_coordinates(degrees, gamma):
+	'''
+	radial co-ordinates of nodes in the popularity similarity model
+	R_i = 2 beta log i + 2 (1 - beta) log N for the node with the ith highest degree,
+	where beta = 1 / (gamma - 1)
+	'''
+	N = len(degrees)
+	beta = 1. / (gamma - 1)
+	return 2 * beta * np.log(degree_rank(degrees) + 1) + 2 * (1 - beta) * np.log(N)
+
+def hash_files(filepaths, block_size=1 << 20):
+	'''
+	sha1 of the contents of all filepaths
+	'''
+	sha1 = hashlib.sha1()
+	for filepath in filepaths:
+		with open(filepath, "rb") as f:
+			for block in iter(lambda: f.read(block_size), b""):
+				sha1.update(block)
+	return sha1.hexdigest()
+
+def save_arrays(cache_path, arrays):
+	'''
+	write a dictionary of arrays to cache_path, a directory of .npy files that can be memory mapped
+	'''
+	# write to a temporary directory and rename so that a partial cache is never read
+	temporary_path = "{}.tmp{}".format(cache_path, os.getpid())
+	os.makedirs(temporary_path)
+	for name, array in arrays.items():
+		np.save(os.path.join(temporary_path, "{}.npy".format(name)), array)
+	try:
+		os.rename(temporary_path, cache_path)
+	except OSError:
+		# built concurrently by another job
+		shutil.rmtree(temporary_path)
+
+def load_array(cache_path, name):
+	return np.load(os.path.join(cache_path, "{}.npy".format(name)), mmap_mode="r")
+
+def get_cache_path(filepaths, cache_directory, default_directory_name):
+	'''
+	directory of the cache of filepaths, keyed on the hash of their contents
+	cache_directory defaults to default_directory_name next to the first of filepaths
+	'''
+	if cache_directory is None:
+		cache_directory = os.path.join(os.path.dirname(os.path.abspath(filepaths[0])), default_directory_name)
+	if not os.path.exists(cache_directory):
+		os.makedirs(cache_directory)
+	return os.path.join(cache_directory, "{}_v{}".format(hash_files(filepaths), cache_version))
+
+def largest_connected_component(nodes, A):
+	'''
+	restrict nodes and the adjacency matrix A to the largest connected component
+	'''
+	_, labels = sp.sparse.csgraph.connected_components(A, directed=False)
+	keep = np.flatnonzero(labels == np.bincount(labels).argmax())
+	return nodes[keep], A[keep][:, keep]
+
+def read_gml(filepath):
+	'''
+	nodes and adjacency matrix of the largest connected component of a gml file
+	'''
+	G = nx.read_gml(filepath)
+	G = max(nx.connected_component_subgraphs(G), key=len)
+	nodes = np.array(G.nodes())
+	if nodes.dtype == object:
+		nodes = nodes.astype(str)
+	return nodes, nx.adjacency_matrix(G).tocsr()
+
+def read_edge_list(filepath):
+	'''
+	nodes and adjacency matrix of the largest connected component of a whitespace separated
+	edge list (optionally compressed), read in chunks without building a networkx graph
+
+	edges are undirected, repeated edges are merged and self loops are kept, as in nx.Graph
+	'''
+	chunks = pd.read_csv(filepath, sep=r"\s+", header=None, usecols=[0, 1], comment="#",
+		compression="infer", chunksize=edge_list_chunksize)
+	edges = np.concatenate([chunk.values for chunk in chunks])
+	nodes, edges = np.unique(edges, return_inverse=True)
+	edges = edges.reshape(-1, 2)
+	N = len(nodes)
+
+	A = sp.sparse.csr_matrix((np.ones(2 * len(edges), dtype=np.int64),
+		(np.append(edges[:,0], edges[:,1]), np.append(edges[:,1], edges[:,0]))), shape=(N, N))
+	A.data[:] = 1
+	return largest_connected_component(nodes, A)
+
+def build_graph_cache(filepath, cache_path):
+	'''
+	read graph from filepath (gml or edge list) and write the arrays needed by the trainers
+	to cache_path
+	'''
+	if filepath.endswith(".gml"):
+		nodes, A = read_gml(filepath)
+	else:
+		nodes, A = read_edge_list(filepath)
+	A.sort_indices()
+
+	# self loops count twice towards the degree, as in nx.degree
+	degrees = np.diff(A.indptr) + (A.diagonal() != 0)
+	L = (sp.sparse.diags(np.asarray(A.sum(axis=1)).ravel()) - A).tocsr().astype(np.float64)
+	L.sort_indices()
+
+	save_arrays(cache_path, {"nodes" : nodes, "degrees" : degrees,
+		"A_data" : A.data, "A_indices" : A.indices, "A_indptr" : A.indptr,
+		"L_data" : L.data, "L_indices" : L.indices, "L_indptr" : L.indptr})
+
+def load_graph(filepath, cache_directory=None):
+	'''
+	nodes, adjacency matrix A (csr), degrees and laplacian L (csr) of the largest connected
+	component of the graph in filepath
+
+	the graph is parsed once and cached in cache_directory (default is .graph_cache next to filepath)
+	under the hash of its contents, later calls memory map the cached arrays
+	'''
+	cache_path = get_cache_path([filepath], cache_directory, ".graph_cache")
+	if not os.path.exists(cache_path):
+		build_graph_cache(filepath, cache_path)
+
+	load = partial(load_array, cache_path)
+
+	nodes = load("nodes")
+	N = len(nodes)
+	A = sp.sparse.csr_matrix((load("A_data"), load("A_indices"), load("A_indptr")), shape=(N, N))
+	L = sp.sparse.csr_matrix((load("L_data"), load("L_indices"), load("L_indptr")), shape=(N, N))
+
+	return nodes, A, load("degrees"), L
@@ -0,0 +1,152 @@
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import scipy.sparse.linalg
+
+# graphs with at most this many nodes are embedded with shift invert eigsh by method "auto"
+max_shift_invert_nodes = 10000
+# (coarse) graphs with at most this many nodes are embedded with a dense eigensolver
+max_dense_nodes = 1000
+# coarsening stops once a level keeps more than this fraction of the nodes of the level above
+min_coarsening_reduction = 0.9
+# rounds of matching unmatched nodes with their strongest unmatched neighbour per coarsening
+matching_rounds = 3
+
+def normalized_laplacian(L, degrees):
+	'''
+	D^-1/2 L D^-1/2 for laplacian L and (weighted) degrees D
+	'''
+	scale = sp.sparse.diags(1 / np.sqrt(degrees))
+	return scale.dot(L).dot(scale).tocsr()
+
+def laplacian_eigenmap(L, degrees, method="lobpcg", Y=None, tol=1e-5, maxiter=200):
+	'''
+	the two smallest non trivial solutions of the generalised eigenproblem L y = lambda D y
+	(Laplacian Eigenmaps), as columns of an (N, 2) array
+
+	computed from the normalized laplacian with its trivial eigenvector D^1/2 1 projected out,
+	by LOBPCG, starting from Y if given
+	(a warm start, such as the eigenmap of a coarser graph) or random vectors,
+	graphs of at most max_dense_nodes are solved exactly
+	'''
+	N = L.shape[0]
+	sqrt_degrees = np.sqrt(degrees)
+	L_norm = normalized_laplacian(L, degrees)
+	trivial = (sqrt_degrees / np.linalg.norm(sqrt_degrees))[:, None]
+
+	if N <= max_dense_nodes:
+		_, V = np.linalg.eigh(L_norm.toarray())
+		return V[:, 1:3] / sqrt_degrees[:, None]
+
+	if Y is None:
+		X = np.random.normal(size=(N, 2))
+	else:
+		X = Y * sqrt_degrees[:, None]
+	X -= trivial.dot(trivial.T.dot(X))
+
+	if method == "lobpcg":
+		eigenvalues, V = sp.sparse.linalg.lobpcg(L_norm, X, Y=trivial, tol=tol, maxiter=maxiter,
+			largest=False)
+		V = V[:, np.argsort(eigenvalues)]
+	else:
+		raise ValueError("unknown method {}".format(method))
+
+	return V / sqrt_degrees[:, None]
+
+def coarsen_laplacian(L, degrees):
+	'''
+	heavy edge matching: pair nodes that are each other's strongest neighbour (largest A_uv / (d_u d_v),
+	with symmetric random tie breaking), repeated for matching_rounds over the unmatched nodes,
+	every pair and every unmatched node becomes a coarse node
+
+	returns the (N, N_coarse) aggregation matrix P and the Galerkin laplacian P^T L P
+	and degrees P^T D of the coarse graph
+	'''
+	N = L.shape[0]
+	A = (sp.sparse.diags(L.diagonal()) - L).tocsr()
+	A.eliminate_zeros()
+	noise = sp.sparse.triu(A, k=1).tocsr()
+	noise.data = np.random.uniform(1, 2, size=noise.nnz)
+	strength = sp.sparse.diags(1 / degrees).dot(A.multiply(noise + noise.T)).dot(
+		sp.sparse.diags(1 / degrees)).tocsr()
+
+	nodes = np.arange(N)
+	match = nodes.copy()
+	for _ in range(matching_rounds):
+		unmatched = sp.sparse.diags((match == nodes).astype(np.float64))
+		S = unmatched.dot(strength).dot(unmatched).tocsr()
+		S.eliminate_zeros()
+		choices = np.asarray(S.argmax(axis=1)).ravel()
+		mutual = (np.diff(S.indptr) > 0) & (choices[choices] == nodes)
+		match[mutual] = choices[mutual]
+
+	_, labels = np.unique(np.minimum(nodes, match), return_inverse=True)
+	P = sp.sparse.csr_matrix((np.ones(N), (np.arange(N), labels)), shape=(N, labels.max() + 1))
+
+	return P, P.T.dot(L).dot(P).tocsr(), P.T.dot(degrees)
+
+def multilevel_eigenmap(L, degrees, method="lobpcg", coarsest_size=max_dense_nodes,
+	refine_iterations=20):
+	'''
+	laplacian_eigenmap by coarsen, embed and refine: the graph is coarsened with coarsen_laplacian
+	until it has at most coarsest_size nodes, embedded exactly, and the embedding of every level
+	is interpolated to the level below and refined there by refine_iterations of method
+	'''
+	levels = []
+	while L.shape[0] > coarsest_size:
+		P, L_coarse, degrees_coarse = coarsen_laplacian(L, degrees)
+		if P.shape[1] > min_coarsening_reduction * L.shape[0]:
+			break
+		levels.append((L, degrees, P))
+		L, degrees = L_coarse, degrees_coarse
+
+	Y = laplacian_eigenmap(L, degrees, method)
+	for L, degrees, P in reversed(levels):
+		Y = laplacian_eigenmap(L, degrees, method, P.dot(Y), maxiter=refine_iterations)
+	return Y
+
+def labne_angles(L, method="auto", thetas=None):
+	'''
+	angular co-ordinates of nodes from the laplacian L of a connected graph, as in LaBNE:
+	the angle of every node in the two dimensional Laplacian Eigenmap of the graph
+
+	method is "eigsh" (shift invert on L, which factorises L), "lobpcg" (see laplacian_eigenmap),
+	"multilevel" (see multilevel_eigenmap) or "auto", which is eigsh
+	for graphs of at most max_shift_invert_nodes and multilevel LOBPCG otherwise
+
+	thetas are a warm start for lobpcg, such as the angles of an earlier embedding
+	'''
+	N = L.shape[0]
+	if method == "auto":
+		if thetas is not None:
+			method = "lobpcg"
+		elif N <= max_shift_invert_nodes:
+			method = "eigsh"
+		else:
+			method = "multilevel"
+
+	if method == "eigsh":
+		_, V = sp.sparse.linalg.eigsh(L, k=3, which="LM", sigma=0)
+		return np.arctan2(V[:,2], V[:,1])
+
+	# connected, so every degree is positive
+	degrees = L.diagonal().astype(np.float64)
+	if method == "multilevel":
+		Y = multilevel_eigenmap(L, degrees)
+	else:
+		Y = None
+		if thetas is not None:
+			thetas = np.asarray(thetas).ravel()
+			Y = np.column_stack([np.cos(thetas), np.sin(thetas)])
+		Y = laplacian_eigenmap(L, degrees, method, Y)
+	return np.arctan2(Y[:,1], Y[:,0])
+
+def equidistant_angles(angles):
+	'''
+	angles spread evenly around the circle in the order of the given angles:
+	2 pi rank / N for the node of every rank (from 0), ties broken by node index
+	'''
+	N = len(angles)
+	rank = np.empty(N, dtype=np.int64)
+	rank[np.argsort(angles, kind="mergesort")] = np.arange(N)
+	return rank * 2 * np.pi / N
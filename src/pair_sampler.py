@@ -0,0 +1,165 @@
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from itertools import count
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+# the sampler of every worker, set once by initialize_worker
+worker_sampler = None
+
+class PairSampler(object):
+	'''
+	minibatches of node pairs (u, v) with the edge indicator A_uv and attributes X_u and X_v
+	of every pair, as contiguous float32 arrays
+
+	"uniform" samples pairs uniformly,
+	"edge" samples edge_fraction of the batch from the edges of A and the rest uniformly,
+	"degree" samples edge_fraction of the batch from the edges of A and the rest with u uniform
+	and v in proportion to its degree ** degree_exponent
+
+	every pair has an importance weight, scaled so that a uniformly sampled pair weighs 1,
+	so that the weighted loss estimates the loss over all pairs whatever the sampler
+	(sampled non edges that are edges weigh 0 as the edges are counted by the edge samples)
+	and every u and v has an importance weight for the distribution of u and v over the whole batch,
+	so that the weighted attribute losses estimate the mean over all nodes
+	'''
+
+	def __init__(self, A, X, batch_size=100, sampler="uniform", edge_fraction=0.5, degree_exponent=0.75):
+		A = sp.sparse.csr_matrix(A)
+		A.sum_duplicates()
+		self.N = A.shape[0]
+		self.batch_size = batch_size
+		self.sampler = sampler
+		self.edge_fraction = edge_fraction
+
+		# edges as keys u N + v in increasing order, so that a batch of pairs is looked up
+		# with a single vectorised binary search
+		self.edges = (np.repeat(np.arange(self.N), np.diff(A.indptr)), A.indices)
+		self.keys = self.edges[0].astype(np.int64) * self.N + self.edges[1]
+
+		self.X = sp.sparse.csr_matrix(X, dtype=np.float32)
+
+		probabilities = np.diff(A.indptr).astype(np.float64) ** degree_exponent
+		self.probabilities = probabilities / probabilities.sum()
+		self.cumulative_probabilities = np.cumsum(self.probabilities)
+
+		self.node_weights = self.compute_node_weights()
+
+	def compute_node_weights(self):
+		'''
+		importance weights of every node as u and as v, 1 / (N q(u)) for the probability q(u)
+		of a node of the batch being u (a mixture of the edge samples and the rest)
+		'''
+		N = self.N
+		if self.sampler == "uniform":
+			return np.ones(N), np.ones(N)
+
+		num_edges = int(round(self.edge_fraction * self.batch_size))
+		edge_fraction = float(num_edges) / self.batch_size
+		uniform = np.ones(N) / N
+		U_probabilities = np.bincount(self.edges[0], minlength=N) / float(len(self.keys))
+		V_probabilities = np.bincount(self.edges[1], minlength=N) / float(len(self.keys))
+		pair_V_probabilities = self.probabilities if self.sampler == "degree" else uniform
+
+		U_probabilities = edge_fraction * U_probabilities + (1 - edge_fraction) * uniform
+		V_probabilities = edge_fraction * V_probabilities + (1 - edge_fraction) * pair_V_probabilities
+		# nodes never sampled as v (without edges, with the degree sampler) are left out of the estimate
+		V_probabilities[V_probabilities == 0] = np.inf
+		return 1 / (N * U_probabilities), 1 / (N * V_probabilities)
+
+	def is_edge(self, U, V):
+		'''
+		A_uv != 0 for every pair (u, v)
+		'''
+		keys = U.astype(np.int64) * self.N + V
+		idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+		return self.keys[idx] == keys
+
+	def sample_pairs(self, random_state=np.random):
+		'''
+		U, V and importance weights of batch_size pairs
+		'''
+		N = self.N
+		if self.sampler == "uniform":
+			U = random_state.randint(N, size=self.batch_size)
+			V = random_state.randint(N, size=self.batch_size)
+			return U, V, np.ones(self.batch_size)
+
+		num_edges = int(round(self.edge_fraction * self.batch_size))
+		num_pairs = self.batch_size - num_edges
+		idx = random_state.randint(len(self.keys), size=num_edges)
+		U = random_state.randint(N, size=num_pairs)
+		if self.sampler == "degree":
+			V = np.searchsorted(self.cumulative_probabilities,
+				random_state.uniform(size=num_pairs) * self.cumulative_probabilities[-1], side="right")
+			V = np.minimum(V, N - 1)
+			weights = 1 / (N * self.probabilities[V])
+		else:
+			V = random_state.randint(N, size=num_pairs)
+			weights = np.ones(num_pairs)
+		weights *= float(self.batch_size) / num_pairs * ~self.is_edge(U, V)
+
+		edge_weights = np.ones(num_edges) * len(self.keys) * self.batch_size / (num_edges * float(N) ** 2)
+		return (np.append(self.edges[0][idx], U), np.append(self.edges[1][idx], V),
+			np.append(edge_weights, weights))
+
+	def sample(self, random_state=np.random):
+		'''
+		a minibatch for fit_generator: inputs [U, V] (int32 node indices of shape (batch_size, 1)),
+		targets [A_uv, X_u, X_v] and sample weights of the pairs, of u and of v
+		'''
+		U, V, weights = self.sample_pairs(random_state)
+		A_uv = self.is_edge(U, V).astype(np.float32).reshape(-1, 1)
+		U_weights, V_weights = self.node_weights
+		return ([U.astype(np.int32).reshape(-1, 1), V.astype(np.int32).reshape(-1, 1)],
+			[A_uv, self.X[U].toarray(), self.X[V].toarray()],
+			[weights.astype(np.float32), U_weights[U].astype(np.float32), V_weights[V].astype(np.float32)])
+
+def initialize_worker(sampler):
+	global worker_sampler
+	worker_sampler = sampler
+
+def sample_worker(seed):
+	return worker_sampler.sample(np.random.RandomState(seed))
+
+class PrefetchingSampler(object):
+	'''
+	minibatches of a PairSampler generated ahead of training by num_workers threads, or processes
+	(forked once, so they share the graph with the trainer), with at most queue_depth batches
+	in progress or waiting, num_workers=0 samples every batch when it is asked for
+
+	the batches of every epoch are drawn from random states seeded by (seed, epoch, batch)
+	so that they depend neither on the number of workers nor on how far ahead they were sampled
+	'''
+
+	def __init__(self, sampler, num_workers=0, queue_depth=10, processes=False):
+		self.sampler = sampler
+		self.queue_depth = max(1, queue_depth)
+		self.pool = None
+		if num_workers > 0:
+			self.pool = (Pool if processes else ThreadPool)(num_workers,
+				initializer=initialize_worker, initargs=(sampler, ))
+
+	def batches(self, seed, initial_epoch=0, steps_per_epoch=1000):
+		'''
+		endless generator of the steps_per_epoch minibatches of every epoch from initial_epoch
+		'''
+		seeds = ([seed, epoch, batch] for epoch in count(initial_epoch) for batch in range(steps_per_epoch))
+		if self.pool is None:
+			for batch_seed in seeds:
+				yield self.sampler.sample(np.random.RandomState(batch_seed))
+			return
+
+		pending = deque()
+		for batch_seed in seeds:
+			pending.append(self.pool.apply_async(sample_worker, (batch_seed, )))
+			if len(pending) >= self.queue_depth:
+				yield pending.popleft().get()
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
@@ -0,0 +1,170 @@
+import os
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from collections import deque
+from multiprocessing import Pool
+
+import matplotlib.pyplot as plt
+from matplotlib import animation
+
+def embedding_coordinates(N, R, thetas, M, F):
+	'''
+	cartesian co-ordinates of nodes and communities, community with the largest
+	membership of every node and the strength of that membership
+	'''
+	R = np.asarray(R).ravel()
+	thetas = np.asarray(thetas).ravel()
+	M = np.asarray(M)
+	F = np.asarray(F)
+
+	assignments = F.argmax(axis=1)
+	assignment_strength = F[np.arange(N), assignments]
+
+	node_cartesian = np.column_stack([R * np.cos(thetas), R * np.sin(thetas)])
+	community_cartesian = np.column_stack([M[0] * np.cos(M[1]), M[0] * np.sin(M[1])])
+
+	return node_cartesian, community_cartesian, assignments, assignment_strength
+
+def draw_network(N, C, R, thetas, M, F, title, filepath):
+	'''
+	scatter nodes, coloured by their community and sized by the strength of their membership,
+	and community centres and save the figure to filepath
+	'''
+	node_cartesian, community_cartesian, assignments, assignment_strength = embedding_coordinates(N,
+		R, thetas, M, F)
+
+	plt.figure(figsize=(15, 15))
+	plt.title(title)
+	plt.scatter(node_cartesian[:,0], node_cartesian[:,1],
+		c=assignments, s=100*assignment_strength, vmin=0, vmax=C-1)
+	plt.scatter(community_cartesian[:,0], community_cartesian[:,1],
+		c=np.arange(C), s=100, vmin=0, vmax=C-1)
+	plt.scatter(community_cartesian[:,0], community_cartesian[:,1],
+		c="k", s=25)
+	plt.savefig(filepath)
+	plt.close()
+
+def save_coordinates(N, thetas, M, F, filepath, **losses):
+	'''
+	compact dump of one epoch for render_animation: thetas, M, community assignments and losses
+	'''
+	F = np.asarray(F)
+	assignments = F.argmax(axis=1)
+	np.savez_compressed(filepath, thetas=np.asarray(thetas, dtype=np.float32).ravel(),
+		M=np.asarray(M, dtype=np.float32), assignments=assignments.astype(np.int32),
+		assignment_strength=F[np.arange(N), assignments].astype(np.float32), **losses)
+
+def plot_title(epoch, losses):
+	return ", ".join(["Epoch={}".format(epoch)] +
+		["{}={}".format(name, loss) for name, loss in sorted(losses.items())])
+
+class Plotter(object):
+	'''
+	plot the embedding every interval epochs in a background process,
+	so that training never waits for matplotlib or the disk
+
+	plot_format "png" draws the network, "coordinates" writes a compressed npz of thetas,
+	M and community assignments per epoch (R is written once to R.npy) for render_animation
+
+	at most queue_depth snapshots wait to be plotted, beyond that training waits for the oldest one,
+	so no snapshot is ever dropped (wait_time is the time training spent waiting)
+	'''
+
+	def __init__(self, plot_directory, N, C, R, interval=1, plot_format="png", queue_depth=4):
+		if not os.path.exists(plot_directory):
+			os.makedirs(plot_directory)
+		self.plot_directory = plot_directory
+		self.N = N
+		self.C = C
+		self.R = np.array(R)
+		self.interval = interval
+		self.plot_format = plot_format
+		if plot_format == "coordinates":
+			np.save(os.path.join(plot_directory, "R.npy"), np.asarray(R).ravel())
+		self.pool = Pool(1)
+		self.queue_depth = max(1, queue_depth)
+		self.pending = deque()
+		self.wait_time = 0.0
+
+	def plot(self, epoch, thetas, M, F, **losses):
+		if epoch % self.interval != 0:
+			return
+		# raise any error from the finished plots
+		while self.pending and self.pending[0].ready():
+			self.pending.popleft().get()
+		if len(self.pending) >= self.queue_depth:
+			start_time = time.time()
+			self.pending.popleft().get()
+			self.wait_time += time.time() - start_time
+
+		# arguments are pickled later by the pool, so take copies before training changes them
+		thetas, M = np.array(thetas), np.array(M)
+		F = F.toarray() if sp.sparse.issparse(F) else np.array(F)
+		if self.plot_format == "coordinates":
+			filepath = os.path.join(self.plot_directory, "epoch_{}.npz".format(epoch))
+			self.pending.append(self.pool.apply_async(save_coordinates, (self.N, thetas, M, F, filepath), losses))
+		else:
+			filepath = os.path.join(self.plot_directory, "epoch_{}.png".format(epoch))
+			self.pending.append(self.pool.apply_async(draw_network, (self.N, self.C, self.R, thetas, M, F,
+				plot_title(epoch, losses), filepath)))
+
+	def close(self):
+		'''
+		wait for every pending snapshot to be plotted
+		'''
+		start_time = time.time()
+		self.pool.close()
+		self.pool.join()
+		while self.pending:
+			self.pending.popleft().get()
+		self.wait_time += time.time() - start_time
+
+def render_animation(plot_directory, filepath, fps=10):
+	'''
+	render the coordinate dumps written by Plotter with plot_format="coordinates"
+	into a single animation (the writer is chosen from the extension of filepath)
+	'''
+	R = np.load(os.path.join(plot_directory, "R.npy"))
+	epochs = sorted(int(filename[len("epoch_"):-len(".npz")]) for filename in os.listdir(plot_directory)
+		if filename.startswith("epoch_") and filename.endswith(".npz"))
+
+	def load(epoch):
+		with np.load(os.path.join(plot_directory, "epoch_{}.npz".format(epoch))) as f:
+			return {name : f[name] for name in f.files}
+
+	frame = load(epochs[0])
+	C = frame["M"].shape[1]
+	limit = 1.05 * max(R.max(), np.abs(frame["M"][0]).max())
+
+	figure = plt.figure(figsize=(15, 15))
+	axes = figure.gca()
+	axes.set_xlim(-limit, limit)
+	axes.set_ylim(-limit, limit)
+	nodes = axes.scatter(np.zeros(len(R)), np.zeros(len(R)), c=np.zeros(len(R)), vmin=0, vmax=C-1)
+	communities = axes.scatter(np.zeros(C), np.zeros(C), c=np.arange(C), s=100, vmin=0, vmax=C-1)
+	centres = axes.scatter(np.zeros(C), np.zeros(C), c="k", s=25)
+
+	def update(epoch):
+		frame = load(epoch)
+		M = frame["M"]
+		node_cartesian = np.column_stack([R * np.cos(frame["thetas"]), R * np.sin(frame["thetas"])])
+		community_cartesian = np.column_stack([M[0] * np.cos(M[1]), M[0] * np.sin(M[1])])
+		nodes.set_offsets(node_cartesian)
+		nodes.set_array(frame["assignments"])
+		nodes.set_sizes(100 * frame["assignment_strength"])
+		communities.set_offsets(community_cartesian)
+		centres.set_offsets(community_cartesian)
+		losses = {name : value.item() for name, value in frame.items() if value.ndim == 0}
+		axes.set_title(plot_title(epoch, losses))
+		return nodes, communities, centres
+
+	anim = animation.FuncAnimation(figure, update, frames=epochs)
+	anim.save(filepath, fps=fps)
+	plt.close(figure)
@@ -0,0 +1,159 @@
+import os
+import time
+
+import numpy as np
+
+class EarlyStopping(object):
+	'''
+	decide after every epoch whether training should stop
+
+	training stops when the relative change in loss has been below tolerance for patience epochs,
+	when NMI has not improved for nmi_patience epochs or when max_time seconds have passed
+	'''
+
+	def __init__(self, tolerance=None, patience=10, nmi_patience=None, max_time=None):
+		self.tolerance = tolerance
+		self.patience = patience
+		self.nmi_patience = nmi_patience
+		self.max_time = max_time
+		self.start_time = time.time()
+		self.previous_loss = None
+		self.converged_epochs = 0
+		self.best_nmi = -np.inf
+		self.nmi_epochs = 0
+
+	def check(self, loss, nmi=None):
+		'''
+		returns the reason to stop, or None to continue
+		'''
+		if self.tolerance is not None and self.previous_loss is not None:
+			change = abs(self.previous_loss - loss) / abs(self.previous_loss)
+			if change < self.tolerance:
+				self.converged_epochs += 1
+			else:
+				self.converged_epochs = 0
+			if self.converged_epochs >= self.patience:
+				return "relative change in loss below {} for {} epochs".format(self.tolerance, self.patience)
+		self.previous_loss = loss
+
+		if self.nmi_patience is not None and nmi is not None:
+			if nmi > self.best_nmi:
+				self.best_nmi = nmi
+				self.nmi_epochs = 0
+			else:
+				self.nmi_epochs += 1
+			if self.nmi_epochs >= self.nmi_patience:
+				return "NMI has not improved on {} for {} epochs".format(self.best_nmi, self.nmi_patience)
+
+		if self.max_time is not None and time.time() - self.start_time > self.max_time:
+			return "exceeded time budget of {} seconds".format(self.max_time)
+
+		return None
+
+	def get_state(self):
+		'''
+		progress towards stopping (the time budget restarts on resume)
+		'''
+		return {name : np.array(getattr(self, name))
+			for name in ("previous_loss", "converged_epochs", "best_nmi", "nmi_epochs")}
+
+	def set_state(self, state):
+		for name, value in state.items():
+			setattr(self, name, value.item())
+
+def prefixed(prefix, arrays):
+	'''
+	arrays (a dictionary, or a list named by position) under names prefix/name, to save in a checkpoint
+	'''
+	if isinstance(arrays, (list, tuple)):
+		arrays = dict(enumerate(arrays))
+	return {"{}/{}".format(prefix, name) : value for name, value in arrays.items()}
+
+def unprefixed(checkpoint, prefix):
+	'''
+	the arrays of checkpoint saved by prefixed(prefix, arrays), as a dictionary by name
+	'''
+	return {name.split("/", 1)[1] : value for name, value in checkpoint.items()
+		if name.startswith(prefix + "/")}
+
+def unprefixed_list(checkpoint, prefix):
+	'''
+	the arrays of checkpoint saved by prefixed(prefix, arrays) for a list of arrays, in order
+	'''
+	arrays = unprefixed(checkpoint, prefix)
+	return [arrays[name] for name in sorted(arrays, key=int)]
+
+def save_checkpoint_arrays(filepath, checkpoint, objects=()):
+	'''
+	atomically write the arrays of checkpoint and the state of every (prefix, obj) of objects
+	(see get_state of EarlyStopping) to a compressed npz file
+	'''
+	checkpoint = dict(checkpoint)
+	for prefix, obj in objects:
+		checkpoint.update(prefixed(prefix, obj.get_state()))
+
+	# write to a temporary file and rename so an interrupted write never replaces a good checkpoint
+	temporary_filepath = filepath + ".tmp"
+	with open(temporary_filepath, "wb") as f:
+		np.savez_compressed(f, **checkpoint)
+	os.rename(temporary_filepath, filepath)
+
+def load_checkpoint(filepath):
+	'''
+	read a checkpoint written by save_checkpoint_arrays into a dictionary
+	'''
+	with np.load(filepath) as f:
+		return {name : f[name] for name in f.files}
+
+def restore_states(checkpoint, objects):
+	'''
+	restore the state of every (prefix, obj) of objects saved by save_checkpoint_arrays
+	'''
+	for prefix, obj in objects:
+		obj.set_state(unprefixed(checkpoint, prefix))
+
+class LearningRateSchedule(object):
+	'''
+	scale of the learning rates for each epoch
+
+	"constant" leaves them unchanged, "step" multiplies them by factor every step_size epochs,
+	"cosine" anneals them to 0 over num_epochs and "plateau" multiplies them by factor
+	when the loss has not improved for patience epochs
+	'''
+
+	def __init__(self, schedule="constant", num_epochs=None, step_size=100, factor=0.5, patience=10):
+		self.schedule = schedule
+		self.num_epochs = num_epochs
+		self.step_size = step_size
+		self.factor = factor
+		self.patience = patience
+		self.plateau_scale = 1.
+		self.best_loss = np.inf
+		self.plateau_epochs = 0
+
+	def scale(self, epoch, loss=None):
+		'''
+		scale for epoch, given the loss at the end of the previous epoch
+		'''
+		if self.schedule == "step":
+			return self.factor ** (epoch // self.step_size)
+		elif self.schedule == "cosine":
+			return 0.5 * (1 + np.cos(np.pi * min(epoch, self.num_epochs) / self.num_epochs))
+		elif self.schedule == "plateau" and loss is not None:
+			if loss < self.best_loss:
+				self.best_loss = loss
+				self.plateau_epochs = 0
+			else:
+				self.plateau_epochs += 1
+				if self.plateau_epochs >= self.patience:
+					self.plateau_scale *= self.factor
+					self.plateau_epochs = 0
+		return self.plateau_scale
+
+	def get_state(self):
+		return {name : np.array(getattr(self, name))
+			for name in ("plateau_scale", "best_loss", "plateau_epochs")}
+
+	def set_state(self, state):
+		for name, value in state.items():
+			setattr(self, name, value.item())
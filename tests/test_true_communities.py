@@ -0,0 +1,42 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import generative_model
+
+class TrueCommunitiesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filepath = os.path.join(self.directory, "communities.txt")
+		with open(self.filepath, "w") as f:
+			f.write("10 3\n7 1\n42 2\n")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_string_labels_are_looked_up(self):
+		# node labels as read from a gml file, in a different order from the file
+		nodes = np.array([u"42", u"10", u"7"])
+		communities = generative_model.preprocess_true_communities(nodes, self.filepath)
+		np.testing.assert_array_equal(communities, [2, 3, 1])
+
+	def test_integer_nodes_are_positions(self):
+		communities = generative_model.preprocess_true_communities(np.array([2, 0]), self.filepath)
+		np.testing.assert_array_equal(communities, [2, 3])
+
+	def test_missing_label(self):
+		with self.assertRaises(AssertionError):
+			generative_model.preprocess_true_communities(np.array([u"10", u"5"]), self.filepath)
+
+	def test_no_file(self):
+		self.assertIsNone(generative_model.preprocess_true_communities(np.array([u"10"]), None))
+
+if __name__ == "__main__":
+	unittest.main()